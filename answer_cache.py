@@ -0,0 +1,119 @@
+"""Semantic cache of chat answers.
+An answer is reused when the same bot and model are asked a question whose embedding is
+similar enough to a cached question, and the retrieval returned the same chunks (the context
+fingerprint), so rebuilding a memory invalidates the answers based on it.
+"""
+import time
+import hashlib
+import threading
+import numpy as np
+
+ANSWER_TTL = 24 * 3600 # seconds
+ANSWER_MAX_ENTRIES = 1000
+ANSWER_SIMILARITY = 0.95 # min cosine similarity of the questions
+# answers depending on these tools are never cached: data changes and time passes
+NO_CACHE_TOOLS = ('execute_sql', 'get_current_date_time')
+
+def fingerprint(chunk_ids, chunks, *context):
+    """Fingerprint of the retrieved chunks and any other text the answer depends on.
+    Args:
+        chunk_ids: (memory path, chunk id) of the retrieved chunks.
+        chunks: texts of the retrieved chunks, so that a rebuilt memory does not match.
+        context: other texts, e.g. the previous user turn.
+    """
+    h = hashlib.sha1()
+    for path, chunk_id in chunk_ids:
+        h.update(f'{path}#{chunk_id}\n'.encode('utf-8'))
+    for text in (*chunks, *context):
+        h.update(hashlib.sha1(text.encode('utf-8')).digest())
+    return h.hexdigest()
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class AnswerCache():
+    """In-process answer cache with TTL and LRU size eviction."""
+    def __init__(self, ttl=ANSWER_TTL, max_entries=ANSWER_MAX_ENTRIES, similarity=ANSWER_SIMILARITY):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        # (bot, model, fingerprint) -> list of [question vector, answer, created, last used]
+        self._entries = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.metrics = {'hits': 0, 'misses': 0, 'stores': 0, 'bypassed': 0, 'expired': 0, 'evicted': 0}
+
+    def get(self, bot, model, context_fingerprint, query_embedding):
+        """Return the cached answer of a similar question asked with the same context, or None."""
+        vector = _unit(query_embedding)
+        now = time.time()
+        with self._lock:
+            key = (bot, model, context_fingerprint)
+            entries = self._entries.get(key, [])
+            fresh = [e for e in entries if now - e[2] < self.ttl]
+            if len(fresh) < len(entries):
+                self.metrics['expired'] += len(entries) - len(fresh)
+                self._size -= len(entries) - len(fresh)
+                self._set(key, fresh)
+            best = max(fresh, key=lambda e: float(e[0] @ vector), default=None)
+            if best is None or float(best[0] @ vector) < self.similarity:
+                self.metrics['misses'] += 1
+                return None
+            best[3] = now
+            self.metrics['hits'] += 1
+            return best[1]
+
+    def put(self, bot, model, context_fingerprint, query_embedding, answer):
+        now = time.time()
+        with self._lock:
+            self._entries.setdefault((bot, model, context_fingerprint), []).append(
+                [_unit(query_embedding), answer, now, now])
+            self._size += 1
+            self.metrics['stores'] += 1
+            while self._size > self.max_entries:
+                self._evict_lru()
+
+    def bypass(self):
+        """Count an answer which was not cached because of the tools it used."""
+        with self._lock:
+            self.metrics['bypassed'] += 1
+
+    def _set(self, key, entries):
+        if entries:
+            self._entries[key] = entries
+        else:
+            del self._entries[key]
+
+    def _evict_lru(self):
+        key, entry = min(((key, e) for key, entries in self._entries.items() for e in entries),
+                         key=lambda item: item[1][3])
+        self._set(key, [e for e in self._entries[key] if e is not entry])
+        self._size -= 1
+        self.metrics['evicted'] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.metrics['hits'] + self.metrics['misses']
+            return {**self.metrics, 'entries': self._size,
+                    'hit_rate': self.metrics['hits'] / lookups if lookups else 0.0}
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+def get_answer_cache():
+    """Return the process-wide answer cache shared by the chat bots."""
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache()
+        return _answer_cache
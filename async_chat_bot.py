@@ -0,0 +1,154 @@
+"""Async Chat_Bot serving many concurrent conversations from one process.
+The loaded memory, index and embedder are shared, read-only, by all the sessions; the state of each
+conversation lives in a ChatSession. The LLM and embeddings calls are awaited on the AsyncOpenAI
+client, the FAISS search and the tools run on worker threads.
+"""
+import time
+import asyncio
+import utils
+import llm_client
+import answer_cache
+import tool_registry
+from chat_bot import Chat_Bot, MEMORY_PATH, tools
+
+SESSION_TTL = 3600 # seconds a session is kept without a turn
+MAX_SESSIONS = 1000 # sessions kept, the least recently used are ended beyond
+
+class ChatSession():
+    """State of one conversation: its chat history and the stats of its last turn."""
+    def __init__(self, session_id, chat_history):
+        self.session_id = session_id
+        self.chat_history = chat_history
+        self.retrieval_stats = None
+        self.context_stats = None
+        self.prompt_cache_stats = None
+        self.created = time.time()
+        self.last_used = self.created
+        # turns of a conversation are answered one at a time
+        self.lock = asyncio.Lock()
+
+class AsyncChat_Bot(Chat_Bot):
+    """Chat_Bot whose chat is a coroutine over per-session state, see achat."""
+    def __init__(self, memory_path=MEMORY_PATH, session_ttl=SESSION_TTL, max_sessions=MAX_SESSIONS, **kwargs):
+        """
+        Args:
+            session_ttl (float): seconds after its last turn a session is ended.
+            max_sessions (int): max number of sessions kept, the least recently used are ended beyond.
+            see Chat_Bot for the other arguments.
+        """
+        super().__init__(memory_path=memory_path, **kwargs)
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        self.sessions = {}
+
+    def session(self, session_id):
+        """Return the session, starting it on first use."""
+        if session_id not in self.sessions:
+            self.evict_sessions(self.max_sessions - 1)
+            self.sessions[session_id] = ChatSession(session_id, self.new_history())
+        session = self.sessions[session_id]
+        session.last_used = time.time()
+        return session
+
+    def evict_sessions(self, max_sessions=None):
+        """End the sessions idle for longer than session_ttl, then the least recently used ones
+        beyond max_sessions (the bot's by default). Sessions answering a turn are kept."""
+        max_sessions = self.max_sessions if max_sessions is None else max_sessions
+        idle = [s for s in self.sessions.values() if not s.lock.locked()]
+        expired = {s.session_id for s in idle if time.time() - s.last_used > self.session_ttl}
+        excess = len(self.sessions) - len(expired) - max_sessions
+        if excess > 0:
+            lru = sorted((s for s in idle if s.session_id not in expired), key=lambda s: s.last_used)
+            expired.update(s.session_id for s in lru[:excess])
+        for session_id in expired:
+            self.end_session(session_id)
+        return len(expired)
+
+    def end_session(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    async def asearch_chunks(self, queries, session):
+        """search_chunks of a session: the queries are embedded on the asyncio client and
+        searched on a worker thread, the stats are kept in the session."""
+        start = time.perf_counter()
+        query_embedding = await self.embedder.aembed_queries(queries, reduce=False) \
+            if self.needs_embedding(queries) else None
+        embedded = time.perf_counter()
+        chunks, ids, scores, query_results = await asyncio.to_thread(self.retrieve, queries, query_embedding)
+        searched = time.perf_counter()
+        session.retrieval_stats = Chat_Bot.retrieval_report(queries, ids, scores, query_results,
+                                                            (embedded - start) * 1000, (searched - embedded) * 1000)
+        return chunks, ids, scores
+
+    async def achat(self, prompt, session_id='default', model=utils.CHAT_MODEL, temperature=0.3):
+        """
+        Args:
+            prompt (str): user prompt or question for the AI bot
+            session_id: the conversation, its chat history is kept apart from the other sessions'
+            model (str): LLM model id
+            temperature (float): ranging from 0.0 to 2.0, the bigger the wilder
+        """
+        session = self.session(session_id)
+        async with session.lock:
+            session.last_used = time.time()
+            queries = self.get_queries(prompt, session.chat_history)
+            relevant_chunks, ids, scores = await self.asearch_chunks(queries, session)
+
+            if self.answer_cache is not None:
+                fingerprint = answer_cache.fingerprint(ids, relevant_chunks, *queries[1:])
+                query_embedding = (await self.embedder.aembed_queries([prompt], reduce=False))[0]
+                answer = self.answer_cache.get(self.bot_key, model, fingerprint, query_embedding)
+                if answer is not None:
+                    self._add_to_history(prompt, answer, session.chat_history)
+                    return answer
+
+            content, session.context_stats = self.pack_context(relevant_chunks, scores, model)
+            messages = self.build_messages(prompt, content, session.chat_history)
+            response = await llm_client.achat_completion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=False,
+                tools=tools, tool_choice='auto'
+            )
+            usages = [response.usage]
+            response = await AsyncChat_Bot.aprocess_tool_calls(response, messages, model, usages)
+            self.record_prompt_cache(usages, session)
+            answer = response.choices[0].message.content
+
+            if self.answer_cache is not None and answer:
+                used_tools = {tool_call['function']['name'] for m in messages for tool_call in m.get('tool_calls', [])}
+                if used_tools & set(answer_cache.NO_CACHE_TOOLS):
+                    self.answer_cache.bypass()
+                else:
+                    self.answer_cache.put(self.bot_key, model, fingerprint, query_embedding, answer)
+            self._add_to_history(prompt, answer, session.chat_history)
+            return answer
+
+    @staticmethod
+    async def aprocess_tool_calls(response, messages, model=utils.CHAT_MODEL, usages=None):
+        """process_tool_calls on the asyncio client, the tools of a response run concurrently on the tool pool."""
+        for iteration in range(tool_registry.MAX_TOOL_ITERATIONS):
+            if response.choices[0].finish_reason != 'tool_calls':
+                return response
+            message = response.choices[0].message
+            tool_calls = Chat_Bot.tool_call_dicts(message)
+            Chat_Bot.append_tool_results(tool_calls, await tool_registry.acall_many(tool_calls), messages,
+                                         message.content)
+            response = await llm_client.achat_completion(
+                model=model,
+                messages=messages,
+                tools=tools, tool_choice='auto' if iteration < tool_registry.MAX_TOOL_ITERATIONS - 1 else 'none',
+                stream=False
+            )
+            if usages is not None:
+                usages.append(response.usage)
+        return Chat_Bot.final_response(response)
+
+if __name__ == "__main__":
+    async def main():
+        bot = AsyncChat_Bot()
+        answers = await asyncio.gather(bot.achat('what is DARE', session_id=1),
+                                       bot.achat('what is the merchant table', session_id=2))
+        print(*answers, sep='\n\n')
+    asyncio.run(main())
@@ -0,0 +1,513 @@
+"""Benchmarks of the memory and retrieval components.
+Usage:
+    python benchmark.py index --mem-path ./memory/dare
+    python benchmark.py index --synthetic 20000
+    python benchmark.py storage --mem-path ./memory/dare
+    python benchmark.py pdf --pages 500
+    python benchmark.py lexical --mem-path ./memory/dare
+    python benchmark.py imports
+    python benchmark.py concurrency --mem-path ./memory/dare --sessions 200
+    python benchmark.py prompt-cache --mem-path ./memory/dare
+    python benchmark.py history --mem-path ./memory/dare --turns 30
+    python benchmark.py resilience --error-rate 0.1 --slow-rate 0.05
+"""
+import os
+import re
+import sys
+import argparse
+import subprocess
+import asyncio
+import contextlib
+import io
+import tempfile
+import time
+import faiss
+import numpy as np
+import embedder
+import pdf_extract
+import bm25
+from chunk_store import ChunkStore
+from embedder import Embedder
+
+# cold import time budget of the modules the bots start with, in ms
+IMPORT_BUDGET_MS = {'chat_bot': 800, 'bot_factory': 900}
+
+def load_embeddings(mem_path):
+    return np.load(f'{mem_path}/embeddings.npy').astype(np.float32)
+
+def synthetic_embeddings(n, dim=3072, n_clusters=200, seed=0):
+    """Generate n clustered vectors, which behave more like real embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, n)
+    return centers[labels] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+
+def sample_queries(embeddings, n_queries=100, seed=1):
+    """Queries are perturbed copies of stored vectors, i.e. questions close to some chunks."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeddings), size=min(n_queries, len(embeddings)), replace=False)
+    noise = rng.standard_normal((len(rows), embeddings.shape[1])).astype(np.float32)
+    scale = 0.1 * np.linalg.norm(embeddings[rows], axis=1, keepdims=True) / np.sqrt(embeddings.shape[1])
+    return (embeddings[rows] + scale * noise).astype(np.float32)
+
+def recall_at_k(result_ids, truth_ids, k):
+    return float(np.mean([len(set(r[:k]) & set(t[:k])) / k for r, t in zip(result_ids, truth_ids)]))
+
+def _search_one_by_one(index, queries, k):
+    """Search the queries one at a time like the chat bot does, returning (ids, mean latency in ms)."""
+    ids = []
+    start = time.perf_counter()
+    for q in queries:
+        _, i = index.search(q.reshape(1, -1), k)
+        ids.append(i[0])
+    return np.array(ids), (time.perf_counter() - start) / len(queries) * 1000
+
+def _print_table(rows):
+    if not rows:
+        return
+    headers = list(rows[0].keys())
+    widths = [max(len(h), *(len(str(r[h])) for r in rows)) for h in headers]
+    print('  '.join(h.ljust(w) for h, w in zip(headers, widths)))
+    for r in rows:
+        print('  '.join(str(r[h]).ljust(w) for h, w in zip(headers, widths)))
+
+def benchmark_index_types(embeddings, k=5, n_queries=100,
+                          index_types=embedder.INDEX_TYPES, metrics=embedder.METRICS):
+    """Compare the index types against the flat (exact) index of the same metric.
+    Reports build time, recall@k, mean single-query latency and serialised index size."""
+    raw_queries = sample_queries(embeddings, n_queries)
+    rows = []
+    for metric in metrics:
+        queries = embedder.prepare_vectors(raw_queries, metric)
+        truth = None
+        for index_type in index_types:
+            start = time.perf_counter()
+            index = Embedder.create_faiss_index(embeddings, index_type, metric)
+            build_s = time.perf_counter() - start
+            embedder.set_search_params(index)
+            ids, latency_ms = _search_one_by_one(index, queries, k)
+            if truth is None:
+                truth = ids if index_type == 'flat' else \
+                    Embedder.create_faiss_index(embeddings, 'flat', metric).search(queries, k)[1]
+            rows.append({
+                'index': index_type,
+                'metric': metric,
+                'build_s': f'{build_s:.2f}',
+                f'recall@{k}': f'{recall_at_k(ids, truth, k):.3f}',
+                'query_ms': f'{latency_ms:.3f}',
+                'size_mb': f'{faiss.serialize_index(index).size / 2**20:.1f}',
+            })
+    _print_table(rows)
+    return rows
+
+def _storage_layouts(embeddings, queries, reduced_dim):
+    """(name, stored vectors, index dtype, stored -> float32 vectors, query vectors) of each layout."""
+    layouts = [('float64 (current)', embeddings.astype(np.float64), 'float32', None, queries)]
+    for dtype in embedder.DTYPES:
+        stored, sq_params = embedder.encode_vectors(embeddings, dtype)
+        layouts.append((dtype, stored, dtype, sq_params, queries))
+
+    pca = faiss.PCAMatrix(embeddings.shape[1], reduced_dim)
+    pca.train(embeddings)
+    layouts.append((f'pca{reduced_dim} float32', pca.apply(embeddings), 'float32', None, pca.apply(queries)))
+    # text-embedding-3 shortened vectors are the leading dimensions, re-normalised
+    def shorten(v):
+        v = np.ascontiguousarray(v[:, :reduced_dim])
+        faiss.normalize_L2(v)
+        return v
+    layouts.append((f'dimensions={reduced_dim} float32', shorten(embeddings), 'float32', None, shorten(queries)))
+    return layouts
+
+def benchmark_storage(embeddings, k=5, n_queries=100, reduced_dim=None):
+    """Compare the vector storage layouts against the current float64, full dimension layout.
+    Reports embeddings.npy size and load time, flat index single query latency and recall@k."""
+    reduced_dim = reduced_dim or max(1, embeddings.shape[1] // 4)
+    if reduced_dim > len(embeddings):
+        # the PCA is fitted on the memory, it needs at least as many vectors as output dimensions
+        print(f"only {len(embeddings)} vectors, reducing to {len(embeddings)} dimensions instead of {reduced_dim}.")
+        reduced_dim = len(embeddings)
+    queries = sample_queries(embeddings, n_queries)
+    truth = Embedder.create_faiss_index(embeddings).search(queries, k)[1]
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, stored, dtype, sq_params, layout_queries in _storage_layouts(embeddings, queries, reduced_dim):
+            path = f'{tmp_dir}/embeddings.npy'
+            np.save(path, stored)
+            start = time.perf_counter()
+            loaded = np.load(path)
+            load_ms = (time.perf_counter() - start) * 1000
+            index = Embedder.create_faiss_index(embedder.decode_vectors(loaded, sq_params), 'flat', 'l2', dtype)
+            ids, latency_ms = _search_one_by_one(index, np.ascontiguousarray(layout_queries, dtype=np.float32), k)
+            rows.append({
+                'layout': name,
+                'disk_mb': f'{os.path.getsize(path) / 2**20:.1f}',
+                'load_ms': f'{load_ms:.1f}',
+                'query_ms': f'{latency_ms:.3f}',
+                f'recall@{k}': f'{recall_at_k(ids, truth, k):.3f}',
+            })
+    _print_table(rows)
+    return rows
+
+def generate_pdf(pdf_path, pages=500, lines_per_page=50):
+    """Write a PDF of text-dense pages, like the scheme fee manuals."""
+    import fitz
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        text = '\n'.join(f"page {i} line {j}: interchange rate for consumer credit card category {j} is 0.{j:02d}%"
+                         for j in range(lines_per_page))
+        page.insert_textbox(page.rect + (36, 36, -36, -36), text, fontsize=7)
+    doc.save(pdf_path)
+    doc.close()
+
+def benchmark_pdf_extraction(pdf_path, workers=pdf_extract.DEFAULT_WORKERS):
+    """Compare the serial extraction of all pages with the page-parallel and cached extraction."""
+    import fitz
+    rows = []
+    start = time.perf_counter()
+    with fitz.open(pdf_path) as doc:
+        serial_text = "".join(page.get_text() for page in doc)
+    rows.append({'extraction': 'serial', 'seconds': f'{time.perf_counter() - start:.2f}', 'same_text': True})
+
+    for name, kwargs in ((f'parallel x{workers}', {'workers': workers, 'use_cache': False}),
+                         ('parallel, cold cache', {'workers': workers, 'use_cache': True}),
+                         ('cached', {'workers': workers, 'use_cache': True})):
+        start = time.perf_counter()
+        text = pdf_extract.extract_text(pdf_path, **kwargs)
+        rows.append({'extraction': name, 'seconds': f'{time.perf_counter() - start:.2f}',
+                     'same_text': text == serial_text})
+    _print_table(rows)
+    return rows
+
+def benchmark_lexical(mem_path, n_queries=100, seed=0):
+    """BM25 index build time, size and single query latency over the chunks of the memory.
+    Queries are identifiers sampled from the chunks, like the table and column names users ask about."""
+    chunks = list(ChunkStore(mem_path))
+    start = time.perf_counter()
+    index = bm25.BM25Index.build(chunks)
+    build_s = time.perf_counter() - start
+    rng = np.random.default_rng(seed)
+    identifiers = sorted({w for c in chunks for w in c.split() if bm25.looks_like_identifier(w)})
+    queries = [identifiers[i] for i in rng.integers(0, len(identifiers), n_queries)] if identifiers else ['dare']
+    start = time.perf_counter()
+    for q in queries:
+        index.search(q, 5)
+    latency_ms = (time.perf_counter() - start) / len(queries) * 1000
+    rows = [{'chunks': len(chunks), 'terms': len(index.terms), 'postings': len(index.doc_ids),
+             'build_s': f'{build_s:.2f}', 'query_ms': f'{latency_ms:.3f}'}]
+    _print_table(rows)
+    return rows
+
+def import_times(module):
+    """Import the module in a fresh interpreter with -X importtime.
+    Returns:
+        dict of imported module name -> cumulative import time in ms.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"Error importing {module}: {result.stderr.strip().splitlines()[-1:]}")
+    times = {}
+    # import time: self [us] | cumulative | imported package
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)', line)
+        if match and len(match.group(3)) <= 3: # the module and its direct imports
+            times[match.group(4)] = int(match.group(2)) / 1000
+    return times
+
+def benchmark_imports(budget=IMPORT_BUDGET_MS, top=5):
+    """Cold import time of the modules against the budget, with their slowest top level imports.
+    Returns:
+        rows, and whether all the modules are within budget.
+    """
+    rows = []
+    for module, budget_ms in budget.items():
+        times = import_times(module)
+        slowest = sorted(((t, name) for name, t in times.items() if name != module), reverse=True)[:top]
+        rows.append({'module': module, 'import_ms': f'{times.get(module, 0):.0f}', 'budget_ms': budget_ms,
+                     'ok': times.get(module, 0) <= budget_ms,
+                     'slowest': ', '.join(f'{name} {t:.0f}' for t, name in slowest)})
+    _print_table(rows)
+    return rows, all(r['ok'] for r in rows)
+
+def _latency_row(mode, sessions, turns, wall_s, latencies):
+    latencies = np.array(latencies) * 1000
+    return {'mode': mode, 'sessions': sessions, 'turns': turns, 'wall_s': f'{wall_s:.2f}',
+            'turns_per_s': f'{turns / wall_s:.1f}', 'p50_ms': f'{np.percentile(latencies, 50):.0f}',
+            'p95_ms': f'{np.percentile(latencies, 95):.0f}'}
+
+def _mock_credentials():
+    """The mock server ignores the API key, but the OpenAI client wants one."""
+    import utils
+    os.environ.setdefault('GENAI_API_KEY', 'mock')
+    utils.GENAI_API_KEY = utils.GENAI_API_KEY or os.environ['GENAI_API_KEY']
+
+def _start_mock_server(mem_path, latency_ms, **kwargs):
+    import memory
+    import mock_openai_server
+    _mock_credentials()
+    m = memory.get_shared(mem_path)
+    manifest = embedder.read_manifest(mem_path)
+    dim = manifest.get('dimensions') or (m.pca.d_in if m.pca is not None else m.embeddings.shape[1])
+    return mock_openai_server.start(latency_ms=latency_ms, embedding_dim=dim, **kwargs)
+
+def benchmark_concurrency(mem_path, sessions=100, turns=2, url=None, latency_ms=500, sync_sessions=5):
+    """Turns per second and turn latency of AsyncChat_Bot serving concurrent sessions from one loaded memory,
+    compared with Chat_Bot answering one conversation at a time, against a mock OpenAI-compatible server.
+    The mock server is started in-process unless the url of one is given."""
+    import utils
+    import embedding_cache
+    from chat_bot import Chat_Bot
+    from async_chat_bot import AsyncChat_Bot
+    # keep the benchmark queries out of the disk cache
+    embedding_cache.QUERY_CACHE_SPILL = False
+    server = None
+    if url is None:
+        server = _start_mock_server(mem_path, latency_ms)
+        url = server.url
+    utils.GENAI_API_URL = url
+
+    def question(session, turn):
+        return f"session {session} question {turn}: which table has the merchant fees?"
+
+    rows = []
+    bot = Chat_Bot(mem_path)
+    latencies = []
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for s in range(sync_sessions):
+            bot.new_chat()
+            for t in range(turns):
+                turn_start = time.perf_counter()
+                bot.chat(question(s, t))
+                latencies.append(time.perf_counter() - turn_start)
+    rows.append(_latency_row('sync', sync_sessions, sync_sessions * turns, time.perf_counter() - start, latencies))
+
+    async_bot = AsyncChat_Bot(mem_path)
+    latencies = []
+    async def conversation(s):
+        for t in range(turns):
+            turn_start = time.perf_counter()
+            await async_bot.achat(question(s, t), session_id=s)
+            latencies.append(time.perf_counter() - turn_start)
+    async def run_all():
+        await asyncio.gather(*(conversation(s) for s in range(sessions)))
+    start = time.perf_counter()
+    asyncio.run(run_all())
+    rows.append(_latency_row('async', sessions, sessions * turns, time.perf_counter() - start, latencies))
+    if server is not None:
+        server.shutdown()
+    _print_table(rows)
+    return rows
+
+def benchmark_prompt_cache(mem_path, sessions=3, turns=4, url=None):
+    """Share of the prompt tokens served from the provider's prompt cache with each prompt layout,
+    over a few conversations. Against the mock server, which simulates prefix caching, unless a url is given."""
+    import utils
+    import embedding_cache
+    import chat_bot
+    embedding_cache.QUERY_CACHE_SPILL = False
+    server = None
+    if url is None:
+        server = _start_mock_server(mem_path, latency_ms=0)
+        url = server.url
+    utils.GENAI_API_URL = url
+    rows = []
+    for layout in chat_bot.PROMPT_LAYOUTS:
+        bot = chat_bot.Chat_Bot(mem_path, prompt_layout=layout)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for s in range(sessions):
+                bot.new_chat()
+                for t in range(turns):
+                    bot.chat(f"{layout} session {s} question {t}: which table has the merchant fees?")
+        totals = bot.prompt_cache_totals
+        rows.append({'layout': layout, 'calls': totals['calls'], 'prompt_tokens': totals['prompt_tokens'],
+                     'cached_tokens': totals['cached_tokens'],
+                     'cached_ratio': f"{totals['cached_tokens'] / max(1, totals['prompt_tokens']):.2f}"})
+    if server is not None:
+        server.shutdown()
+    _print_table(rows)
+    return rows
+
+HISTORY_QUESTION = """Turn {turn}: the merchant has MCC 5812 and postcode 2000. Why does this query return no rows?
+SELECT m.merchant_id, m.trading_name, SUM(t.amount) AS amount FROM dbo.merchant m
+JOIN dbo.transactions t ON t.merchant_id = m.merchant_id
+WHERE m.mcc = 5812 AND m.postcode = 2000 AND t.settlement_date >= DATEADD(month, -1, GETDATE())
+GROUP BY m.merchant_id, m.trading_name ORDER BY amount DESC"""
+# verbose answers, like the SQL explanations of the DARE bot
+HISTORY_ANSWER = ("The query joins dbo.merchant to dbo.transactions on merchant_id and filters on the MCC, "
+                  "the postcode and the last month of settlement dates. ") * 12
+
+
+def benchmark_history(mem_path, turns=30, history_budget=1000, url=None):
+    """Prompt tokens per turn of a long conversation, keeping the last 20 messages as before
+    and with the token budget aware history, against the mock server, answering verbosely, unless a url is given."""
+    import utils
+    import embedding_cache
+    import chat_bot
+    embedding_cache.QUERY_CACHE_SPILL = False
+    server = None
+    if url is None:
+        server = _start_mock_server(mem_path, latency_ms=0, answer=HISTORY_ANSWER)
+        url = server.url
+    utils.GENAI_API_URL = url
+    rows = []
+    for budget in (None, history_budget):
+        bot = chat_bot.Chat_Bot(mem_path, history_budget=budget)
+        prompt_tokens = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for turn in range(turns):
+                bot.chat(HISTORY_QUESTION.format(turn=turn))
+                prompt_tokens.append(bot.prompt_cache_stats['prompt_tokens'])
+            bot.chat_history.wait()
+        last = prompt_tokens[-max(1, turns // 3):]
+        rows.append({'history': 'last 20 messages' if budget is None else f'{budget} tokens',
+                     'turn_1': prompt_tokens[0], f'turn_{turns // 2}': prompt_tokens[turns // 2 - 1],
+                     f'turn_{turns}': prompt_tokens[-1], 'last_third_mean': f'{np.mean(last):.0f}',
+                     'last_third_max': max(last), 'folded_turns': bot.chat_history.folded_turns})
+    if server is not None:
+        server.shutdown()
+    _print_table(rows)
+    return rows
+
+def _timed_calls(name, client_name, n, fn):
+    latencies = []
+    ok = 0
+    for _ in range(n):
+        start = time.perf_counter()
+        try:
+            fn()
+            ok += 1
+        except Exception:
+            pass
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {'call': name, 'client': client_name, 'calls': n, 'ok': ok,
+            'p50_ms': f'{np.percentile(latencies, 50):.0f}', 'p95_ms': f'{np.percentile(latencies, 95):.0f}',
+            'p99_ms': f'{np.percentile(latencies, 99):.0f}', 'max_ms': f'{max(latencies):.0f}'}
+
+def benchmark_resilience(calls=200, error_rate=0.1, rate_limit_rate=0.05, slow_rate=0.05, slow_ms=2000, latency_ms=100):
+    """Success rate and latency of the query embeddings and chat completions against the mock server
+    injecting faults, with the OpenAI client without retries and with llm_client.
+    Then an outage of the endpoint, which llm_client's circuit breaker fails fast."""
+    import utils
+    import llm_client
+    import mock_openai_server
+    _mock_credentials()
+    server = mock_openai_server.start(latency_ms=latency_ms, embedding_dim=256, error_rate=error_rate,
+                                      rate_limit_rate=rate_limit_rate, slow_rate=slow_rate, slow_ms=slow_ms)
+    utils.GENAI_API_URL = server.url
+    raw = utils.client.with_options(max_retries=0)
+    embed = {'input': ['which table has the merchant fees?'], 'model': 'mock-embedding'}
+    chat = {'messages': [{'role': 'user', 'content': 'what is DARE'}], 'model': 'mock-model'}
+    rows = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows.append(_timed_calls('embed_query', 'openai', calls, lambda: raw.embeddings.create(**embed)))
+        rows.append(_timed_calls('embed_query', 'llm_client', calls, lambda: llm_client.embeddings('embed_query', **embed)))
+        rows.append(_timed_calls('chat', 'openai', calls // 4, lambda: raw.chat.completions.create(**chat)))
+        rows.append(_timed_calls('chat', 'llm_client', calls // 4, lambda: llm_client.chat_completion('chat', **chat)))
+        server.error_rate, server.rate_limit_rate, server.slow_rate = 1.0, 0.0, 0.0
+        rows.append(_timed_calls('embed_query outage', 'llm_client', calls // 10,
+                                 lambda: llm_client.embeddings('embed_query', **embed)))
+    server.shutdown()
+    _print_table(rows)
+    print()
+    _print_table([{'endpoint': name, **{k: v for k, v in endpoint.items() if k != 'histogram'}}
+                  for name, endpoint in llm_client.stats().items()])
+    return rows
+
+def _embeddings_from_args(args):
+    if args.mem_path:
+        return load_embeddings(args.mem_path)
+    return synthetic_embeddings(args.synthetic, args.dim)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="db_agent benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    index_parser = subparsers.add_parser('index', help='recall / latency / size of the FAISS index types')
+    source = index_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--mem-path', help='memory directory containing embeddings.npy')
+    source.add_argument('--synthetic', type=int, help='number of synthetic vectors to generate')
+    index_parser.add_argument('--dim', type=int, default=3072)
+    index_parser.add_argument('-k', type=int, default=5)
+    index_parser.add_argument('--queries', type=int, default=100)
+
+    storage_parser = subparsers.add_parser('storage', help='size / load time / latency / recall of the vector storage layouts')
+    source = storage_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--mem-path', help='memory directory containing embeddings.npy')
+    source.add_argument('--synthetic', type=int, help='number of synthetic vectors to generate')
+    storage_parser.add_argument('--dim', type=int, default=3072)
+    storage_parser.add_argument('--reduced-dim', type=int, help='dimensions of the reduced layouts, default dim/4')
+    storage_parser.add_argument('-k', type=int, default=5)
+    storage_parser.add_argument('--queries', type=int, default=100)
+
+    pdf_parser = subparsers.add_parser('pdf', help='serial vs page-parallel vs cached PDF text extraction')
+    pdf_parser.add_argument('--pdf', help='PDF file, a large PDF is generated if not given')
+    pdf_parser.add_argument('--pages', type=int, default=500, help='pages of the generated PDF')
+    pdf_parser.add_argument('--workers', type=int, default=pdf_extract.DEFAULT_WORKERS)
+
+    lexical_parser = subparsers.add_parser('lexical', help='build time / latency of the BM25 index')
+    lexical_parser.add_argument('--mem-path', required=True, help='memory directory containing chunks.txt')
+    lexical_parser.add_argument('--queries', type=int, default=100)
+
+    imports_parser = subparsers.add_parser('imports', help='cold import time of the bot modules against IMPORT_BUDGET_MS')
+    imports_parser.add_argument('--module', action='append', help='module to measure, default all the budgeted ones')
+    imports_parser.add_argument('--budget-ms', type=int, help='budget of the --module modules')
+
+    concurrency_parser = subparsers.add_parser('concurrency', help='async bot serving concurrent sessions vs the sync bot')
+    concurrency_parser.add_argument('--mem-path', required=True, help='memory directory of the bot')
+    concurrency_parser.add_argument('--sessions', type=int, default=100, help='concurrent sessions of the async bot')
+    concurrency_parser.add_argument('--turns', type=int, default=2, help='turns per session')
+    concurrency_parser.add_argument('--sync-sessions', type=int, default=5, help='sessions of the sync bot, one at a time')
+    concurrency_parser.add_argument('--url', help='OpenAI-compatible server, a mock server is started if not given')
+    concurrency_parser.add_argument('--latency-ms', type=int, default=500, help='answer latency of the mock server')
+
+    prompt_cache_parser = subparsers.add_parser('prompt-cache', help='prompt tokens served from the prompt cache per prompt layout')
+    prompt_cache_parser.add_argument('--mem-path', required=True, help='memory directory of the bot')
+    prompt_cache_parser.add_argument('--sessions', type=int, default=3)
+    prompt_cache_parser.add_argument('--turns', type=int, default=4, help='turns per session')
+    prompt_cache_parser.add_argument('--url', help='OpenAI-compatible server, a mock server is started if not given')
+
+    history_parser = subparsers.add_parser('history', help='prompt tokens per turn of a long conversation')
+    history_parser.add_argument('--mem-path', required=True, help='memory directory of the bot')
+    history_parser.add_argument('--turns', type=int, default=30)
+    history_parser.add_argument('--history-budget', type=int, default=1000, help='tokens of the chat history')
+    history_parser.add_argument('--url', help='OpenAI-compatible server, a mock server is started if not given')
+
+    resilience_parser = subparsers.add_parser('resilience', help='retries, hedging and circuit breaking against injected faults')
+    resilience_parser.add_argument('--calls', type=int, default=200)
+    resilience_parser.add_argument('--error-rate', type=float, default=0.1, help='share of the requests failing with 500')
+    resilience_parser.add_argument('--rate-limit-rate', type=float, default=0.05, help='share of the requests failing with 429')
+    resilience_parser.add_argument('--slow-rate', type=float, default=0.05, help='share of the requests answered slowly')
+    resilience_parser.add_argument('--slow-ms', type=int, default=2000, help='extra latency of the slow requests')
+
+    args = parser.parse_args()
+    if args.benchmark == 'index':
+        benchmark_index_types(_embeddings_from_args(args), k=args.k, n_queries=args.queries)
+    elif args.benchmark == 'storage':
+        benchmark_storage(_embeddings_from_args(args), k=args.k, n_queries=args.queries,
+                          reduced_dim=args.reduced_dim)
+    elif args.benchmark == 'pdf':
+        if args.pdf:
+            benchmark_pdf_extraction(args.pdf, args.workers)
+        else:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                generate_pdf(f'{tmp_dir}/generated.pdf', args.pages)
+                benchmark_pdf_extraction(f'{tmp_dir}/generated.pdf', args.workers)
+    elif args.benchmark == 'lexical':
+        benchmark_lexical(args.mem_path, args.queries)
+    elif args.benchmark == 'imports':
+        budget = IMPORT_BUDGET_MS
+        if args.module:
+            budget = {m: args.budget_ms or IMPORT_BUDGET_MS.get(m, max(IMPORT_BUDGET_MS.values())) for m in args.module}
+        _, ok = benchmark_imports(budget)
+        if not ok:
+            sys.exit(1)
+    elif args.benchmark == 'concurrency':
+        benchmark_concurrency(args.mem_path, args.sessions, args.turns, args.url, args.latency_ms, args.sync_sessions)
+    elif args.benchmark == 'prompt-cache':
+        benchmark_prompt_cache(args.mem_path, args.sessions, args.turns, args.url)
+    elif args.benchmark == 'history':
+        benchmark_history(args.mem_path, args.turns, args.history_budget, args.url)
+    elif args.benchmark == 'resilience':
+        benchmark_resilience(args.calls, args.error_rate, args.rate_limit_rate, args.slow_rate, args.slow_ms)
@@ -0,0 +1,120 @@
+"""BM25 inverted index over the chunks of a memory.
+Table names, column names and product codes are matched exactly, which the embeddings often
+miss. The postings are stored as flat numpy arrays (CSR layout) in bm25.npz next to the FAISS index.
+"""
+import os
+import re
+import numpy as np
+
+BM25_FILE = 'bm25.npz'
+K1 = 1.5
+B = 0.75
+IDENTIFIER_QUERY_MAX_TOKENS = 4
+_TOKEN = re.compile(r'[A-Za-z0-9_]+')
+
+def tokenize(text):
+    """Lower-cased word tokens. Snake case identifiers are indexed whole and by their parts,
+    so that both merchant_fee and fee match the column merchant_fee."""
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        tokens.append(token)
+        if '_' in token:
+            tokens += [part for part in token.split('_') if part]
+    return tokens
+
+def looks_like_identifier(word):
+    """True for words like table / column names and product codes: DARE, CSL, dbo.merchant_fee, MCC5411."""
+    word = word.strip('`"\'[]()?,;:')
+    if not word or not re.fullmatch(r'[A-Za-z0-9_.]+', word):
+        return False
+    return '_' in word or '.' in word.strip('.') or any(c.isdigit() for c in word) or \
+        (len(word) >= 2 and word.isupper())
+
+class BM25Index():
+    """Okapi BM25 over a list of chunks, chunk ids being the positions in the list."""
+    def __init__(self, terms, term_offsets, doc_ids, tfs, doc_lens):
+        self.terms = {t: i for i, t in enumerate(terms)}
+        self._terms = terms
+        self.term_offsets = term_offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lens = doc_lens
+        n = len(doc_lens)
+        df = np.diff(term_offsets)
+        self.idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avg_len = doc_lens.mean() if n else 0
+        self._norm = (K1 * (1 - B + B * doc_lens / avg_len)).astype(np.float32) if n else doc_lens
+
+    @classmethod
+    def build(cls, chunks):
+        postings = {}
+        doc_lens = []
+        for doc_id, chunk in enumerate(chunks):
+            tokens = tokenize(chunk)
+            doc_lens.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((doc_id, count))
+        terms = sorted(postings)
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(postings[t]) for t in terms])
+        pairs = np.array([p for t in terms for p in postings[t]], dtype=np.int64).reshape(-1, 2)
+        return cls(terms, term_offsets, pairs[:, 0].astype(np.int32), pairs[:, 1].astype(np.float32),
+                   np.array(doc_lens, dtype=np.float32))
+
+    def save(self, mem_path):
+        path = f'{mem_path}/{BM25_FILE}'
+        # write a temporary file and replace, a running bot may have the old index loaded
+        with open(f'{path}.tmp', 'wb') as f:
+            np.savez(f, terms=np.array(self._terms, dtype=str), term_offsets=self.term_offsets,
+                     doc_ids=self.doc_ids, tfs=self.tfs, doc_lens=self.doc_lens)
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load(cls, mem_path):
+        with np.load(f'{mem_path}/{BM25_FILE}') as data:
+            return cls(data['terms'].tolist(), data['term_offsets'], data['doc_ids'],
+                       data['tfs'], data['doc_lens'])
+
+    def __len__(self):
+        return len(self.doc_lens)
+
+    def has_terms(self, text):
+        """True if every token of the text is in the index."""
+        tokens = tokenize(text)
+        return bool(tokens) and all(t in self.terms for t in tokens)
+
+    def search(self, query, k=5):
+        """Return (scores, chunk ids) of the k best matching chunks, best first.
+        Chunks matching none of the query terms are not returned."""
+        scores = np.zeros(len(self.doc_lens), dtype=np.float32)
+        for token in set(tokenize(query)):
+            term_id = self.terms.get(token)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            doc_ids, tfs = self.doc_ids[start:end], self.tfs[start:end]
+            scores[doc_ids] += self.idf[term_id] * tfs * (K1 + 1) / (tfs + self._norm[doc_ids])
+        matched = np.flatnonzero(scores)
+        top = matched[np.argsort(-scores[matched], kind='stable')[:k]]
+        return scores[top], top
+
+def load_or_build(mem_path, chunks):
+    """Load the BM25 index of the memory, building and saving it for memories created before it existed."""
+    if os.path.exists(f'{mem_path}/{BM25_FILE}'):
+        return BM25Index.load(mem_path)
+    index = BM25Index.build(chunks)
+    try:
+        index.save(mem_path)
+    except OSError as e:
+        print(f"Error saving BM25 index {mem_path}/{BM25_FILE}: {e}")
+    return index
+
+def is_identifier_query(query, indexes):
+    """True if the query is a few identifiers only, all of them known to one of the indexes.
+    Such queries are answered from the lexical index without embedding them."""
+    words = query.split()
+    return 0 < len(words) <= IDENTIFIER_QUERY_MAX_TOKENS and all(looks_like_identifier(w) for w in words) and \
+        any(index.has_terms(query) for index in indexes)
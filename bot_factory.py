@@ -1,6 +1,20 @@
+import os
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
 from chat_bot import Chat_Bot
 import chat_bot
-from langchain_bot import LangChainBot
+import context_packer
+import history
+import memory
+
+BOT_CACHE_MAX_MB = int(os.getenv('BOT_CACHE_MAX_MB', 2048)) # RAM cap of the loaded bots' memories
+
+def LangChainBot(**kwargs):
+    """Create a LangChainBot, importing langchain only when a LangChain bot is used."""
+    from langchain_bot import LangChainBot
+    return LangChainBot(**kwargs)
 
 PRODUCT_RECOM_SYSTEM_PROMPT = """You are a merchant solutions expert specialising in recommending merchant products/services to the user.
     You need to recommend one of the following merchant products to the user:
@@ -56,6 +70,8 @@ class BotFactory:
     """,
             "memory": "./memory/scheme",
             "bot_class": Chat_Bot,
+            # interchange rate tables are long, allow more context
+            "context_budget": 6000,
             "greeting": "Welcome! I'm your Interchange Fee expert. How can I help you today?"
         },
         available_bots[3]: {
@@ -82,12 +98,114 @@ class BotFactory:
         }
     }
 
+    # loaded bots by config key, least recently used first
+    _bots = OrderedDict()
+    _lock = threading.Lock()
+    _key_locks = {} # bots are created outside _lock, one at a time per config
+    max_memory_mb = BOT_CACHE_MAX_MB
+
     @staticmethod
-    def bot(bot=available_bots[0]):
+    def _key(bot):
+        config = BotFactory._config[bot]
+        return (config['bot_class'].__name__, config['memory'],
+                hashlib.sha1(config['system_prompt'].encode('utf-8')).hexdigest(),
+                config.get('context_budget', context_packer.DEFAULT_CONTEXT_BUDGET),
+                config.get('history_budget', history.DEFAULT_HISTORY_BUDGET))
+
+    @staticmethod
+    def _create(bot):
         print("BotFactory: creating ", bot)
         system_prompt = BotFactory._config[bot]['system_prompt']
         memory_path = BotFactory._config[bot]['memory']
         bot_class = BotFactory._config[bot]['bot_class']
-        cb = bot_class(memory_path=memory_path, system_prompt=system_prompt)
+        context_budget = BotFactory._config[bot].get('context_budget', context_packer.DEFAULT_CONTEXT_BUDGET)
+        history_budget = BotFactory._config[bot].get('history_budget', history.DEFAULT_HISTORY_BUDGET)
+        cb = bot_class(memory_path=memory_path, system_prompt=system_prompt, context_budget=context_budget,
+                       history_budget=history_budget)
         return cb
 
+    @staticmethod
+    def bot(bot=available_bots[0]):
+        """Return the bot, creating it on first use. Loaded bots are kept, and share the memories
+        they have in common, until the least recently used ones are evicted to stay under max_memory_mb."""
+        return BotFactory._get(bot, warm_up=False)
+
+    @staticmethod
+    def warm_up(bot):
+        """Load the bot in advance, e.g. on a background thread, as the least recently used bot 
+        so that it does not push out the bots in use. Does nothing when the RAM cap is reached."""
+        with BotFactory._lock:
+            if BotFactory.memory_mb() >= BotFactory.max_memory_mb:
+                return None
+        return BotFactory._get(bot, warm_up=True)
+
+    @staticmethod
+    def _get(bot, warm_up):
+        key = BotFactory._key(bot)
+        with BotFactory._lock:
+            if key in BotFactory._bots:
+                if not warm_up:
+                    BotFactory._bots.move_to_end(key)
+                return BotFactory._bots[key]
+            key_lock = BotFactory._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with BotFactory._lock:
+                if key in BotFactory._bots:
+                    if not warm_up:
+                        BotFactory._bots.move_to_end(key)
+                    return BotFactory._bots[key]
+            cb = BotFactory._create(bot)
+            with BotFactory._lock:
+                BotFactory._bots[key] = cb
+                BotFactory._bots.move_to_end(key, last=not warm_up)
+                BotFactory._evict()
+            return cb
+
+    @staticmethod
+    def _memory_paths(cb):
+        """Memory directories the bot has loaded."""
+        paths = {cb.memory_path}
+        if getattr(cb, 'common', None) is not None:
+            paths.add(cb.common.path)
+        return paths
+
+    @staticmethod
+    def memory_mb():
+        """Estimated RAM of the loaded bots, i.e. the size of their distinct memory files."""
+        paths = {os.path.normcase(os.path.abspath(p)) for cb in BotFactory._bots.values() for p in BotFactory._memory_paths(cb)}
+        return sum(_directory_size(p) for p in paths) / 2**20
+
+    @staticmethod
+    def _evict():
+        # the most recently used bot is never evicted
+        while len(BotFactory._bots) > 1 and BotFactory.memory_mb() > BotFactory.max_memory_mb:
+            key, cb = BotFactory._bots.popitem(last=False)
+            print("BotFactory: evicting ", key[0], key[1])
+            in_use = {p for other in BotFactory._bots.values() for p in BotFactory._memory_paths(other)}
+            for path in BotFactory._memory_paths(cb) - in_use:
+                _release(path)
+
+    @staticmethod
+    def clear():
+        """Drop all the loaded bots and memories."""
+        with BotFactory._lock:
+            for cb in BotFactory._bots.values():
+                for path in BotFactory._memory_paths(cb):
+                    _release(path)
+            BotFactory._bots.clear()
+
+def _release(memory_path):
+    memory.release_shared(memory_path)
+    if 'langchain_bot' in sys.modules:
+        sys.modules['langchain_bot'].release_vectorstore(memory_path)
+
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                pass
+    return size
+
@@ -1,14 +1,25 @@
-import faiss
-import numpy as np
-import json
+import time
+import hashlib
 import utils
-import db_utils
-# from db_utils import DbUtil
+import llm_client
+import tool_registry
+import answer_cache
+import context_packer
+import history
+import memory
+import bm25
 from embedder import Embedder
-import recommend
 
 
 MEMORY_PATH = './memory/dare'
+PINNED_CHUNKS = 3 # number of general domain knowledge chunks always included in the context
+RETRIEVAL_MODES = ('vector', 'lexical', 'hybrid')
+QUERY_VARIANTS = 2 # the prompt, and the prompt following the last user turn
+# 'prefix': the invariant system prompt and pinned chunks first, byte-identical on every turn, so that the
+# provider's prompt cache applies to them. 'legacy': the pinned chunks with the retrieved ones, after the history
+PROMPT_LAYOUTS = ('prefix', 'legacy')
+# answer of a turn whose last round, forced to answer, still calls tools
+TOOL_BUDGET_ANSWER = "Sorry, I could not answer within the tool call budget of this turn. Please narrow down the question."
 SYSTEM_PROMPT = """
     You are a SQL Server expert speicalising in DARE database and SQL queries in T-SQL. 
     Use the provided context as the primary source of information to answer the query. 
@@ -19,7 +30,7 @@ SYSTEM_PROMPT = """
     2. double check the table's descriptions and data structure in the context to match the user's prompt. If not, use a different table.
     3. repeat step 2 for every table to be used.
     4. generate the SQL statement but do not run it yet. 
-    5. Double check in the context whether all the columns used in the SQL statement actually exist in the query tables, if not consider joining with more tables. If the context does not have sufficient information, query the SQL Server databse INFORMATION_SCHEMA.COLUMNS to retrieve all the columns of the table and check, make sure to provide database name in the query - no need to ask user for this query, just run it.
+    5. Double check in the context whether all the columns used in the SQL statement actually exist in the query tables, if not consider joining with more tables. If the context does not have sufficient information, call the get_table_columns tool to retrieve all the columns of the table and check - no need to ask user for this, just call it. Only if the table is not in the schema catalog, query the SQL Server databse INFORMATION_SCHEMA.COLUMNS instead, make sure to provide database name in the query.
     6. repeat step 5 for all columns used in the query.
     7. display the final SQL query to user.
     8. when the user gives the command to execute the query, call the execute_sql tool to run the query and display the results
@@ -31,161 +42,251 @@ SYSTEM_PROMPT = """
     3. when displaying card numbers (also known as Primary Account Numbers or PAN or funding PAN or fPAN), always mask the value by showing the first 6 digits and last 3 digits of the number, and replace the rest of the digits with '...', for example, mask the value of 5152341111234567 into 515234...567. Do not allow any other ways to extract / substring any portion of the card number field.
     """
 
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "get_current_date_time",
-            "description": "Get the current date, time and day of week. It answers the question of today's date, day of week, etc.",
-            "parameters": {
-                "type": "object",
-                "properties": {},
-                "required": []
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "execute_sql",
-            "description": "Execute SQL query on the database and return results",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "The SQL query to execute"
-                    }
-                },
-                "required": ["query"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "recommend_product",
-            "description": "Recommend merchant products based on input criteria",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "cp_cnp": {
-                        "type": "string",
-                        "description": "Whether the product should be CP / Card Present or CNP / Card Not Present / eCommerce"
-                    },
-                    "mis_division": {
-                        "type": "string",
-                        "description": "Which market division the customer belongs. Valid values are RBS, BB, IB&M"
-                    },
-                    "mcc": {
-                        "type": "integer",
-                        "description": "MCC / Merchant Category Code."
-                    },
-                    "postcode": {
-                        "type": "integer",
-                        "description": "Postcode of trading address, must be valid Australian postcode."
-                    },
-                    "revenue": {
-                        "type": "number",
-                        "description": "Monthly net revenue of the merchant."
-                    }
-                },
-                "required": ["cp_cnp", "mis_division", "mcc", "postcode", "revenue"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "recommend_pricing",
-            "description": "Recommend merchant pricing plan",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "product_code": {
-                        "type": "string",
-                        "description": "Merchant product code"
-                    },
-                    "mis_division": {
-                        "type": "string",
-                        "description": "Which market division the customer belongs. Valid values are RBS, BB, IB&M"
-                    },
-                    "mcc": {
-                        "type": "integer",
-                        "description": "MCC / Merchant Category Code."
-                    },
-                    "postcode": {
-                        "type": "integer",
-                        "description": "Postcode of trading address, must be valid Australian postcode."
-                    },
-                    "revenue": {
-                        "type": "number",
-                        "description": "Monthly net revenue of the merchant."
-                    }
-                },
-                "required": ["product_code", "mis_division", "mcc", "postcode", "revenue"]
-            }
-        }
-    }
-]
+# OpenAI schemas of the tools, see tool_registry
+tools = tool_registry.schemas()
 
 class Chat_Bot():
-    def __init__(self, memory_path=MEMORY_PATH, emb_model=None, system_prompt=None):
+    def __init__(self, memory_path=MEMORY_PATH, emb_model=None, system_prompt=None, retrieval='hybrid',
+                 query_variants=QUERY_VARIANTS, use_answer_cache=False,
+                 context_budget=context_packer.DEFAULT_CONTEXT_BUDGET, prompt_layout='prefix',
+                 history_budget=history.DEFAULT_HISTORY_BUDGET):
+        """
+        Args:
+            memory_path (str): memory directory.
+            emb_model (str): embedding model id, defaults to the model of the memory.
+            system_prompt (str): defaults to SYSTEM_PROMPT.
+            retrieval (str): 'vector' | 'lexical' (BM25) | 'hybrid' (both, fused by rank).
+            query_variants (int): max number of queries searched per prompt, see get_queries.
+            use_answer_cache (bool): answer repeated questions from the semantic answer cache, see answer_cache.
+            context_budget (int): max number of tokens of the retrieved chunks in the prompt.
+            prompt_layout (str): 'prefix' | 'legacy', see PROMPT_LAYOUTS.
+            history_budget (int): max number of tokens of the chat history in the prompt, see history.ChatHistory.
+        """
+        assert retrieval in RETRIEVAL_MODES, f"Invalid retrieval mode, must be one of {RETRIEVAL_MODES}"
+        assert prompt_layout in PROMPT_LAYOUTS, f"Invalid prompt layout, must be one of {PROMPT_LAYOUTS}"
+        self.prompt_layout = prompt_layout
+        self._system_message = None
+        self.prompt_cache_stats = None
+        self.prompt_cache_totals = {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0}
         self.system_prompt = system_prompt if system_prompt else SYSTEM_PROMPT
+        self.retrieval = retrieval
+        self.query_variants = query_variants
+        self.retrieval_stats = None
+        self.retrieved_ids = []
+        self.retrieved_scores = []
+        self.context_budget = context_budget
+        self.context_stats = None
+        self.stream_stats = None
+        self.answer_cache = answer_cache.get_answer_cache() if use_answer_cache else None
+        self.bot_key = f"{memory_path}:{hashlib.sha1(self.system_prompt.encode('utf-8')).hexdigest()[:12]}"
         self.memory_path = memory_path
         self.load_memory()
-        self.chat_history = []
-        self.embedder = Embedder(model=emb_model) if emb_model else Embedder()
+        self.history_budget = history_budget
+        self.chat_history = self.new_history()
+        self.embedder = Embedder.from_memory(self.memory_path, model=emb_model)
       
 
     def load_memory(self):
-        self.embeddings = np.load(f'{self.memory_path}/embeddings.npy')
-        with open(f'{self.memory_path}/chunks.txt', 'r', encoding='utf-8') as f:
-            self.chunks = f.read().split('\n===\n')
-        self.indices = faiss.read_index(f'{self.memory_path}/faiss_index.bin')
+        """Open the memory lazily: the index and embeddings are memory-mapped and 
+        chunks are only read from disk when they are retrieved.
+        Memories are shared by the bots and loaded once per process."""
+        self.memory = memory.get_shared(self.memory_path)
+        self.embeddings = self.memory.embeddings
+        self.chunks = self.memory.chunks
+        self.indices = self.memory.index
+        self.metric = self.memory.metric
+        self.common = memory.get_shared(self.memory.common_path) if self.memory.common_path else None
+        if self.common is not None and any(self.common.manifest.get(key) != self.memory.manifest.get(key)
+                                           for key in ('model', 'dimensions', 'metric')):
+            print(f"Common memory {self.memory.common_path} is not compatible with {self.memory_path}, rebuild it.")
+            self.common = None
+        if self.common is not None and self.common.manifest.get('pca_dim') != self.memory.manifest.get('pca_dim'):
+            if self.common.pca is None:
+                # scores are only comparable in the same vector space, the bot's
+                self.common = self.common.with_pca(self.memory.pca)
+            else:
+                print(f"Common memory {self.memory.common_path} has its own PCA, not compatible with {self.memory_path}.")
+                self.common = None
         
-    def search_chunks(self, queries):
-        """queries - list of questions/strings
+    def get_queries(self, prompt, chat_history=None):
+        """The retrieval queries of the prompt: the prompt itself and, for follow-up questions,
+        the prompt following the last user turn, without any extra LLM call.
+        chat_history defaults to the bot's own."""
+        chat_history = self.chat_history if chat_history is None else chat_history
+        queries = [prompt]
+        last_user = next((m['content'] for m in reversed(chat_history) if m['role'] == 'user'), None)
+        if last_user and last_user != prompt:
+            queries.append(f"{last_user}\n{prompt}")
+        return queries[:max(1, self.query_variants)]
+
+    def _memories(self):
+        """The memories searched, the function of the chunks to skip, and the memory of the pinned chunks."""
+        if self.common is None:
+            # memories built with the common files at their start, before the common memory, pin their own
+            # first chunks; the others have no general domain knowledge to pin
+            return [self.memory], None, None if 'common' in self.memory.manifest else self.memory
+        # search the bot's memory and the common memory together, 
+        # the first 3 common chunks are the general domain knowledge, pinned rather than searched
+        return [self.memory, self.common], lambda m, i: m is self.common and i < PINNED_CHUNKS, self.common
+
+    def needs_embedding(self, queries):
+        """False when the queries are searched without vectors: lexical retrieval, or
+        identifier only queries, e.g. table names, answered by the lexical index."""
+        memories, _, _ = self._memories()
+        return self.retrieval == 'vector' or (self.retrieval == 'hybrid' and not all(
+            bm25.is_identifier_query(q, [m.bm25 for m in memories]) for q in queries))
+
+    def retrieve(self, queries, query_embedding=None):
+        """Search the memories without changing the bot, so that concurrent sessions can share it.
+        Args:
+            queries: list of questions/strings, all searched in one batch and their results fused.
+            query_embedding: vectors of the queries as returned by the embedding model, None if not needed.
+        Returns:
+            chunks: the pinned and the retrieved chunks.
+            ids: (memory path, chunk id) of the chunks.
+            scores: relevance of the chunks, None for the pinned ones.
+            query_results: for each query, its own top (memory, chunk_id).
         """
-        # query_embedding = np.array(get_embedding(query)).reshape(1, -1)
-        query_embedding = np.array(self.embedder.embed_chunks(queries))
-        distances, indices = self.indices.search(query_embedding, k=5)  # Retrieve top k relevant chunks
-        
+        memories, skip, pinned = self._memories()
         # first 3 chunks are the general domain knowledge. Always include them.
-        chunks = self.chunks[:3]
-        chunks.extend([self.chunks[i] for i in indices[0]])
+        chunks = pinned.chunks[:PINNED_CHUNKS] if pinned is not None else []
+        results, query_results = memory.hybrid_search(memories, queries, query_embedding, k=5, skip=skip,
+                                                      lexical=self.retrieval != 'vector')
+        chunks.extend([m.chunks[i] for _, m, i in results])
+        ids = [(pinned.path, i) for i in range(len(chunks) - len(results))] + [(m.path, i) for _, m, i in results]
+        scores = [None] * (len(chunks) - len(results)) + [score for score, _, _ in results]
+        return chunks, ids, scores, query_results
+
+    @staticmethod
+    def retrieval_report(queries, ids, scores, query_results, embed_ms, search_ms):
+        """Timings of the retrieval, and the overlap of the results of each query with those of the first."""
+        query_ids = [{(m.path, i) for m, i in r} for r in query_results]
+        fused = {chunk_id for chunk_id, score in zip(ids, scores) if score is not None}
+        return {
+            'queries': len(queries),
+            'embed_ms': embed_ms,
+            'search_ms': search_ms,
+            'ms_per_query': (embed_ms + search_ms) / len(queries),
+            # share of the top results of each variant already found by the first query
+            'overlap': [len(query_ids[0] & r) / max(1, len(r)) for r in query_ids[1:]],
+            # results the variants added to those of the first query
+            'added_by_variants': len(fused - query_ids[0]),
+        }
+
+    def search_chunks(self, queries):
+        """queries - list of questions/strings, all searched in one batch and their results fused.
+        The timings and the overlap of the results of each query with those of the first are 
+        kept in self.retrieval_stats.
+        """
+        start = time.perf_counter()
+        query_embedding = self.embedder.embed_queries(queries, reduce=False) if self.needs_embedding(queries) else None
+        embedded = time.perf_counter()
+        chunks, self.retrieved_ids, self.retrieved_scores, query_results = self.retrieve(queries, query_embedding)
+        searched = time.perf_counter()
+        self.retrieval_stats = Chat_Bot.retrieval_report(queries, self.retrieved_ids, self.retrieved_scores, query_results,
+                                                         (embedded - start) * 1000, (searched - embedded) * 1000)
         return chunks
     
+    def new_history(self):
+        return history.ChatHistory(self.history_budget)
+
     def new_chat(self):
         """start a new chat, i.e. clear chat history."""
-        self.chat_history = []
+        self.chat_history = self.new_history()
     
-    def chat(self, prompt, model=utils.CHAT_MODEL, temperature=0.3):
-        """
-        Args:
-            prompt (str): user prompt or question for the AI bot
-            model (str): LLM model id
-            temperatur (float): ranging from 0.0 to 2.0, the bigger the wilder
+    def _prepare_chat(self, prompt, model):
+        """Retrieve the context of the prompt and build the messages to send.
+        Returns:
+            messages: the messages, None when the answer is cached.
+            answer: the cached answer, None if not cached.
+            cache_key: (context fingerprint, question embedding) to cache the answer, None without answer cache.
         """
-        queries = [prompt]
+        queries = self.get_queries(prompt)
         relevant_chunks = self.search_chunks(queries)
         # print("relevant_chunks: ", relevant_chunks)
+
+        cache_key = None
+        if self.answer_cache is not None:
+            # the answer depends on the retrieved chunks and, for follow-up questions, on the previous question
+            fingerprint = answer_cache.fingerprint(self.retrieved_ids, relevant_chunks, *queries[1:])
+            query_embedding = self.embedder.embed_queries([prompt], reduce=False)[0]
+            cache_key = (fingerprint, query_embedding)
+            answer = self.answer_cache.get(self.bot_key, model, fingerprint, query_embedding)
+            if answer is not None:
+                print("answer cache hit:", self.answer_cache.stats())
+                return None, answer, cache_key
         
-        content = "\n".join(relevant_chunks)
+        # de-duplicated, relevant chunks only, within the token budget
+        content, self.context_stats = self.pack_context(relevant_chunks, self.retrieved_scores, model)
+        print("context:", self.context_stats)
         
-        messages = [{"role": "system", "content": self.system_prompt}]
+        return self.build_messages(prompt, content, self.chat_history), None, cache_key
+
+    def system_message(self):
+        """The system message. In the prefix layout it holds the pinned chunks too, the same bytes
+        on every turn and session of the bot, so that the provider's prompt cache applies to it."""
+        if self.prompt_layout != 'prefix':
+            return self.system_prompt
+        if self._system_message is None:
+            _, _, pinned = self._memories()
+            # without duplicates, in order
+            knowledge = "\n".join(dict.fromkeys(pinned.chunks[:PINNED_CHUNKS])) if pinned is not None else None
+            self._system_message = f"{self.system_prompt}\n\nDomain knowledge:\n{knowledge}" if knowledge \
+                else self.system_prompt
+        return self._system_message
+
+    def pack_context(self, chunks, scores, model):
+        """Pack the chunks into the context of the question, see context_packer.pack.
+        In the prefix layout the pinned chunks are in the system message: they are left out of the
+        context, and still count in the token budget.
+        The scores are rank fusion sums, not similarities, so no chunk is dropped for its relative score:
+        the top k of retrieve already bounds the chunks."""
+        budget = self.context_budget
+        if self.prompt_layout == 'prefix':
+            pinned = [chunk for chunk, score in zip(chunks, scores) if score is None]
+            budget = max(0, budget - context_packer.count_tokens("\n".join(pinned), model))
+            retrieved = [(chunk, score) for chunk, score in zip(chunks, scores) if score is not None and chunk not in pinned]
+            chunks, scores = [chunk for chunk, _ in retrieved], [score for _, score in retrieved]
+        return context_packer.pack(chunks, scores, model, budget, min_relative_score=None)
+
+    def build_messages(self, prompt, content, chat_history):
+        # invariant content first: the tool schemas (sent as tools), the system prompt, then the history
+        messages = [{"role": "system", "content": self.system_message()}]
         
         # Add chat history if available
-        if self.chat_history:
-            messages.extend(self.chat_history)
+        if chat_history:
+            messages.extend(chat_history)
         
         # Add current context and question
         messages.extend([
             {"role": "user", "content": f"Document Excerpt: {content}"},
             {"role": "user", "content": f"Question: {prompt}"}
         ])
+        return messages
+
+    def _finish_chat(self, prompt, model, messages, answer, cache_key):
+        """Cache the answer unless it used tools whose results change, and add it to the chat history."""
+        if self.answer_cache is not None and answer:
+            used_tools = {tool_call['function']['name'] for m in messages for tool_call in m.get('tool_calls', [])}
+            if used_tools & set(answer_cache.NO_CACHE_TOOLS):
+                self.answer_cache.bypass()
+            else:
+                self.answer_cache.put(self.bot_key, model, *cache_key, answer)
+        self._add_to_history(prompt, answer)
+
+    def chat(self, prompt, model=utils.CHAT_MODEL, temperature=0.3):
+        """
+        Args:
+            prompt (str): user prompt or question for the AI bot
+            model (str): LLM model id
+            temperatur (float): ranging from 0.0 to 2.0, the bigger the wilder
+        """
+        messages, answer, cache_key = self._prepare_chat(prompt, model)
+        if answer is not None:
+            self._add_to_history(prompt, answer)
+            return answer
         
-        response = utils.client.chat.completions.create(
+        response = llm_client.chat_completion(
             model=model,
             messages=messages,
             temperature=temperature,
@@ -195,84 +296,190 @@ class Chat_Bot():
         )
 
         # invoke tools
-        follow_up_response = Chat_Bot.process_tool_calls(response, messages, model)
+        usages = [response.usage]
+        follow_up_response = Chat_Bot.process_tool_calls(response, messages, model, usages)
+        print("prompt cache:", self.record_prompt_cache(usages))
             
         print("follow_up_response:", follow_up_response)
         answer = follow_up_response.choices[0].message.content
 
-        # Update chat history
-        self.chat_history.extend([
-            {"role": "user", "content": prompt},
-            {"role": "assistant", "content": answer}
-        ])
-        
-        # Keep only last 10 messages to prevent context from growing too large
-        if len(self.chat_history) > 20:
-            self.chat_history = self.chat_history[-20:]
-
+        self._finish_chat(prompt, model, messages, answer, cache_key)
         return answer #, final_answer
-        
+
+    def chat_stream(self, prompt, model=utils.CHAT_MODEL, temperature=0.3):
+        """Like chat, yielding the answer as it is generated. Tool calls are assembled from the 
+        streamed deltas, run, and the answer streamed on. The whole answer is added to the chat history
+        once the generator is exhausted, and the time to first token is kept in self.stream_stats.
+        Args:
+            prompt (str): user prompt or question for the AI bot
+            model (str): LLM model id
+            temperature (float): ranging from 0.0 to 2.0, the bigger the wilder
+        Yields:
+            str: the next piece of the answer.
+        """
+        start = time.perf_counter()
+        messages, answer, cache_key = self._prepare_chat(prompt, model)
+        if answer is not None:
+            self.stream_stats = {'ttft_ms': (time.perf_counter() - start) * 1000, 'rounds': 0, 'cached': True}
+            yield answer
+            self._add_to_history(prompt, answer)
+            return
+
+        pieces = []
+        usages = []
+        first_token = None
+        rounds = 0
+        while True:
+            rounds += 1
+            stream = llm_client.chat_completion(
+                call_type='chat_stream',
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+                # after MAX_TOOL_ITERATIONS rounds of tool calls the model has to answer
+                tools=tools, tool_choice='auto' if rounds <= tool_registry.MAX_TOOL_ITERATIONS else 'none'
+            )
+            tool_calls = {} # by index, the id and name come first and the arguments in pieces
+            finish_reason = None
+            round_pieces = []
+            for chunk in stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    # the last chunk, without choices
+                    usages.append(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    round_pieces.append(delta.content)
+                    yield delta.content
+                for tool_call in delta.tool_calls or []:
+                    call = tool_calls.setdefault(tool_call.index, {"id": "", "type": "function",
+                                                                   "function": {"name": "", "arguments": ""}})
+                    if tool_call.id:
+                        call["id"] = tool_call.id
+                    if tool_call.function is not None:
+                        call["function"]["name"] += tool_call.function.name or ""
+                        call["function"]["arguments"] += tool_call.function.arguments or ""
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+            pieces += round_pieces
+            if rounds > tool_registry.MAX_TOOL_ITERATIONS and not round_pieces:
+                # the last round still called tools, which are not run
+                print(f"no answer after {tool_registry.MAX_TOOL_ITERATIONS} rounds of tool calls")
+                pieces.append(TOOL_BUDGET_ANSWER)
+                yield TOOL_BUDGET_ANSWER
+            if finish_reason != 'tool_calls' or not tool_calls or rounds > tool_registry.MAX_TOOL_ITERATIONS:
+                break
+            Chat_Bot.add_tool_results([tool_calls[i] for i in sorted(tool_calls)], messages,
+                                      ''.join(round_pieces) or None)
+
+        answer = ''.join(pieces)
+        end = time.perf_counter()
+        self.stream_stats = {'ttft_ms': ((first_token or end) - start) * 1000, 'total_ms': (end - start) * 1000,
+                             'rounds': rounds, 'cached': False}
+        print("stream:", self.stream_stats)
+        print("prompt cache:", self.record_prompt_cache(usages))
+        self._finish_chat(prompt, model, messages, answer, cache_key)
+
     @staticmethod
-    def process_tool_calls(response, messages=[], model=utils.CHAT_MODEL):
-        if response.choices[0].finish_reason != 'tool_calls':
-            print("process_tool_calls returning: finish_reason=", response.choices[0].finish_reason)
-            return response
-        # else
-        # print("tool_calls=", response.choices[0].message.tool_calls)
-        for tool_call in response.choices[0].message.tool_calls:
-            print(f"tool_call id={tool_call.id}")
-            result = Chat_Bot.process_tool_call(tool_call)
-            
-            messages.extend([
-                {"role": "assistant", "content": str(result), "tool_calls": [{"id": tool_call.id, "type": "function", "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments}}]},
-                {"role": "tool", "tool_call_id": tool_call.id, "content": str(result)}
-            ])
+    def prompt_cache_report(usages):
+        """Prompt tokens of the completions of a turn, and how many the provider served from its prompt cache."""
+        usages = [usage for usage in usages if usage is not None]
+        prompt_tokens = sum(usage.prompt_tokens or 0 for usage in usages)
+        cached_tokens = sum(getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None) or 0
+                            for usage in usages)
+        return {'calls': len(usages), 'prompt_tokens': prompt_tokens, 'cached_tokens': cached_tokens,
+                'uncached_tokens': prompt_tokens - cached_tokens,
+                'cached_ratio': cached_tokens / prompt_tokens if prompt_tokens else 0.0}
 
-        # print("messages=", messages)
-        response = utils.client.chat.completions.create(
-            model=model,
-            messages=messages,
-            tools=tools, tool_choice='auto',
-            stream=False
-        )
-        # print("tool_calls_response:", response)
-        
-        return Chat_Bot.process_tool_calls(response, messages, model)
-        # return response
+    def record_prompt_cache(self, usages, session=None):
+        """Keep the prompt cache report of the turn in prompt_cache_stats, of the session if given,
+        and add it to the bot's totals."""
+        report = Chat_Bot.prompt_cache_report(usages)
+        for key in self.prompt_cache_totals:
+            self.prompt_cache_totals[key] += report[key]
+        (session or self).prompt_cache_stats = report
+        return report
+
+    def _add_to_history(self, prompt, answer, chat_history=None):
+        # Update chat history, the bot's own by default
+        chat_history = self.chat_history if chat_history is None else chat_history
+        # older turns are folded into a summary in the background, within the history budget
+        chat_history.add(prompt, answer)
+        print("history:", chat_history.stats())
         
+    @staticmethod
+    def process_tool_calls(response, messages=[], model=utils.CHAT_MODEL, usages=None):
+        """Run the tool calls of the response and send their results back until the model answers,
+        for at most MAX_TOOL_ITERATIONS rounds. The tool calls of a response run concurrently.
+        The tool calls of the last round, forced to answer, are not run, see final_response.
+        The usage of each completion is appended to usages, if given."""
+        for iteration in range(tool_registry.MAX_TOOL_ITERATIONS):
+            if response.choices[0].finish_reason != 'tool_calls':
+                print("process_tool_calls returning: finish_reason=", response.choices[0].finish_reason)
+                return response
+            # print("tool_calls=", response.choices[0].message.tool_calls)
+            message = response.choices[0].message
+            Chat_Bot.add_tool_results(Chat_Bot.tool_call_dicts(message), messages, message.content)
+
+            # print("messages=", messages)
+            response = llm_client.chat_completion(
+                model=model,
+                messages=messages,
+                # the last round must answer without calling more tools
+                tools=tools, tool_choice='auto' if iteration < tool_registry.MAX_TOOL_ITERATIONS - 1 else 'none',
+                stream=False
+            )
+            if usages is not None:
+                usages.append(response.usage)
+            # print("tool_calls_response:", response)
+        return Chat_Bot.final_response(response)
+
+    @staticmethod
+    def final_response(response):
+        """The response of the last round: its text, or TOOL_BUDGET_ANSWER when the model
+        still called tools instead of answering."""
+        message = response.choices[0].message
+        if response.choices[0].finish_reason == 'tool_calls' or not message.content:
+            print(f"no answer after {tool_registry.MAX_TOOL_ITERATIONS} rounds of tool calls, finish_reason=",
+                  response.choices[0].finish_reason)
+            message.content = message.content or TOOL_BUDGET_ANSWER
+        return response
+
+    @staticmethod
+    def add_tool_results(tool_calls, messages, content=None):
+        """Run the tool calls of one response concurrently, given as API message dicts, and append 
+        the assistant message with the calls and one tool message per result to the messages."""
+        for tool_call in tool_calls:
+            print(f"tool_call id={tool_call['id']} {tool_call['function']['name']}")
+        Chat_Bot.append_tool_results(tool_calls, tool_registry.call_many(tool_calls), messages, content)
+
+    @staticmethod
+    def tool_call_dicts(message):
+        """The tool calls of a response message as API message dicts."""
+        return [{"id": tool_call.id, "type": "function",
+                 "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments}}
+                for tool_call in message.tool_calls]
+
+    @staticmethod
+    def append_tool_results(tool_calls, results, messages, content=None):
+        """Append the assistant message with the tool calls and one tool message per result to the messages."""
+        messages.append({"role": "assistant", "content": content, "tool_calls": tool_calls})
+        messages.extend({"role": "tool", "tool_call_id": tool_call['id'], "content": str(result)}
+                        for tool_call, result in zip(tool_calls, results))
 
     @staticmethod
     def process_tool_call(tool_call):
         # print("process_tool_call:", tool_call)
-        function_name = tool_call.function.name
-        arguments = json.loads(tool_call.function.arguments)
-        # print(f"function name: {function_name}, arguments: {arguments}")
-        
-        # Call the appropriate function
-        if function_name == "execute_sql":
-            result = db_utils.execute_sql(arguments["query"])
-            print("query result: ", result)
-            return f"query result: {result}"
-        elif function_name == "get_current_date_time":
-            result = utils.print_now()
-            return result
-        elif function_name == "recommend_product":
-            result = recommend.recommend_product(arguments["cp_cnp"],
-                                                 arguments["mis_division"], 
-                                                 arguments["mcc"], 
-                                                 arguments["postcode"], 
-                                                 arguments["revenue"] )
-            print("recommended product: ", result)
-            return f"recommended products (from high to low priority): {result}"
-        elif function_name == "recommend_pricing":
-            result = recommend.recommend_pricing(arguments["product_code"], 
-                                                 arguments["mis_division"], 
-                                                 arguments["mcc"], 
-                                                 arguments["postcode"], 
-                                                 arguments["revenue"])
-            print("recommended pricing: ", result)
-            return f"recommended pricing plan: {result}"
-        return None
+        return Chat_Bot.call_tool(tool_call.function.name, tool_call.function.arguments)
+
+    @staticmethod
+    def call_tool(function_name, arguments):
+        """Call the tool function with its JSON arguments, see tool_registry."""
+        return tool_registry.call(function_name, arguments)
 
 
 
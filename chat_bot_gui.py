@@ -1,3 +1,7 @@
+import time
+STARTUP_START = time.perf_counter() # before the imports, which are part of the startup time
+import os
+import json
 import customtkinter as ctk
 import markdown2
 from bot_factory import BotFactory
@@ -6,9 +10,14 @@ from tkinter import ttk
 import threading
 import utils
 
+WARM_UP_OTHER_BOTS = True # load the other bots in the background after the selected one
+STARTUP_LOG = './memory/startup_times.jsonl'
+
 class ChatBotGUI:
     def __init__(self):
-        self.bot = BotFactory.bot()
+        # the bot is loaded in the background, the send button is enabled when it is ready
+        self.bot = None
+        self.startup_times = {'init_ms': (time.perf_counter() - STARTUP_START) * 1000}
         
         # Initialize history navigation index
         self.history_index = -1
@@ -80,15 +89,10 @@ class ChatBotGUI:
         model_label = ctk.CTkLabel(controls_frame, text="Model:")
         model_label.grid(row=0, column=2, padx=(20, 10))
         
-        # Get available models
-        try:
-            models = [model['id'] for model in utils.get_available_models()]
-        except Exception as e:
-            models = [utils.CHAT_MODEL]  # Fallback to default model
-            
+        # The available models are loaded in the background
         self.model_combo = ctk.CTkComboBox(
             controls_frame,
-            values=models,
+            values=[utils.CHAT_MODEL],
             width=250
         )
         self.model_combo.set(utils.CHAT_MODEL)  # Set default model
@@ -149,6 +153,70 @@ class ChatBotGUI:
         # Welcome message
         self.display_bot_message("Welcome! I'm your DARE database assistant. How can I help you today?")
 
+        # Warm up in the background while the window renders
+        self.gate_input(f"Loading {self.bot_combo.get()}...")
+        threading.Thread(target=self.load_bot, args=(self.bot_combo.get(), False, WARM_UP_OTHER_BOTS), daemon=True).start()
+        threading.Thread(target=self.load_models, daemon=True).start()
+        self.window.after(0, self.on_window_shown)
+
+    def on_window_shown(self):
+        self.startup_times['window_ms'] = (time.perf_counter() - STARTUP_START) * 1000
+        print(f"startup: window shown in {self.startup_times['window_ms']:.0f} ms")
+
+    def load_models(self):
+        """Load the available models (cached on disk) on a background thread"""
+        start = time.perf_counter()
+        try:
+            models = [model['id'] for model in utils.get_available_models_cached()]
+        except Exception as e:
+            print(f"Error getting models: {e}")
+            return
+        self.startup_times['models_ms'] = (time.perf_counter() - start) * 1000
+        self.window.after(0, lambda: self.model_combo.configure(values=models))
+
+    def load_bot(self, choice, clear, warm_up=False):
+        """Load the bot on a background thread, then, at startup (warm_up), the other bots"""
+        try:
+            bot = BotFactory.bot(choice)
+            self.window.after(0, self.on_bot_ready, choice, bot, clear)
+        except Exception as e:
+            self.window.after(0, self.handle_error, str(e))
+            return
+        if warm_up:
+            for name in BotFactory.available_bots:
+                try:
+                    BotFactory.warm_up(name)
+                except Exception as e:
+                    print(f"Error warming up {name}: {e}")
+
+    def on_bot_ready(self, choice, bot, clear):
+        """Switch to the loaded bot if it is still the selected one"""
+        if choice != self.bot_combo.get():
+            return
+        self.bot = bot
+        if clear:
+            self.clear_history()
+        self.enable_input()
+        if 'bot_ready_ms' not in self.startup_times:
+            self.startup_times['bot_ready_ms'] = (time.perf_counter() - STARTUP_START) * 1000
+            print(f"startup: {choice} ready in {self.startup_times['bot_ready_ms']:.0f} ms")
+            self.log_startup_times()
+
+    def log_startup_times(self):
+        """Append the startup times to STARTUP_LOG to track regressions"""
+        try:
+            os.makedirs(os.path.dirname(STARTUP_LOG), exist_ok=True)
+            with open(STARTUP_LOG, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'time': time.time(), **self.startup_times}) + '\n')
+        except OSError as e:
+            print(f"Error saving startup times: {e}")
+
+    def gate_input(self, text):
+        """Disable the send button until the selected bot is ready, typing is still allowed"""
+        self.bot = None
+        self.send_button.configure(state="disabled")
+        self.loading_label.configure(text=text)
+
     def handle_return(self, event):
         """Handle Enter key press"""
         if not event.state & 0x1:  # Shift is not pressed
@@ -230,7 +298,40 @@ class ChatBotGUI:
         self.chat_display.configure(state='normal')  # Temporarily enable for inserting text
         self.chat_display.insert(tk.END, "Bot: ", "bot")
         self.chat_display.insert(tk.END, " ", "bot_bubble")  # Start bubble
-        
+        self.insert_markdown(message)
+        self.chat_display.insert(tk.END, '\n')
+        self.chat_display.see(tk.END)
+        self.chat_display.configure(state='disabled')  # Disable again after inserting
+
+    def start_bot_message(self):
+        """Start a streamed bot message, its text is appended as it arrives"""
+        self.loading_label.configure(text="")
+        self.chat_display.configure(state='normal')
+        self.chat_display.insert(tk.END, "Bot: ", "bot")
+        self.chat_display.insert(tk.END, " ", "bot_bubble")
+        # the streamed text goes after this mark, and is replaced by its markdown rendering at the end
+        self.chat_display.mark_set("stream_start", "end-1c")
+        self.chat_display.mark_gravity("stream_start", tk.LEFT)
+        self.chat_display.configure(state='disabled')
+
+    def append_bot_message(self, text):
+        """Append streamed text to the bot message as plain text"""
+        self.chat_display.configure(state='normal')
+        self.chat_display.insert(tk.END, text, "bot_bubble")
+        self.chat_display.see(tk.END)
+        self.chat_display.configure(state='disabled')
+
+    def end_bot_message(self, message):
+        """Replace the streamed text with the markdown rendering of the whole message"""
+        self.chat_display.configure(state='normal')
+        self.chat_display.delete("stream_start", "end-1c")
+        self.insert_markdown(message)
+        self.chat_display.insert(tk.END, '\n')
+        self.chat_display.see(tk.END)
+        self.chat_display.configure(state='disabled')
+
+    def insert_markdown(self, message):
+        """Insert the message at the end of the chat with basic markdown formatting"""
         # Configure tags for markdown elements
         self.chat_display.tag_configure("code", background="#e3f2fd", foreground="#d32f2f", font=("Consolas", 10))
         self.chat_display.tag_configure("bold", background="#e3f2fd", font=("Consolas", 11, "bold"))
@@ -281,10 +382,6 @@ class ChatBotGUI:
                                 else:
                                     self.chat_display.insert(tk.END, subpart, "bot_bubble")
                     self.chat_display.insert(tk.END, '\n', "bot_bubble")
-        
-        self.chat_display.insert(tk.END, '\n')
-        self.chat_display.see(tk.END)
-        self.chat_display.configure(state='disabled')  # Disable again after inserting
 
     def update_temp_label(self, value):
         """Update temperature value label"""
@@ -293,7 +390,7 @@ class ChatBotGUI:
     def send_message(self):
         """Send message and get response"""
         message = self.input_field.get("1.0", tk.END).strip()
-        if not message:
+        if not message or self.bot is None:
             return
         
         # Reset history navigation index when sending a new message
@@ -312,21 +409,33 @@ class ChatBotGUI:
         
         # Get response in a separate thread with current temperature
         temperature = float(self.temp_slider.get())
-        threading.Thread(target=self.get_response, args=(message, temperature), daemon=True).start()
+        threading.Thread(target=self.get_response, args=(self.bot, message, temperature), daemon=True).start()
 
-    def get_response(self, message, temperature):
-        """Get response from the chat bot"""
+    def get_response(self, bot, message, temperature):
+        """Get response from the chat bot, displaying it as it is streamed.
+        bot is the bot the message was sent to, the selected bot may change meanwhile."""
+        pieces = []
         try:
             model = self.model_combo.get()
-            response = self.bot.chat(message, model=model, temperature=temperature)
-            
-            # Update GUI in the main thread
-            self.window.after(0, self.handle_response, response)
+            for piece in bot.chat_stream(message, model=model, temperature=temperature):
+                # Update GUI in the main thread
+                if not pieces:
+                    self.window.after(0, self.start_bot_message)
+                pieces.append(piece)
+                self.window.after(0, self.append_bot_message, piece)
+            # the streamed text of LangChainBot includes its tool calling rounds, its answer replaces it
+            answer = getattr(bot, 'last_answer', None) or ''.join(pieces)
+            if pieces:
+                self.window.after(0, self.end_bot_message, answer)
+            else:
+                self.window.after(0, self.handle_response, answer)
         except Exception as e:
+            if pieces:
+                self.window.after(0, self.end_bot_message, ''.join(pieces))
             self.window.after(0, self.handle_error, str(e))
         finally:
-            # Re-enable input
-            self.window.after(0, self.enable_input)
+            # Re-enable input, unless another bot was selected and is still loading
+            self.window.after(0, self.enable_input_for, bot)
 
     def handle_response(self, response):
         """Handle bot response"""
@@ -336,6 +445,11 @@ class ChatBotGUI:
         """Handle error in chat"""
         self.display_bot_message(f"Error: {error_message}")
 
+    def enable_input_for(self, bot):
+        """Re-enable input if the bot is still the selected one, see gate_input"""
+        if self.bot is bot:
+            self.enable_input()
+
     def enable_input(self):
         """Re-enable input field and button"""
         self.input_field.configure(state="normal")
@@ -343,9 +457,9 @@ class ChatBotGUI:
         self.loading_label.configure(text="")
 
     def on_bot_change(self, choice):
-        """Handle bot type change"""
-        self.bot = BotFactory.bot(choice)
-        self.clear_history()
+        """Handle bot type change, loading the bot in the background. The other bots were warmed up at startup."""
+        self.gate_input(f"Loading {choice}...")
+        threading.Thread(target=self.load_bot, args=(choice, True), daemon=True).start()
 
     def clear_history(self):
         """Clear chat history and display"""
@@ -357,7 +471,8 @@ class ChatBotGUI:
         # Create new bot instance with same type to clear history
         current_bot = self.bot_combo.get()
         # self.bot = BotFactory.bot(current_bot)
-        self.bot.new_chat()
+        if self.bot is not None:
+            self.bot.new_chat()
         
         # Reset history navigation index
         self.history_index = -1
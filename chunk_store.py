@@ -0,0 +1,78 @@
+import os
+import mmap
+import numpy as np
+
+CHUNKS_FILE = 'chunks.txt'
+OFFSETS_FILE = 'chunks_offsets.npy'
+SEPARATOR = '\n===\n'
+
+def _offsets(data):
+    """[start, end) byte offsets of the chunks in the SEPARATOR joined chunks bytes."""
+    sep = SEPARATOR.encode('utf-8')
+    offsets = []
+    start = 0
+    while True:
+        end = data.find(sep, start)
+        if end < 0:
+            offsets.append((start, len(data)))
+            break
+        offsets.append((start, end))
+        start = end + len(sep)
+    return np.array(offsets, dtype=np.int64).reshape(-1, 2)
+
+def _write_atomic(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        if isinstance(data, np.ndarray):
+            np.save(f, data)
+        else:
+            f.write(data)
+    # replace rather than overwrite, a running bot may have the old file mapped
+    os.replace(tmp_path, path)
+
+def write_chunks(mem_path, chunks):
+    """Save the chunks into chunks.txt together with the byte offsets of every chunk.
+    The offsets are replaced first: a store opened in between finds that they do not end where
+    chunks.txt ends, and indexes the old chunks.txt itself, see ChunkStore."""
+    data = SEPARATOR.join(chunks).encode('utf-8')
+    _write_atomic(f'{mem_path}/{OFFSETS_FILE}', _offsets(data))
+    _write_atomic(f'{mem_path}/{CHUNKS_FILE}', data)
+
+class ChunkStore():
+    """Read-only list-like view of the chunks of a memory directory.
+    chunks.txt is memory-mapped and only the chunks which are accessed are decoded,
+    so opening the store costs the same regardless of the memory size.
+    """
+    def __init__(self, mem_path):
+        self.path = f'{mem_path}/{CHUNKS_FILE}'
+        offsets_path = f'{mem_path}/{OFFSETS_FILE}'
+        with open(self.path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.path) else b''
+        self.offsets = np.load(offsets_path, mmap_mode='r') if os.path.exists(offsets_path) else None
+        if self.offsets is not None and (len(self.offsets) == 0 or self.offsets[-1][1] != len(self._data)):
+            # the offsets of another chunks.txt, being replaced by write_chunks
+            print(f"chunk offsets {offsets_path} do not match {self.path}, indexing it")
+            self.offsets = _offsets(self._data)
+        elif self.offsets is None:
+            # memory created before the offsets were stored, index it once
+            self.offsets = _offsets(self._data)
+            try:
+                _write_atomic(offsets_path, self.offsets)
+            except OSError as e:
+                print(f"Error saving chunk offsets {offsets_path}: {e}")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        start, end = self.offsets[i]
+        return self._data[start:end].decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
@@ -0,0 +1,115 @@
+"""Token budget aware packing of the retrieved chunks into the prompt context.
+Chunks are de-duplicated, the ones scoring far below the best are dropped, and the rest are
+added by relevance until the token budget is used up. Tokens are counted with the tokenizer of
+the chat model (tiktoken), or estimated from the text length when it is not available.
+"""
+import threading
+import dedup
+
+DEFAULT_CONTEXT_BUDGET = 4000 # tokens
+MIN_RELATIVE_SCORE = 0.5 # chunks scoring below this fraction of the best score are dropped
+MIN_TRUNCATED_TOKENS = 200 # a chunk which does not fit is truncated only if this many tokens are left
+CHARS_PER_TOKEN = 4 # estimate when no tokenizer is available
+DEFAULT_ENCODING = 'o200k_base'
+
+class _EstimatingTokenizer():
+    """Stand-in for a tiktoken encoding, estimating CHARS_PER_TOKEN characters per token."""
+    def count(self, text):
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+    def truncate(self, text, max_tokens):
+        return text[:max_tokens * CHARS_PER_TOKEN]
+
+class _TiktokenTokenizer():
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text, max_tokens):
+        return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max_tokens])
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+def _load_encoding(model):
+    import tiktoken
+    # deployment names carry a version suffix, e.g. gpt-4.1_v2025-04-14_GLOBAL
+    base_model = model.split('_')[0]
+    try:
+        return tiktoken.encoding_for_model(base_model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+def get_tokenizer(model):
+    """Return the tokenizer of the model, with count(text) and truncate(text, max_tokens)."""
+    with _tokenizers_lock:
+        if model not in _tokenizers:
+            try:
+                tokenizer = _TiktokenTokenizer(_load_encoding(model))
+            except Exception as e:
+                # tiktoken is optional, and downloads its encodings on first use which may not be allowed
+                print(f"Error loading the tokenizer of {model}, estimating token counts: {e}")
+                tokenizer = _EstimatingTokenizer()
+            _tokenizers[model] = tokenizer
+        return _tokenizers[model]
+
+def count_tokens(text, model):
+    return get_tokenizer(model).count(text)
+
+def pack(chunks, scores, model, budget=DEFAULT_CONTEXT_BUDGET, separator="\n",
+         min_relative_score=MIN_RELATIVE_SCORE):
+    """Pack the chunks into a context of at most budget tokens.
+    Args:
+        chunks: list of chunk texts.
+        scores: relevance score of each chunk, the higher the better, None for pinned chunks
+            which are always put first.
+        model (str): chat model whose tokenizer counts the tokens.
+        budget (int): max number of tokens of the context.
+        separator (str): joins the chunks.
+        min_relative_score (float): chunks scoring below this fraction of the best score are dropped,
+            None to keep them all. Only meaningful for similarity scores: the reciprocal rank fusion
+            sum of a chunk found by all the rankings is several times that of a chunk found by one.
+    Returns:
+        context: the packed chunks joined with separator.
+        report: dict of chunk counts and tokens before / after packing.
+    """
+    tokenizer = get_tokenizer(model)
+    report = {'chunks': len(chunks), 'duplicates': 0, 'low_score': 0, 'over_budget': 0, 'truncated': 0}
+    duplicate_index = dedup.DuplicateIndex()
+    candidates = []
+    for i, (chunk, score) in enumerate(zip(chunks, scores)):
+        if duplicate_index.add_if_new(i, chunk) is not None:
+            report['duplicates'] += 1
+        else:
+            candidates.append((chunk, score))
+
+    best = max((score for _, score in candidates if score is not None), default=None)
+    if min_relative_score is not None and best is not None and best > 0:
+        kept = [(chunk, score) for chunk, score in candidates if score is None or score >= min_relative_score * best]
+        report['low_score'] = len(candidates) - len(kept)
+        candidates = kept
+    # pinned chunks first, then the most relevant first
+    candidates.sort(key=lambda c: float('inf') if c[1] is None else c[1], reverse=True)
+
+    packed = []
+    used = 0
+    separator_tokens = tokenizer.count(separator)
+    for chunk, _ in candidates:
+        tokens = tokenizer.count(chunk) + (separator_tokens if packed else 0)
+        if used + tokens <= budget:
+            packed.append(chunk)
+            used += tokens
+        elif budget - used >= MIN_TRUNCATED_TOKENS:
+            packed.append(tokenizer.truncate(chunk, budget - used - separator_tokens))
+            used = budget
+            report['truncated'] += 1
+        else:
+            report['over_budget'] += 1
+
+    context = separator.join(packed)
+    report['tokens_in'] = tokenizer.count(separator.join(chunks))
+    report['tokens_out'] = tokenizer.count(context)
+    report['tokens_saved'] = report['tokens_in'] - report['tokens_out']
+    return context, report
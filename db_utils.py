@@ -1,5 +1,7 @@
-import pyodbc
-import pandas as pd
+import utils
+
+pyodbc = utils.lazy_import('pyodbc')
+pd = utils.lazy_import('pandas')
 
 # Define connection parameters
 server = 'daredb.cba'  
@@ -0,0 +1,88 @@
+"""Exact and near-duplicate detection of chunks.
+Exact duplicates are found by hashing the normalised text. Near duplicates are found with
+64 bit SimHash fingerprints over word shingles: two chunks are near duplicates when their
+fingerprints differ in at most max_distance bits.
+"""
+import re
+import hashlib
+import numpy as np
+
+SHINGLE_SIZE = 3
+DEFAULT_MAX_DISTANCE = 3
+_BITS = 64
+
+def normalise(text):
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def simhash(text, shingle_size=SHINGLE_SIZE):
+    """64 bit SimHash fingerprint of the text over its word shingles."""
+    words = normalise(text).split(' ')
+    shingles = [' '.join(words[i:i+shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))]
+    hashes = np.array([_hash64(s) for s in shingles], dtype=np.uint64)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    # each bit of the fingerprint is the majority vote of that bit over the shingle hashes
+    votes = bits.sum(axis=0) * 2 > len(hashes)
+    return int(np.packbits(votes, bitorder='little').view(np.uint64)[0])
+
+class DuplicateIndex():
+    """Index of chunk fingerprints answering 'is this chunk a duplicate of an indexed chunk?'.
+    The fingerprints are split into max_distance+1 bands, any two fingerprints within
+    max_distance bits agree on at least one band, so only chunks sharing a band are compared.
+    """
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._exact = {}
+        self._bands = [{} for _ in range(max_distance + 1)]
+        self._band_bits = _BITS // (max_distance + 1)
+        self.stats = {'chunks': 0, 'exact': 0, 'near': 0}
+
+    def _band_keys(self, fingerprint):
+        mask = (1 << self._band_bits) - 1
+        return [fingerprint >> (i * self._band_bits) & mask for i in range(len(self._bands))]
+
+    def _fingerprints(self, text):
+        normalised = normalise(text)
+        exact = hashlib.sha1(normalised.encode('utf-8')).hexdigest()
+        return exact, simhash(normalised) if self.max_distance > 0 else None
+
+    def _find(self, exact, fingerprint):
+        exact_id = self._exact.get(exact)
+        if exact_id is not None:
+            return exact_id, 'exact'
+        if fingerprint is None:
+            return None
+        for band, key in zip(self._bands, self._band_keys(fingerprint)):
+            for other, chunk_id in band.get(key, []):
+                if bin(fingerprint ^ other).count('1') <= self.max_distance:
+                    return chunk_id, 'near'
+        return None
+
+    def _add(self, chunk_id, exact, fingerprint):
+        self._exact[exact] = chunk_id
+        if fingerprint is not None:
+            for band, key in zip(self._bands, self._band_keys(fingerprint)):
+                band.setdefault(key, []).append((fingerprint, chunk_id))
+
+    def find(self, text):
+        """Return (id, 'exact' | 'near') of an indexed duplicate of the text, or None."""
+        return self._find(*self._fingerprints(text))
+
+    def add(self, chunk_id, text):
+        self._add(chunk_id, *self._fingerprints(text))
+
+    def add_if_new(self, chunk_id, text):
+        """Index the text unless it duplicates an indexed chunk.
+        Returns:
+            None if the text was added, otherwise the id of the chunk it duplicates.
+        """
+        self.stats['chunks'] += 1
+        fingerprints = self._fingerprints(text)
+        found = self._find(*fingerprints)
+        if found is None:
+            self._add(chunk_id, *fingerprints)
+            return None
+        self.stats[found[1]] += 1
+        return found[0]
@@ -1,24 +1,212 @@
 import os
-import openai
-import fitz
-import faiss
+import json
+import functools
 import numpy as np
 from pathlib import Path
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-# from langchain_text_splitters import CharacterTextSplitter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import utils
-from utils import client
+import llm_client
+import embedding_cache
+import chunk_store
+import ingest
+import dedup
+import bm25
+
+faiss = utils.lazy_import('faiss')
 
 DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_EMB_MODEL = 'text-embedding-3-large_v1'
 MEMORY_PATH = './memory'
+COMMON_INPUT_PATH = './input/summary'
+# the common memory is chunked the same way whatever the settings of the memory embedding it,
+# so that building memories of other chunk sizes or dedup does not rebuild it
+COMMON_CHUNK_SIZE = DEFAULT_CHUNK_SIZE
+COMMON_DEDUP = False
+COMMON_MEMORY_PATH = './memory/common' # memory of the common files, shared by the bot memories of the same settings
+MANIFEST_FILE = 'manifest.json'
+PCA_FILE = 'pca.bin'
+SQ_PARAMS_FILE = 'sq_params.npy'
+EMBED_BATCH_SIZE = 96
+EMBED_MAX_WORKERS = 4
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'ivfpq')
+METRICS = ('l2', 'ip')
+DTYPES = ('float32', 'float16', 'int8')
+# FAISS storage of the vectors for each dtype
+_CODECS = {'float32': 'Flat', 'float16': 'SQfp16', 'int8': 'SQ8'}
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+MIN_TRAIN_SIZE = 256 # fewer vectors than this cannot train an IVF / PQ index
+
+def common_memory_path(model=DEFAULT_EMB_MODEL, dimensions=None, metric='l2'):
+    """The common memory of the embedding settings: memories are searched together with a common
+    memory of the same vector space, the default settings keep COMMON_MEMORY_PATH."""
+    if (model, dimensions, metric) == (DEFAULT_EMB_MODEL, None, 'l2'):
+        return COMMON_MEMORY_PATH
+    return f"{COMMON_MEMORY_PATH}_{model}_{dimensions or 'full'}_{metric}"
+
+def read_manifest(mem_path):
+    """Return the manifest of the memory directory, or an empty dict for memories
+    created before the manifest was introduced."""
+    manifest_path = f'{mem_path}/{MANIFEST_FILE}'
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def encode_vectors(vectors, dtype='float32', sq_params=None):
+    """Convert float vectors into their storage dtype.
+    int8 is scalar quantized per dimension into 256 levels between the min and max of the dimension.
+    Args:
+        vectors: matrix of float vectors.
+        dtype (str): 'float32' | 'float16' | 'int8'
+        sq_params: (2, dim) array of per dimension [min, step] of the int8 quantizer, fitted on vectors if None.
+    Returns:
+        stored: the vectors in the storage dtype
+        sq_params: the int8 quantizer parameters, None for the other dtypes
+    """
+    assert dtype in DTYPES, f"Invalid dtype, must be one of {DTYPES}"
+    if dtype != 'int8':
+        return np.asarray(vectors, dtype=dtype), None
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if sq_params is None:
+        vmin = vectors.min(axis=0)
+        step = (vectors.max(axis=0) - vmin) / 255
+        sq_params = np.stack([vmin, np.where(step > 0, step, 1)]).astype(np.float32)
+    vmin, step = sq_params
+    codes = np.clip(np.rint((vectors - vmin) / step) - 128, -128, 127).astype(np.int8)
+    return codes, sq_params
+
+def quantizer_fits(vectors, sq_params):
+    """True if the vectors are within the range of the int8 quantizer, i.e. encoded without clipping."""
+    vmin, step = sq_params
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return bool(np.all(vectors >= vmin) and np.all(vectors <= vmin + 255 * step))
+
+def decode_vectors(stored, sq_params=None):
+    """Inverse of encode_vectors, returns float32 vectors."""
+    if stored.dtype == np.int8:
+        vmin, step = sq_params
+        return (stored.astype(np.float32) + 128) * step + vmin
+    return np.asarray(stored, dtype=np.float32)
+
+def load_pca(mem_path):
+    """Return the PCA fitted for the memory, or None if its vectors are not reduced by PCA."""
+    pca_path = f'{mem_path}/{PCA_FILE}'
+    return faiss.read_VectorTransform(pca_path) if os.path.exists(pca_path) else None
+
+def prepare_vectors(vectors, metric='l2'):
+    """Return a float32 copy of the vectors ready to be added to / searched in an index.
+    For the inner product metric the vectors are L2-normalised so the index ranks by cosine similarity."""
+    vectors = np.array(vectors, dtype=np.float32)
+    if metric == 'ip':
+        faiss.normalize_L2(vectors)
+    return vectors
+
+def index_description(index_type, n, dim, dtype='float32'):
+    """Return the faiss.index_factory description of the index type for n vectors of dim dimensions,
+    storing the vectors as dtype (ivfpq always stores PQ codes)."""
+    assert index_type in INDEX_TYPES, f"Invalid index type, must be one of {INDEX_TYPES}"
+    codec = _CODECS[dtype]
+    if index_type in ('ivf', 'ivfpq') and n < MIN_TRAIN_SIZE:
+        print(f"only {n} vectors, too few to train a {index_type} index, using flat index instead.")
+        index_type = 'flat'
+
+    if index_type == 'flat':
+        return codec
+    if index_type == 'hnsw':
+        return 'HNSW32' if codec == 'Flat' else f'HNSW32,{codec}'
+    # faiss wants at least 39 training vectors per IVF list
+    nlist = max(1, min(int(4 * np.sqrt(n)), n // 39))
+    if index_type == 'ivf':
+        return f'IVF{nlist},{codec}'
+    # ivfpq: largest number of sub-quantizers <= 64 dividing dim with at least 8 dims each,
+    # and as many bits per code as the training set allows
+    m = max(i for i in range(1, max(1, min(64, dim // 8)) + 1) if dim % i == 0)
+    nbits = int(min(8, max(4, np.log2(n // 39))))
+    return f'IVF{nlist},PQ{m}x{nbits}'
+
+def set_search_params(index, nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH):
+    """Set the query-time parameters which apply to the index type."""
+    params = faiss.ParameterSpace()
+    for name, value in (('nprobe', nprobe), ('efSearch', ef_search)):
+        try:
+            params.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass # the parameter does not apply to this index type
+
+def _read_index_mmap(index_path):
+    """Open a FAISS index read-only with its vectors memory-mapped rather than read into RAM.
+    Which flags are supported depends on the index type and faiss version, so fall back
+    from the most to the least lazy one."""
+    flags = [getattr(faiss, 'IO_FLAG_MMAP_IFC', 0) | faiss.IO_FLAG_MMAP, faiss.IO_FLAG_MMAP]
+    for flag in flags:
+        try:
+            return faiss.read_index(index_path, flag | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            pass
+    return faiss.read_index(index_path)
+
+def load_index(mem_path, mmap=False):
+    """Read the FAISS index of the memory directory with the search parameters recorded in its manifest.
+    Args:
+        mem_path (str): memory directory.
+        mmap (bool): open the index read-only and memory-mapped, for searching only.
+    Returns:
+        index: the FAISS index
+        manifest: the memory manifest (see read_manifest)
+    """
+    manifest = read_manifest(mem_path)
+    index_path = f'{mem_path}/faiss_index.bin'
+    index = _read_index_mmap(index_path) if mmap else faiss.read_index(index_path)
+    set_search_params(index, manifest.get('nprobe', DEFAULT_NPROBE), manifest.get('ef_search', DEFAULT_EF_SEARCH))
+    return index, manifest
 
 class Embedder():
-    def __init__(self, model='text-embedding-3-large_v1',
+    def __init__(self, model=DEFAULT_EMB_MODEL,
                  chunk_size=DEFAULT_CHUNK_SIZE,
-                 mem_path=MEMORY_PATH):
+                 mem_path=MEMORY_PATH, use_cache=True, max_workers=EMBED_MAX_WORKERS,
+                 index_type='flat', metric='l2', nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH,
+                 dtype='float32', dimensions=None, pca_dim=None, ingest_workers=ingest.DEFAULT_WORKERS,
+                 dedup=False, dedup_distance=dedup.DEFAULT_MAX_DISTANCE):
+        """
+        Args:
+            model (str): embedding model id.
+            chunk_size (int): chunking size.
+            mem_path (str): memory directory.
+            use_cache (bool): look up / store embeddings in the on-disk embedding cache.
+            max_workers (int): number of embedding requests in flight.
+            index_type (str): 'flat' | 'ivf' | 'hnsw' | 'ivfpq', see create_faiss_index.
+            metric (str): 'l2' | 'ip', see create_faiss_index.
+            nprobe (int): number of IVF lists searched per query.
+            ef_search (int): HNSW search depth.
+            dtype (str): storage of the vectors, 'float32' | 'float16' | 'int8' (scalar quantized).
+            dimensions (int): ask the embedding model for shortened vectors (text-embedding-3 models only).
+            pca_dim (int): reduce the vectors to pca_dim dimensions with a PCA fitted on the memory.
+            ingest_workers (int): number of processes extracting and chunking files, 1 for none.
+            dedup (bool): drop exact and near duplicate chunks before embedding them.
+            dedup_distance (int): max SimHash bit distance of near duplicates, 0 for exact duplicates only.
+        """
+        assert index_type in INDEX_TYPES, f"Invalid index type, must be one of {INDEX_TYPES}"
+        assert metric in METRICS, f"Invalid metric, must be one of {METRICS}"
+        assert dtype in DTYPES, f"Invalid dtype, must be one of {DTYPES}"
         self.model = model
+        self.dtype = dtype
+        self.dimensions = dimensions
+        self.pca_dim = pca_dim
+        self.index_type = index_type
+        self.metric = metric
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.max_workers = max_workers
+        self.ingest_workers = ingest_workers
+        self.dedup = dedup
+        self.dedup_distance = dedup_distance
+        self.dedup_stats = None
+        self.use_cache = use_cache
+        self.common_path = None
         self.chunk_size = chunk_size
         self.mem_path = mem_path
+        self.cache = embedding_cache.get_default_cache() if use_cache else None
         self._reset_memory()
         if not os.path.exists(self.mem_path):
             try:
@@ -31,35 +219,145 @@ class Embedder():
         self.chunks = []
         self.embeddings = np.array([])
         self.indices = None
+        self.pca = None
+        self.sq_params = None
+
+    @classmethod
+    def from_memory(cls, mem_path, model=None):
+        """Create an Embedder which embeds queries the same way as the vectors of the memory,
+        i.e. same model, dimensions and PCA."""
+        manifest = read_manifest(mem_path)
+        emb = cls(model=model or manifest.get('model', DEFAULT_EMB_MODEL), mem_path=mem_path,
+                  dimensions=manifest.get('dimensions'), metric=manifest.get('metric', 'l2'))
+        emb.pca = load_pca(mem_path)
+        return emb
 
-    def _save_memory(self):
+    def _save_memory(self, files=None):
         """Save chunks and embeddings into files on disk"""
-        np.save(f'{self.mem_path}/embeddings', self.embeddings)
-        with open(f'{self.mem_path}/chunks.txt', 'w', encoding='utf-8') as f:
-            f.write('\n===\n'.join(self.chunks))
+        # write to temporary files and replace, running bots may have the old files mapped
+        stored, self.sq_params = encode_vectors(self.embeddings, self.dtype, self.sq_params)
+        with open(f'{self.mem_path}/embeddings.npy.tmp', 'wb') as f:
+            np.save(f, stored)
+        os.replace(f'{self.mem_path}/embeddings.npy.tmp', f'{self.mem_path}/embeddings.npy')
+        chunk_store.write_chunks(self.mem_path, self.chunks)
+        bm25.BM25Index.build(self.chunks).save(self.mem_path)
 
-        faiss.write_index(self.indices, f'{self.mem_path}/faiss_index.bin')
+        faiss.write_index(self.indices, f'{self.mem_path}/faiss_index.bin.tmp')
+        os.replace(f'{self.mem_path}/faiss_index.bin.tmp', f'{self.mem_path}/faiss_index.bin')
+        for file_name in (PCA_FILE, SQ_PARAMS_FILE):
+            if os.path.exists(f'{self.mem_path}/{file_name}'):
+                os.remove(f'{self.mem_path}/{file_name}')
+        if self.pca is not None:
+            faiss.write_VectorTransform(self.pca, f'{self.mem_path}/{PCA_FILE}')
+        if self.sq_params is not None:
+            np.save(f'{self.mem_path}/{SQ_PARAMS_FILE}', self.sq_params)
+        if files is not None:
+            manifest = {'model': self.model, 'chunk_size': self.chunk_size,
+                        'dtype': self.dtype, 'dimensions': self.dimensions, 'pca_dim': self.pca_dim,
+                        'dedup': self.dedup, 'common': self.common_path,
+                        'index_type': self.index_type, 'metric': self.metric,
+                        'nprobe': self.nprobe, 'ef_search': self.ef_search,
+                        'files': files}
+            with open(f'{self.mem_path}/{MANIFEST_FILE}', 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2)
 
     def load_memory(self):
-        self.embeddings = np.load(f'{self.mem_path}/embeddings.npy')
-        with open(f'{self.mem_path}/chunks.txt', 'r', encoding='utf-8') as f:
-            self.chunks = f.read().split('\n===\n')
-        self.indices = faiss.read_index(f'{self.mem_path}/faiss_index.bin')
+        sq_params_path = f'{self.mem_path}/{SQ_PARAMS_FILE}'
+        self.sq_params = np.load(sq_params_path) if os.path.exists(sq_params_path) else None
+        self.embeddings = decode_vectors(np.load(f'{self.mem_path}/embeddings.npy'), self.sq_params)
+        self.pca = load_pca(self.mem_path)
+        store = chunk_store.ChunkStore(self.mem_path)
+        self.chunks = list(store)
+        store.close()
+        self.indices, _ = load_index(self.mem_path)
         
 
+    @property
+    def cache_model(self):
+        # shortened vectors are cached apart from the full size ones
+        return f'{self.model}@{self.dimensions}' if self.dimensions else self.model
+
     def embed_chunks(self, chunks):
-        """Embed the chunks using the class' embedding model"""
+        """Embed the chunks using the class' embedding model.
+        Chunks found in the embedding cache are not sent to the embeddings endpoint."""
+        if self.cache is None:
+            return self._embed_chunks(chunks)
+
+        cache_model = self.cache_model
+        embeddings = self.cache.get_many(cache_model, chunks)
+        misses = [i for i, e in enumerate(embeddings) if e is None]
+        if misses:
+            miss_chunks = [chunks[i] for i in misses]
+            miss_embeddings = self._embed_chunks(miss_chunks)
+            self.cache.put_many(cache_model, miss_chunks, miss_embeddings)
+            for i, e in zip(misses, miss_embeddings):
+                embeddings[i] = e
+        return np.array(embeddings) if embeddings else None
+
+    def _embed_batch(self, sub_chunks, call_type='embed'):
+        """Embed one batch of chunks, retried by llm_client when the endpoint fails or is rate limited."""
+        kwargs = {'dimensions': self.dimensions} if self.dimensions else {}
+        response = llm_client.embeddings(call_type, input=sub_chunks, model=self.model, **kwargs)
+        return [item.embedding for item in response.data]
+
+    async def _aembed_batch(self, sub_chunks, call_type='embed'):
+        """Like _embed_batch, on the asyncio client."""
+        kwargs = {'dimensions': self.dimensions} if self.dimensions else {}
+        response = await llm_client.aembeddings(call_type, input=sub_chunks, model=self.model, **kwargs)
+        return np.asarray([item.embedding for item in response.data], dtype=np.float32)
+
+    def _embed_chunks(self, chunks):
         # if the chunks is too large the model will throw exception, so 
-        # break it into sub-chunks of 96 elements each
-        step = 96
+        # break it into sub-chunks of 96 elements each, keeping up to 
+        # max_workers batches in flight
+        step = EMBED_BATCH_SIZE
+        batches = [chunks[i:i+step] for i in range(0, len(chunks), step)]
+        if not batches:
+            return None
+
         embeddings = None
-        for i in range(0, len(chunks), step):
-            sub_chunks = chunks[i:i+step]
-            response = client.embeddings.create(input=sub_chunks, model=self.model)
-            sub_embeddings = np.array([item.embedding for item in response.data])
-            embeddings = sub_embeddings if embeddings is None else np.vstack((embeddings, sub_embeddings))
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+            futures = {executor.submit(self._embed_batch, batch): i for i, batch in enumerate(batches)}
+            try:
+                for future in as_completed(futures):
+                    sub_embeddings = np.asarray(future.result(), dtype=np.float32)
+                    if embeddings is None:
+                        embeddings = np.empty((len(chunks), sub_embeddings.shape[1]), dtype=np.float32)
+                    i = futures[future] * step
+                    embeddings[i:i+len(sub_embeddings)] = sub_embeddings
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
 
         return embeddings
+
+    def reduce(self, embeddings):
+        """Apply the memory's PCA, if any, to embedded vectors."""
+        if self.pca is None or embeddings is None:
+            return embeddings
+        return self.pca.apply(np.ascontiguousarray(embeddings, dtype=np.float32))
+
+    def embed_queries(self, queries, reduce=True):
+        """Embed the queries into the vector space of the memory.
+        Repeated queries are served from the process-wide query cache.
+        Args:
+            queries: list of query texts.
+            reduce (bool): apply the memory's PCA, False for the vectors as returned by the model.
+        """
+        # queries are short, they are sent in one batch, hedged against slow answers
+        embeddings = embedding_cache.get_query_cache().embed(self.cache_model, queries,
+                                                             functools.partial(self._embed_batch, call_type='embed_query'))
+        embeddings = np.array(embeddings) if embeddings else None
+        return self.reduce(embeddings) if reduce else embeddings
+
+    async def aembed_queries(self, queries, reduce=True):
+        """Like embed_queries, awaiting the embeddings endpoint on the asyncio client.
+        Queries are short, they are sent in one batch."""
+        embeddings = await embedding_cache.get_query_cache().aembed(self.cache_model, queries,
+                                                                    functools.partial(self._aembed_batch, call_type='embed_query'))
+        embeddings = np.array(embeddings) if embeddings else None
+        return self.reduce(embeddings) if reduce else embeddings
     
     def embed_pdf(self, pdf_file_path, chunk_size=None):
         """Read and convert PDF file into text, then chunk it, embed it.
@@ -73,54 +371,215 @@ class Embedder():
         if chunk_size is None:
             chunk_size = self.chunk_size
 
-        chunks = []
-
-        doc = fitz.open(pdf_file_path)
-        text = "".join(page.get_text() for page in doc)
-        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
-        # splitter = CharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=100)
-        chunks = splitter.split_text(text)
+        chunks = ingest.extract_chunks(pdf_file_path, 'pdf', chunk_size, pdf_workers=self.ingest_workers)
         embeddings = self.embed_chunks(chunks=chunks)
 
         return chunks, embeddings
-    
-    def _embed_directory(self, file_directory, file_type='txt'):
-        directory = Path(file_directory)
-        for file_path in directory.glob(f"*.{file_type}"):
-            if file_type=='pdf':
-                chunks, embeddings = self.embed_pdf(file_path)
-            elif file_type=='html':
-                chunks, embeddings = self.embed_html(file_path)
-            else:
-                chunks, embeddings = self.embed_txt(file_path)
-            self.chunks += chunks
-            
-            if self.embeddings.size > 0:
-                self.embeddings = np.vstack((self.embeddings, embeddings)) 
-            else: 
-                self.embeddings = embeddings
-        return
 
-    def embed_directory(self, file_directory, file_type='txt', embed_common=True):
+    def _load_manifest(self):
+        """Load the per-file manifest of the memory, or None if it does not exist or
+        was built with a different model / chunk size / vector layout."""
+        manifest = read_manifest(self.mem_path)
+        settings = ('model', 'chunk_size', 'dtype', 'dimensions', 'pca_dim', 'dedup')
+        if not manifest or any(manifest.get(k, False if k == 'dedup' else None) != getattr(self, k) for k in settings):
+            return None
+        if self.pca_dim and not os.path.exists(f'{self.mem_path}/{PCA_FILE}'):
+            return None
+        return manifest
+
+    def _list_files(self, file_directory, file_type='txt'):
+        """List (file_path, file_type) in the order they are stored in the memory."""
+        return [(p, file_type) for p in sorted(Path(file_directory).glob(f"*.{file_type}"))]
+
+    def embed_common_memory(self):
+        """Embed the common files in ./input/summary into the common memory shared by all bot
+        memories of the same model, dimensions and metric, so that they can be searched together.
+        Each of these settings has its own common memory, chunked with COMMON_CHUNK_SIZE and COMMON_DEDUP
+        whatever the memory's chunk size and dedup, so that a memory of other settings does not rebuild it.
+        It has no PCA, a bot with a PCA memory projects it, see memory.Memory.with_pca.
+        Returns:
+            the common memory path, None if there are no common files.
+        """
+        if not any(Path(COMMON_INPUT_PATH).glob("*.txt")):
+            return None
+        common_path = common_memory_path(self.model, self.dimensions, self.metric)
+        common = Embedder(model=self.model, chunk_size=COMMON_CHUNK_SIZE, mem_path=common_path,
+                          use_cache=self.use_cache, max_workers=self.max_workers, metric=self.metric,
+                          dimensions=self.dimensions, ingest_workers=self.ingest_workers, dedup=COMMON_DEDUP)
+        common.embed_directory(COMMON_INPUT_PATH, 'txt', embed_common=False)
+        return common_path
+
+    @staticmethod
+    def _invalidate_duplicates(plan):
+        """A reused file whose dropped duplicates refer to a file which is re-embedded or removed
+        has to be re-embedded too, its chunks may no longer be duplicates."""
+        reused = {p['key'] for p in plan if p['reuse']}
+        changed = True
+        while changed:
+            changed = False
+            for p in plan:
+                if p['reuse'] and any(ref_key not in reused for _, ref_key, _ in p['entry'].get('duplicates', [])):
+                    p['reuse'] = False
+                    reused.discard(p['key'])
+                    changed = True
+
+    def _duplicate_index(self, plan):
+        """Index the chunks of the reused files for de-duplicating the chunks of the files to embed."""
+        index = dedup.DuplicateIndex(self.dedup_distance)
+        for p in plan:
+            if p['reuse']:
+                start, end = p['entry']['start'], p['entry']['end']
+                for offset, chunk in enumerate(self.chunks[start:end]):
+                    index.add((p['key'], offset), chunk)
+        return index
+
+    @staticmethod
+    def _drop_duplicates(chunked, index):
+        """Drop the chunks of the (file_path, chunks, pages) stream which duplicate an indexed chunk.
+        Yields (file_path, chunks, pages, duplicates), duplicates listing
+        [chunk number in the file, file key, chunk offset in that file] of every dropped chunk."""
+        for file_path, chunks, pages in chunked:
+            key = Path(file_path).as_posix()
+            kept, kept_pages, duplicates = [], [], []
+            for i, chunk in enumerate(chunks):
+                duplicate_of = index.add_if_new((key, len(kept)), chunk)
+                if duplicate_of is None:
+                    kept.append(chunk)
+                    if pages is not None:
+                        kept_pages.append(pages[i])
+                else:
+                    duplicates.append([i, *duplicate_of])
+            yield file_path, kept, kept_pages if pages is not None else None, duplicates
+
+    def embed_directory(self, file_directory, file_type='txt', embed_common=True, rebuild=False):
         """Read all files in the given path, for each file, chunk and embed it.
         At the end of it, concat all the chunks and embeddings into self.chunks and self.embeddings.
+        The content hash and chunk range of each file are recorded in the memory manifest, so 
+        subsequent calls only embed added/changed files and drop the chunks of deleted files.
         Args:
             file_directory (str): directory where the files are stored.
             file_type (str): 'txt' | 'pdf' | 'html'
+            embed_common (bool): whether to embed the common files in ./input/summary into the 
+                shared common memory and link it to this memory, see embed_common_memory.
+            rebuild (bool): ignore the existing memory and re-embed every file.
         Returns:
             chunks: list of texts after chunking
             embeddings: list of embedded vectors
         """
         assert file_type=='txt' or file_type=='pdf' or file_type=='html', \
             "Invalid file type, must be txt, html or pdf"
-        
-        # embed the common files first
-        if embed_common:
-            self._embed_directory('./input/summary')
-        self._embed_directory(file_directory, file_type)
-        
-        self.indices = self.create_faiss_index(self.embeddings)
-        self._save_memory()
+        self.common_path = self.embed_common_memory() if embed_common else None
+
+        manifest = None if rebuild else self._load_manifest()
+        if manifest is not None:
+            self.load_memory()
+            old_files = manifest['files']
+            if (manifest.get('index_type', 'flat'), manifest.get('metric', 'l2')) != (self.index_type, self.metric):
+                # vectors can be reused, but the index has to be rebuilt
+                self.indices = None
+        else:
+            self._reset_memory()
+            old_files = {}
+
+        plan = []
+        for file_path, ftype in self._list_files(file_directory, file_type):
+            key = Path(file_path).as_posix()
+            file_hash = utils.get_file_hash(file_path)
+            entry = old_files.get(key)
+            reuse = entry is not None and entry['hash'] == file_hash
+            plan.append({'path': file_path, 'type': ftype, 'key': key, 'hash': file_hash,
+                         'entry': entry, 'reuse': reuse})
+        duplicate_index = None
+        if self.dedup:
+            self._invalidate_duplicates(plan)
+        to_embed = [(p['path'], p['type']) for p in plan if not p['reuse']]
+        if self.dedup and to_embed:
+            duplicate_index = self._duplicate_index(plan)
+        # stream the added/changed files through the extraction / embedding pipeline
+        chunk_filter = (lambda chunked: self._drop_duplicates(chunked, duplicate_index)) if duplicate_index else None
+        embedded = ingest.iter_embedded(to_embed, self, self.ingest_workers, chunk_filter=chunk_filter)
+
+        chunks = []
+        embeddings = []
+        files = {}
+        stats = {'added': 0, 'changed': 0, 'unchanged': 0}
+        # length of the leading run of chunks which keep their position in the existing index
+        kept_prefix = 0
+        try:
+            for p in plan:
+                file_path, key, entry = p['path'], p['key'], p['entry']
+                if p['reuse']:
+                    file_chunks = self.chunks[entry['start']:entry['end']]
+                    file_embeddings = self.embeddings[entry['start']:entry['end']]
+                    pages = entry.get('pages')
+                    duplicates = entry.get('duplicates')
+                    stats['unchanged'] += 1
+                    if entry['start'] == kept_prefix == len(chunks):
+                        kept_prefix = entry['end']
+                else:
+                    _, file_chunks, file_embeddings, pages, *extra = next(embedded)
+                    duplicates = extra[0] if extra else None
+                    print(f"embedded {file_path}: {len(file_chunks)} chunks")
+                    # on a full rebuild the PCA is fitted below, once all the vectors are known
+                    file_embeddings = self.reduce(file_embeddings)
+                    stats['changed' if entry is not None else 'added'] += 1
+                files[key] = {'hash': p['hash'], 'type': p['type'],
+                              'start': len(chunks), 'end': len(chunks)+len(file_chunks)}
+                if pages is not None:
+                    # page provenance of the PDF chunks
+                    files[key]['pages'] = [list(r) for r in pages]
+                if duplicates:
+                    files[key]['duplicates'] = duplicates
+                chunks += file_chunks
+                if len(file_chunks) > 0:
+                    embeddings.append(file_embeddings)
+        finally:
+            # stop the pipeline, also when embedding failed
+            embedded.close()
+        stats['removed'] = len(set(old_files) - set(files))
+        print(f"embed_directory: {stats['added']} added, {stats['changed']} changed, "
+              f"{stats['removed']} removed, {stats['unchanged']} unchanged files.")
+        if duplicate_index is not None:
+            self.dedup_stats = duplicate_index.stats
+            print(f"dedup: dropped {self.dedup_stats['exact']} exact and {self.dedup_stats['near']} near "
+                  f"duplicates out of {self.dedup_stats['chunks']} new chunks.")
+
+        if self.indices is not None and stats['added'] + stats['changed'] + stats['removed'] == 0:
+            if manifest.get('common') != self.common_path:
+                self._save_memory(files)
+            return
+
+        if not chunks:
+            raise ValueError(f"No chunks to embed in {file_directory}, the memory {self.mem_path} is left unchanged")
+        new_embeddings = np.concatenate(embeddings)
+        if self.pca_dim and self.pca is None and len(new_embeddings) < self.pca_dim:
+            raise ValueError(f"A PCA to {self.pca_dim} dimensions is fitted on at least {self.pca_dim} vectors, "
+                             f"{file_directory} has {len(new_embeddings)} chunks: use a smaller pca_dim or none. "
+                             f"The memory {self.mem_path} is left unchanged")
+        if self.pca_dim and self.pca is None and new_embeddings.shape[1] < self.pca_dim:
+            raise ValueError(f"pca_dim {self.pca_dim} is larger than the {new_embeddings.shape[1]} dimensions "
+                             f"of the vectors, the memory {self.mem_path} is left unchanged")
+        old_size = len(self.chunks)
+        self.chunks = chunks
+        self.embeddings = new_embeddings
+        if self.pca_dim and self.pca is None:
+            print(f"fitting PCA {self.embeddings.shape[1]} -> {self.pca_dim} dimensions ...")
+            self.pca = faiss.PCAMatrix(self.embeddings.shape[1], self.pca_dim)
+            self.pca.train(np.ascontiguousarray(self.embeddings, dtype=np.float32))
+            self.embeddings = self.reduce(self.embeddings)
+        extend = self.indices is not None and kept_prefix == old_size == self.indices.ntotal
+        if extend and self.sq_params is not None and not quantizer_fits(self.embeddings[kept_prefix:], self.sq_params):
+            print("the appended vectors are out of the range of the int8 quantizer, rebuilding the index.")
+            extend = False
+        if extend:
+            # only appended files, extend the existing index in place
+            self.indices.add(prepare_vectors(self.embeddings[kept_prefix:], self.metric))
+        else:
+            # the int8 quantizer is fitted again on all the vectors
+            self.sq_params = None
+            self.indices = self.create_faiss_index(self.embeddings, self.index_type, self.metric, self.dtype)
+        set_search_params(self.indices, self.nprobe, self.ef_search)
+        self._save_memory(files)
         return
 
     def embed_txt(self, txt_file_path, chunk_size=None):
@@ -135,16 +594,7 @@ class Embedder():
         if chunk_size is None:
             chunk_size = self.chunk_size
 
-        chunks = []
-        
-        with open(txt_file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-        
-        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
-        chunks = splitter.split_text(text)
-        
-        file_name = utils.get_basename_without_extension(txt_file_path)+"\n"
-        chunks = [file_name+chunk for chunk in chunks]
+        chunks = ingest.extract_chunks(txt_file_path, 'txt', chunk_size)
 
         embeddings = self.embed_chunks(chunks=chunks)
 
@@ -162,16 +612,7 @@ class Embedder():
         if chunk_size is None:
             chunk_size = self.chunk_size
 
-        chunks = []
-        
-        with open(html_file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-        
-        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
-        chunks = splitter.split_text(text)
-        
-        file_name = utils.get_basename_without_extension(html_file_path)+"\n"
-        chunks = [file_name+chunk for chunk in chunks]
+        chunks = ingest.extract_chunks(html_file_path, 'html', chunk_size)
         
         embeddings = self.embed_chunks(chunks=chunks)
 
@@ -179,10 +620,21 @@ class Embedder():
 
     
     @staticmethod
-    def create_faiss_index(embeddings):
-        dim = len(embeddings[0])
-        index = faiss.IndexFlatL2(dim)  # L2 distance for similarity
-        index.add(np.array(embeddings))  # Add embeddings to index
+    def create_faiss_index(embeddings, index_type='flat', metric='l2', dtype='float32'):
+        """Build a FAISS index over the embeddings.
+        Args:
+            embeddings: matrix of embedded vectors.
+            index_type (str): 'flat' (exact search) | 'ivf' | 'hnsw' | 'ivfpq'
+            metric (str): 'l2' (L2 distance) | 'ip' (inner product over normalised vectors, i.e. cosine)
+            dtype (str): how the index stores the vectors, 'float32' | 'float16' | 'int8'
+        """
+        vectors = prepare_vectors(embeddings, metric)
+        n, dim = vectors.shape
+        faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == 'ip' else faiss.METRIC_L2
+        index = faiss.index_factory(dim, index_description(index_type, n, dim, dtype), faiss_metric)
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
         return index
     
     def search_chunks(self, queries):
@@ -190,7 +642,7 @@ class Embedder():
         chunks - list of chunks
         """
         # query_embedding = np.array(get_embedding(query)).reshape(1, -1)
-        query_embedding = self.embed_chunks(queries)
+        query_embedding = prepare_vectors(self.embed_queries(queries), self.metric)
         distances, indices = self.indices.search(query_embedding, k=10)  # Retrieve top k relevant chunks
         return [self.chunks[i] for i in indices[0]]
 
@@ -0,0 +1,242 @@
+import os
+import re
+import time
+import atexit
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+CACHE_PATH = './memory/embedding_cache.db'
+DEFAULT_MAX_ENTRIES = 200000
+QUERY_CACHE_ENTRIES = 1024
+QUERY_CACHE_SPILL = True # keep the query vectors in the disk cache too, so they survive restarts
+_BATCH = 500 # max number of sql parameters per statement
+TOUCH_FLUSH_ENTRIES = 256 # the last_used of the hits are written in batches of entries ...
+TOUCH_FLUSH_SECONDS = 30 # ... or after seconds, whichever comes first
+EVICT_TO = 0.9 # share of max_entries kept by an eviction, so that the next one waits for more puts
+
+class EmbeddingCache():
+    """Disk-backed cache of embedding vectors keyed by (model, sha256 of chunk text).
+    When the cache grows beyond max_entries the least recently used vectors are evicted.
+    The last_used of the hits are kept in memory and written in batches, so a hit does not commit.
+    """
+    def __init__(self, path=CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                                model TEXT NOT NULL,
+                                text_hash TEXT NOT NULL,
+                                vector BLOB NOT NULL,
+                                last_used REAL NOT NULL,
+                                PRIMARY KEY (model, text_hash))""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._touched = {} # (model, text_hash) -> last_used not written yet
+        self._flushed = time.time()
+        # upper bound of the number of entries, counted again only when it exceeds max_entries
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, model, texts):
+        """Look up the vectors of the texts.
+        Returns:
+            list of np.ndarray (float32) aligned with texts, None for a cache miss.
+        """
+        hashes = [self.text_hash(t) for t in texts]
+        found = {}
+        with self._lock:
+            for i in range(0, len(hashes), _BATCH):
+                sub_hashes = list(set(hashes[i:i+_BATCH]))
+                placeholders = ','.join('?' * len(sub_hashes))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model=? AND text_hash IN ({placeholders})",
+                    [model] + sub_hashes).fetchall()
+                found.update({h: np.frombuffer(v, dtype=np.float32) for h, v in rows})
+            if found:
+                now = time.time()
+                self._touched.update(((model, h), now) for h in found)
+                if len(self._touched) >= TOUCH_FLUSH_ENTRIES or now - self._flushed >= TOUCH_FLUSH_SECONDS:
+                    self._flush_touched()
+                    self._conn.commit()
+        vectors = [found.get(h) for h in hashes]
+        hits = sum(v is not None for v in vectors)
+        self.hits += hits
+        self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, model, texts, vectors):
+        """Store the vectors of the texts, evicting the least recently used entries if needed."""
+        now = time.time()
+        rows = [(model, self.text_hash(t), np.asarray(v, dtype=np.float32).tobytes(), now)
+                for t, v in zip(texts, vectors)]
+        with self._lock:
+            self._flush_touched()
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._count += len(rows)
+            if self._count > self.max_entries:
+                self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                if self._count > self.max_entries:
+                    keep = int(self.max_entries * EVICT_TO)
+                    self._conn.execute("""DELETE FROM embeddings WHERE rowid IN
+                                          (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)""",
+                                       (self._count - keep,))
+                    self._count = keep
+            self._conn.commit()
+
+    def _flush_touched(self):
+        # called with the lock held, the caller commits
+        if self._touched:
+            self._conn.executemany("UPDATE embeddings SET last_used=? WHERE model=? AND text_hash=?",
+                                   [(t, model, h) for (model, h), t in self._touched.items()])
+            self._touched = {}
+        self._flushed = time.time()
+
+    def flush(self):
+        """Write the last_used of the hits kept in memory."""
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._touched = {}
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._count = 0
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    """Return the process-wide embedding cache stored at CACHE_PATH."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+            atexit.register(_default_cache.flush)
+        return _default_cache
+
+class QueryCache():
+    """In-process LRU cache of query vectors keyed by (model, normalised query text),
+    so that repeated questions do not wait for the embeddings endpoint.
+    With a disk_cache the vectors are also stored on disk and looked up there on a miss.
+    """
+    def __init__(self, max_entries=QUERY_CACHE_ENTRIES, disk_cache=None):
+        self.max_entries = max_entries
+        self.disk_cache = disk_cache
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalise(query):
+        return re.sub(r'\s+', ' ', query).strip().lower()
+
+    def _disk_model(self, model):
+        # query vectors live apart from the chunk vectors in the disk cache
+        return f'query:{model}'
+
+    def embed(self, model, queries, embed_fn):
+        """Return the vectors of the queries, calling embed_fn only for the queries not cached.
+        Args:
+            model (str): embedding model id, part of the cache key.
+            queries: list of query texts.
+            embed_fn: function(list of texts) returning their vectors.
+        Returns:
+            list of np.ndarray (float32) aligned with queries.
+        """
+        keys, vectors, misses = self._lookup(model, queries)
+        if misses and self.disk_cache is not None:
+            misses = self._lookup_disk(model, keys, vectors, misses)
+        if misses:
+            self._store(model, keys, vectors, misses, embed_fn([queries[i] for i in misses]))
+        return self._remember(keys, vectors, misses)
+
+    async def aembed(self, model, queries, embed_fn):
+        """Like embed, with embed_fn a coroutine function. The disk cache is read and written
+        on a worker thread, off the event loop."""
+        keys, vectors, misses = self._lookup(model, queries)
+        if misses and self.disk_cache is not None:
+            misses = await asyncio.to_thread(self._lookup_disk, model, keys, vectors, misses)
+        if misses:
+            embedded = await embed_fn([queries[i] for i in misses])
+            if self.disk_cache is not None:
+                await asyncio.to_thread(self._store, model, keys, vectors, misses, embedded)
+            else:
+                self._store(model, keys, vectors, misses, embedded)
+        return self._remember(keys, vectors, misses)
+
+    def _lookup(self, model, queries):
+        keys = [(model, self.normalise(q)) for q in queries]
+        with self._lock:
+            vectors = [self._entries.get(key) for key in keys]
+            for key, v in zip(keys, vectors):
+                if v is not None:
+                    self._entries.move_to_end(key)
+        return keys, vectors, [i for i, v in enumerate(vectors) if v is None]
+
+    def _lookup_disk(self, model, keys, vectors, misses):
+        # fills the vectors found on disk, returns the misses left
+        found = self.disk_cache.get_many(self._disk_model(model), [keys[i][1] for i in misses])
+        for i, v in zip(misses, found):
+            vectors[i] = v
+        return [i for i in misses if vectors[i] is None]
+
+    def _store(self, model, keys, vectors, misses, embedded):
+        for i, v in zip(misses, embedded):
+            vectors[i] = np.asarray(v, dtype=np.float32)
+        if self.disk_cache is not None:
+            self.disk_cache.put_many(self._disk_model(model), [keys[i][1] for i in misses],
+                                     [vectors[i] for i in misses])
+
+    def _remember(self, keys, vectors, misses):
+        with self._lock:
+            self.hits += len(keys) - len(misses)
+            self.misses += len(misses)
+            for key, v in zip(keys, vectors):
+                self._entries[key] = v
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return vectors
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+def get_query_cache():
+    """Return the process-wide query cache shared by the chat bots."""
+    global _query_cache
+    with _query_cache_lock:
+        if _query_cache is None:
+            _query_cache = QueryCache(disk_cache=get_default_cache() if QUERY_CACHE_SPILL else None)
+        return _query_cache
@@ -0,0 +1,154 @@
+"""Token budget aware chat history.
+The last turns are kept verbatim; when the history grows over its token budget, the older turns are
+folded into a running summary by the LLM on a background thread, off the critical path of the chat.
+Until the summary is ready the oldest turns which do not fit the budget are left out of the prompt,
+so that the prompt cost of a turn stays flat on long conversations.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import utils
+import llm_client
+import context_packer
+
+DEFAULT_HISTORY_BUDGET = 2000 # tokens of the summary and the verbatim turns
+RECENT_TURNS = 3 # question / answer pairs always kept verbatim
+MAX_MESSAGES = 20 # without a token budget, only the last messages are kept
+SUMMARY_SHARE = 0.3 # max share of the budget taken by the summary
+SUMMARY_WORKERS = 2 # summaries computed at once in the process
+SUMMARY_PROMPT = """
+    Update the summary of a conversation between a user and a SQL Server / merchant solutions assistant
+    with the new messages. Keep every fact the rest of the conversation may rely on: names of tables and
+    columns, filters and SQL decisions, merchant details such as the MCC, postcode, revenue, market division
+    and products, and the user's goals and preferences. Drop greetings, and query results that were only shown.
+    Answer with the updated summary only, as short bullet points, in at most {max_words} words.
+    """
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """Return the process-wide thread pool computing the summaries."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix='history')
+        return _executor
+
+def summarise(summary, messages, model=utils.CHAT_MODEL, max_tokens=500):
+    """Fold the messages into the summary of the earlier conversation with one LLM call.
+    Args:
+        summary (str): the summary so far, None at first.
+        messages: the message dicts to fold, oldest first.
+        max_tokens (int): max length of the new summary.
+    Returns:
+        the new summary.
+    """
+    conversation = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = llm_client.chat_completion(
+        call_type='summary',
+        model=model,
+        messages=[{"role": "system", "content": SUMMARY_PROMPT.format(max_words=max_tokens * 3 // 4)},
+                  {"role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nNew messages:\n{conversation}"}],
+        temperature=0.0,
+        max_tokens=max_tokens,
+        stream=False
+    )
+    return response.choices[0].message.content
+
+class ChatHistory():
+    """Chat history of one conversation, iterated as the message dicts to send: the summary of the
+    earlier turns as a system message, then the recent turns verbatim, within the token budget."""
+    def __init__(self, budget=DEFAULT_HISTORY_BUDGET, model=utils.CHAT_MODEL, recent_turns=RECENT_TURNS):
+        """
+        Args:
+            budget (int): max number of tokens of the history in the prompt, None to keep the last
+                MAX_MESSAGES messages verbatim, without summary.
+            model (str): chat model whose tokenizer counts the tokens, and which summarises.
+            recent_turns (int): number of last question / answer pairs never folded into the summary.
+        """
+        assert budget is None or budget > 0, "The history budget must be positive"
+        self.budget = budget
+        self.model = model
+        self.recent_turns = recent_turns
+        self.summary = None
+        self.summary_tokens = 0
+        self.folded_turns = 0
+        self._messages = [] # (message dict, tokens), oldest first
+        self._pending = None # future of the summary being computed
+        self._lock = threading.Lock()
+
+    def add(self, prompt, answer):
+        """Add a turn, and start folding the older turns into the summary if over budget."""
+        tokenizer = context_packer.get_tokenizer(self.model)
+        with self._lock:
+            for message in ({"role": "user", "content": prompt}, {"role": "assistant", "content": answer or ''}):
+                self._messages.append((message, tokenizer.count(message['content'])))
+            if self.budget is None:
+                del self._messages[:-MAX_MESSAGES]
+            else:
+                self._fold()
+
+    def _fold(self):
+        # called with the lock held; one summary at a time, its messages stay at the head meanwhile
+        if self._pending is not None or self._tokens() <= self.budget:
+            return
+        n = len(self._messages) - 2 * self.recent_turns
+        if n <= 0:
+            return
+        self._pending = get_executor().submit(self._summarise, self.summary,
+                                              [message for message, _ in self._messages[:n]], n)
+
+    def _summarise(self, summary, messages, n):
+        try:
+            summary = summarise(summary, messages, self.model, int(self.budget * SUMMARY_SHARE))
+        except Exception as e:
+            # the old turns are dropped, as without summary
+            print(f"Error summarising the chat history, dropping {n // 2} turns: {e}")
+        tokenizer = context_packer.get_tokenizer(self.model)
+        with self._lock:
+            if summary:
+                self.summary = tokenizer.truncate(summary, int(self.budget * SUMMARY_SHARE))
+                self.summary_tokens = tokenizer.count(self.summary)
+            del self._messages[:n]
+            self.folded_turns += n // 2
+            self._pending = None
+            self._fold()
+
+    def _tokens(self):
+        return self.summary_tokens + sum(tokens for _, tokens in self._messages)
+
+    def wait(self, timeout=None):
+        """Wait for the summaries being computed, if any."""
+        while (pending := self._pending) is not None:
+            pending.exception(timeout)
+
+    def messages(self):
+        """The message dicts to send: the summary, then the most recent turns which fit the budget."""
+        with self._lock:
+            recent = self._messages
+            if self.budget is not None:
+                used = self.summary_tokens
+                start = len(recent)
+                # whole turns, the last one always
+                while start >= 2 and (start == len(recent) or
+                                      used + recent[start - 2][1] + recent[start - 1][1] <= self.budget):
+                    start -= 2
+                    used += recent[start][1] + recent[start + 1][1]
+                recent = recent[start:]
+            summary = [{"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"}] \
+                if self.summary else []
+            return summary + [message for message, _ in recent]
+
+    def stats(self):
+        with self._lock:
+            return {'messages': len(self._messages), 'tokens': self._tokens(), 'summary_tokens': self.summary_tokens,
+                    'folded_turns': self.folded_turns, 'summarising': self._pending is not None}
+
+    def __iter__(self):
+        return iter(self.messages())
+
+    def __reversed__(self):
+        return reversed(self.messages())
+
+    def __len__(self):
+        return len(self.messages())
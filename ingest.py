@@ -0,0 +1,121 @@
+"""Streaming document ingestion pipeline.
+Text extraction and chunking are CPU bound and run in a process pool, embedding is
+network bound and runs on threads. The stages overlap and only a bounded number of
+documents is in flight at any time, so memory does not grow with the corpus size.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import utils
+import pdf_extract
+
+text_splitters = utils.lazy_import('langchain_text_splitters')
+
+CHUNK_OVERLAP = 100
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+MAX_PENDING = 8 # documents in flight per stage
+EMBED_DOCUMENTS_IN_FLIGHT = 2
+
+def read_text(file_path, file_type='txt', pdf_workers=1):
+    """Return the text of the file: the text of all pages for PDF, the file content otherwise."""
+    if file_type == 'pdf':
+        return pdf_extract.extract_text(file_path, workers=pdf_workers)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def split_text(text, chunk_size, file_path=None):
+    """Chunk the text. When file_path is given every chunk is prefixed with the file name."""
+    splitter = text_splitters.RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=CHUNK_OVERLAP)
+    chunks = splitter.split_text(text)
+    if file_path is not None:
+        file_name = utils.get_basename_without_extension(file_path)+"\n"
+        chunks = [file_name+chunk for chunk in chunks]
+    return chunks
+
+def extract_pdf_chunks(pdf_path, chunk_size=2000, pdf_workers=1):
+    """Read and chunk the PDF file.
+    Returns:
+        chunks: list of texts after chunking
+        pages: (first page, last page) of each chunk, page numbers starting from 1
+    """
+    pages = pdf_extract.extract_pages(pdf_path, workers=pdf_workers)
+    splitter = text_splitters.RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=CHUNK_OVERLAP,
+                                              add_start_index=True)
+    docs = splitter.create_documents(["".join(pages)])
+    chunks = [doc.page_content for doc in docs]
+    ranges = pdf_extract.page_ranges(pages, [doc.metadata['start_index'] for doc in docs], [len(c) for c in chunks])
+    return chunks, ranges
+
+def extract_chunks(file_path, file_type='txt', chunk_size=2000, pdf_workers=1):
+    """Read and chunk the file. txt and html chunks carry the file name, PDF chunks do not."""
+    if file_type == 'pdf':
+        return extract_pdf_chunks(file_path, chunk_size, pdf_workers)[0]
+    text = read_text(file_path, file_type)
+    return split_text(text, chunk_size, file_path)
+
+def _ordered_map(executor, fn, args_iter, max_pending=MAX_PENDING):
+    """Like executor.map, but consumes args_iter lazily with at most max_pending
+    calls in flight. Runs inline when executor is None."""
+    pending = deque()
+    for args in args_iter:
+        if executor is None:
+            yield fn(*args)
+            continue
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def _process_pool(workers):
+    return ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+def _read(file_path, file_type):
+    return file_path, read_text(file_path, file_type)
+
+def _extract(file_path, file_type, chunk_size):
+    if file_type == 'pdf':
+        return (file_path, *extract_pdf_chunks(file_path, chunk_size))
+    return file_path, extract_chunks(file_path, file_type, chunk_size), None
+
+def iter_texts(files, workers=DEFAULT_WORKERS, max_pending=MAX_PENDING):
+    """Yield (file_path, text) for the (file_path, file_type) pairs, in order,
+    extracting up to max_pending files ahead in a process pool."""
+    executor = _process_pool(workers)
+    try:
+        yield from _ordered_map(executor, _read, files, max_pending)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def iter_chunks(files, chunk_size, workers=DEFAULT_WORKERS, max_pending=MAX_PENDING):
+    """Yield (file_path, chunks, pages) for the (file_path, file_type) pairs, in order.
+    pages are the page ranges of the chunks of PDF files (see extract_pdf_chunks), None for other files."""
+    executor = _process_pool(workers)
+    try:
+        args = ((file_path, file_type, chunk_size) for file_path, file_type in files)
+        yield from _ordered_map(executor, _extract, args, max_pending)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def iter_embedded(files, embedder, workers=DEFAULT_WORKERS, max_pending=MAX_PENDING, chunk_filter=None):
+    """Yield (file_path, chunks, embeddings, pages) for the (file_path, file_type) pairs, in order.
+    Files are chunked in a process pool while previously chunked files are being embedded.
+    Args:
+        files: iterable of (file_path, file_type).
+        embedder (Embedder): embeds the chunks, with its own batch concurrency.
+        workers (int): number of extraction processes, 1 to extract in this process.
+        max_pending (int): max number of documents in flight in each stage.
+        chunk_filter: optional generator function applied in order to the stream of
+            (file_path, chunks, pages) before embedding, e.g. to drop duplicate chunks.
+            Items it appends to the tuples are passed through after pages.
+    """
+    def embed(file_path, chunks, *extra):
+        return (file_path, chunks, embedder.embed_chunks(chunks), *extra)
+
+    with ThreadPoolExecutor(max_workers=EMBED_DOCUMENTS_IN_FLIGHT) as executor:
+        chunked = iter_chunks(files, embedder.chunk_size, workers, max_pending)
+        if chunk_filter is not None:
+            chunked = chunk_filter(chunked)
+        yield from _ordered_map(executor, embed, chunked, max_pending)
@@ -2,19 +2,36 @@ from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import OpenAIEmbeddings
 from langchain_openai import ChatOpenAI
 from langchain.schema import SystemMessage, HumanMessage, AIMessage
-from langchain.tools import Tool
+from langchain.tools import StructuredTool
 from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain.callbacks.base import BaseCallbackHandler
 from itertools import islice
 from chat_bot import Chat_Bot
-import recommend
 import chat_bot
 import utils
-import db_utils
+import embedding_cache
+import tool_registry
+import context_packer
+import history
 import json
+import time
+import queue
+import threading
+from pydantic import Field, create_model
 
 MEMORY_PATH = './memory_lc'
 
+# vector stores shared by the bots, by memory path
+_vectorstores = {}
+_vectorstores_lock = threading.Lock()
+_path_locks = {} # vector stores are loaded outside _vectorstores_lock, one at a time per path
+
+def release_vectorstore(memory_path):
+    """Drop the shared vector store of the memory, it is loaded again on next use."""
+    with _vectorstores_lock:
+        _vectorstores.pop(memory_path, None)
+
 def get_first_n_chunks(vector_store, n=3):
     # Access index_to_docstore_id mapping
     index_to_id = vector_store.index_to_docstore_id
@@ -30,15 +47,52 @@ def get_first_n_chunks(vector_store, n=3):
             chunks.append(doc)
     return chunks
 
+class _TokenQueueCallback(BaseCallbackHandler):
+    """Put the tokens streamed by the LLM into a queue, read by LangChainBot.chat_stream."""
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token, **kwargs):
+        # tool call chunks come with an empty token
+        if token:
+            self.tokens.put(token)
+
+_JSON_TYPES = {"string": str, "integer": int, "number": float, "boolean": bool}
+
+def _args_schema(spec):
+    fields = {name: (_JSON_TYPES.get(p.get("type"), str), Field(description=p.get("description", "")))
+              for name, p in spec.parameters.items()}
+    return create_model(f"{spec.name}_args", **fields)
+
+def _registry_func(name):
+    def func(**kwargs):
+        # through the tool pool, within the tool's timeout and concurrency limit
+        return tool_registry.call_many([{"id": name, "type": "function",
+                                         "function": {"name": name, "arguments": json.dumps(kwargs)}}])[0]
+    return func
+
+def registry_tools():
+    """LangChain tools of the tools in tool_registry, the same tools as Chat_Bot's."""
+    return [StructuredTool.from_function(func=_registry_func(spec.name), name=spec.name,
+                                         description=spec.description, args_schema=_args_schema(spec))
+            for spec in tool_registry.specs()]
+
 class LangChainBot(Chat_Bot):
     def __init__(self, memory_path=MEMORY_PATH, emb_model='text-embedding-3-large_v1',
-                 system_prompt=None):
+                 system_prompt=None, context_budget=context_packer.DEFAULT_CONTEXT_BUDGET,
+                 history_budget=history.DEFAULT_HISTORY_BUDGET):
         self.system_prompt = system_prompt if system_prompt else chat_bot.SYSTEM_PROMPT
+        self.context_budget = context_budget
+        self.context_stats = None
+        self.stream_stats = None
+        self.last_answer = None # the agent's output of the last turn, the streamed text may hold more
         self.memory_path = memory_path
+        self.emb_model = emb_model
         self.embeddings = OpenAIEmbeddings(openai_api_key=utils.GENAI_API_KEY, 
                                            base_url=utils.GENAI_API_URL,
                                            model=emb_model)
-        self.chat_history = []
+        self.history_budget = history_budget
+        self.chat_history = history.ChatHistory(history_budget)
         self.temperature = 0.3
         self.model_id = utils.CHAT_MODEL
 
@@ -46,13 +100,23 @@ class LangChainBot(Chat_Bot):
         self.setup_agent()
         
     def load_memory(self):
-        """Load or create FAISS vector store"""
+        """Load or create FAISS vector store, shared by the bots of the same memory"""
         try:
-            self.vectorstore = FAISS.load_local(
-                self.memory_path + "/faiss_index",
-                self.embeddings,
-                allow_dangerous_deserialization=True
-            )
+            with _vectorstores_lock:
+                self.vectorstore = _vectorstores.get(self.memory_path)
+                path_lock = _path_locks.setdefault(self.memory_path, threading.Lock())
+            if self.vectorstore is None:
+                with path_lock:
+                    with _vectorstores_lock:
+                        self.vectorstore = _vectorstores.get(self.memory_path)
+                    if self.vectorstore is None:
+                        self.vectorstore = FAISS.load_local(
+                            self.memory_path + "/faiss_index",
+                            self.embeddings,
+                            allow_dangerous_deserialization=True
+                        )
+                        with _vectorstores_lock:
+                            _vectorstores[self.memory_path] = self.vectorstore
         except:
             # If no existing index, create one from documents
             print("No existing FAISS index found. Please create one first.")
@@ -60,21 +124,8 @@ class LangChainBot(Chat_Bot):
 
     def setup_agent(self):
         """Setup LangChain agent with tools"""
-        # Define the SQL execution tool
-        self.tools = [
-            Tool(
-                name="get_current_date_time",
-                func=lambda query: json.dumps(utils.print_now()),
-                description="Get the current date, time and day of week. It answers the question of today's date, day of week, etc."
-            ),
-            Tool(
-                name="execute_sql",
-                func=lambda query: json.dumps(db_utils.execute_sql(query)),
-                description="Execute SQL query on the database and return results. The query parameter should be a valid SQL query string."
-            ),
-            recommend.recommend_product_wrapper,
-            recommend.recommend_pricing_wrapper
-        ]
+        # the tools of the registry shared with Chat_Bot
+        self.tools = registry_tools()
 
         # Create prompt template
         self.prompt = ChatPromptTemplate.from_messages([
@@ -89,7 +140,8 @@ class LangChainBot(Chat_Bot):
             temperature=self.temperature,
             model=self.model_id,
             openai_api_key=utils.GENAI_API_KEY,
-            base_url=utils.GENAI_API_URL
+            base_url=utils.GENAI_API_URL,
+            streaming=True # tokens reach the callbacks of chat_stream as they are generated
         )
         agent = create_openai_tools_agent(llm, self.tools, self.prompt)
         
@@ -97,25 +149,34 @@ class LangChainBot(Chat_Bot):
         self.agent_executor = AgentExecutor(
             agent=agent,
             tools=self.tools,
+            max_iterations=tool_registry.MAX_TOOL_ITERATIONS + 1, # the tool rounds and the answer
             verbose=True
         )
 
+    def new_chat(self):
+        """start a new chat, i.e. clear chat history."""
+        self.chat_history = history.ChatHistory(self.history_budget)
+
     def search_chunks(self, query):
         """Search for relevant document chunks"""
-        docs = self.vectorstore.similarity_search(query, k=5)
-        docs.extend(get_first_n_chunks(self.vectorstore, 3))
+        # repeated questions are served from the query cache shared with Chat_Bot
+        query_embedding = embedding_cache.get_query_cache().embed(self.emb_model, [query],
+                                                                  self.embeddings.embed_documents)[0]
+        docs_and_distances = self.vectorstore.similarity_search_with_score_by_vector(query_embedding.tolist(), k=5)
+        docs = [doc for doc, _ in docs_and_distances]
+        # similarity in (0, 1], the higher the more relevant; the first chunks are pinned
+        scores = [1 / (1 + float(distance)) for _, distance in docs_and_distances]
+        first_chunks = get_first_n_chunks(self.vectorstore, 3)
+        docs.extend(first_chunks)
+        scores.extend([None] * len(first_chunks))
 
-        return "\n===\n".join([doc.page_content for doc in docs])
+        context, self.context_stats = context_packer.pack([doc.page_content for doc in docs], scores,
+                                                          self.model_id, self.context_budget, separator="\n===\n")
+        print("context:", self.context_stats)
+        return context
 
-    def chat(self, prompt, model=utils.CHAT_MODEL, temperature=0.3):
-        """
-        Chat with the bot using LangChain components
-        
-        Args:
-            prompt (str): user prompt or question
-            model (str): LLM model id
-            temperature (float): ranging from 0.0 to 2.0
-        """
+    def _prepare_chat(self, prompt, model, temperature):
+        """Retrieve the context and build the messages of the prompt"""
         # Get relevant context
         context = self.search_chunks(prompt)
         
@@ -131,46 +192,90 @@ class LangChainBot(Chat_Bot):
             {"role": "system", "content": self.system_prompt}
         ]
         
-        # Add chat history
-        if self.chat_history:
-            messages.extend([
-                {"role": msg.type, "content": msg.content}
-                for msg in self.chat_history
-            ])
+        # Add chat history, the summary of the earlier turns and the recent turns
+        messages.extend(self.chat_history)
         
         # Add current context and question
         messages.extend([
             {"role": "user", "content": full_prompt}
         ])
+        return messages
+
+    def _add_to_history(self, prompt, answer):
+        # Update chat history, older turns are folded into a summary in the background
+        self.chat_history.add(prompt, answer)
+        self.last_answer = answer
+
+    def chat(self, prompt, model=utils.CHAT_MODEL, temperature=0.3):
+        """
+        Chat with the bot using LangChain components
+        
+        Args:
+            prompt (str): user prompt or question
+            model (str): LLM model id
+            temperature (float): ranging from 0.0 to 2.0
+        """
+        messages = self._prepare_chat(prompt, model, temperature)
         
         # Initial agent run
         response = self._run_agent_with_tools(messages)
         
-        # Update chat history
-        self.chat_history.extend([
-            HumanMessage(content=prompt),
-            AIMessage(content=response)
-        ])
-        
-        # Keep only last 20 message pairs to prevent context from growing too large
-        if len(self.chat_history) > 20:
-            self.chat_history = self.chat_history[-20:]
-            
+        self._add_to_history(prompt, response)
         return response
 
-    def _run_agent_with_tools(self, messages):
+    def chat_stream(self, prompt, model=utils.CHAT_MODEL, temperature=0.3):
+        """Like chat, yielding the tokens of the LLM as they are streamed to the agent's callbacks.
+        The agent runs on a background thread, its final output is added to the chat history.
+        Args:
+            prompt (str): user prompt or question
+            model (str): LLM model id
+            temperature (float): ranging from 0.0 to 2.0
+        Yields:
+            str: the next piece of the answer. The tokens of the tool calling rounds are streamed too,
+            self.last_answer is the final answer once the generator is exhausted.
+        """
+        start = time.perf_counter()
+        self.last_answer = None
+        messages = self._prepare_chat(prompt, model, temperature)
+        tokens = queue.Queue()
+        result = {}
+        def run():
+            try:
+                result['output'] = self._run_agent_with_tools(messages, callbacks=[_TokenQueueCallback(tokens)])
+            except Exception as e:
+                result['error'] = e
+            finally:
+                tokens.put(None)
+        threading.Thread(target=run, daemon=True).start()
+
+        first_token = None
+        while (token := tokens.get()) is not None:
+            if first_token is None:
+                first_token = time.perf_counter()
+            yield token
+        if 'error' in result:
+            raise result['error']
+        if first_token is None:
+            # nothing was streamed, e.g. the answer came from the agent without an LLM call
+            yield result['output']
+        end = time.perf_counter()
+        self.stream_stats = {'ttft_ms': ((first_token or end) - start) * 1000, 'total_ms': (end - start) * 1000}
+        print("stream:", self.stream_stats)
+        self._add_to_history(prompt, result['output'])
+
+    def _run_agent_with_tools(self, messages, callbacks=None):
         """
         Run agent with recursive tool handling
         
         Args:
-            agent: The LangChain agent
             messages: List of conversation messages
+            callbacks: LangChain callback handlers of this run, e.g. to stream the tokens
         """
         # Invoke agent
         result = self.agent_executor.invoke({
             "input": messages[-1]["content"],
             "chat_history": messages[:-1]  # Exclude current message
-        })
+        }, config={"callbacks": callbacks} if callbacks else None)
         # print("result keys=", *result.keys(), sep=",")
         return result["output"]
         
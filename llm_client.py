@@ -0,0 +1,333 @@
+"""Resilient calls to the OpenAI-compatible endpoints.
+Every completion and embedding call goes through the policy of its call type: a deadline for the whole
+call, a timeout per attempt, retries with jittered exponential backoff (or the server's retry-after),
+optional hedging of short calls, and a circuit breaker per endpoint which fails fast while the endpoint
+keeps failing. The latency of each attempt is kept in a histogram per endpoint, see stats.
+"""
+import time
+import bisect
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import utils
+
+openai = utils.lazy_import('openai')
+
+BACKOFF_BASE = 0.5 # seconds, the first retry waits up to this, doubling with each retry
+BACKOFF_MAX = 30 # seconds
+BREAKER_WINDOW = 20 # last attempts of an endpoint whose failure rate is watched
+BREAKER_FAILURE_RATE = 0.5 # failure rate of the window opening the circuit
+BREAKER_MIN_FAILURES = 5 # failures in the window needed to open the circuit
+BREAKER_COOLDOWN = 30 # seconds the circuit stays open before a trial call
+HEDGE_MAX_WORKERS = 8 # hedged attempts running at once in the process
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+
+class CircuitOpenError(Exception):
+    """The endpoint kept failing, calls fail fast until its cooldown is over."""
+
+class DeadlineExceededError(TimeoutError):
+    """The call could not succeed within the deadline of its call type."""
+
+class CallPolicy():
+    """Timeouts, retries and hedging of one type of call."""
+    def __init__(self, deadline, attempt_timeout, max_retries, hedge_after=None):
+        """
+        Args:
+            deadline (float): seconds for the whole call, retries included.
+            attempt_timeout (float): seconds of one attempt.
+            max_retries (int): retries after the first attempt.
+            hedge_after (float): seconds after which a duplicate request is sent if the first one has not
+                answered, the first answer wins; None not to hedge. Only for short, idempotent calls.
+        """
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+
+POLICIES = {
+    'chat': CallPolicy(deadline=180, attempt_timeout=120, max_retries=2),
+    # until the stream starts, then each streamed chunk within the attempt timeout
+    'chat_stream': CallPolicy(deadline=90, attempt_timeout=60, max_retries=2),
+    # chat history summaries, in the background
+    'summary': CallPolicy(deadline=90, attempt_timeout=60, max_retries=2),
+    # document summaries, offline, long answers
+    'summarise': CallPolicy(deadline=900, attempt_timeout=300, max_retries=4),
+    # batches of chunks
+    'embed': CallPolicy(deadline=300, attempt_timeout=60, max_retries=5),
+    # the questions of a chat turn, on the critical path
+    'embed_query': CallPolicy(deadline=20, attempt_timeout=5, max_retries=3, hedge_after=1.0),
+}
+
+def _retryable(error):
+    """Errors of the endpoint or the network, worth another attempt."""
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in (408, 409)
+
+def backoff(error, attempt):
+    """Seconds to wait before retrying a failed request: the server's retry-after header when
+    present, otherwise exponential backoff with full jitter, so that clients do not retry in step."""
+    response = getattr(error, 'response', None)
+    headers = response.headers if response is not None else {}
+    try:
+        if headers.get('retry-after-ms'):
+            return min(float(headers['retry-after-ms']) / 1000, BACKOFF_MAX)
+        if headers.get('retry-after'):
+            return min(float(headers['retry-after']), BACKOFF_MAX)
+    except ValueError:
+        pass
+    return random.uniform(0, min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX))
+
+class Endpoint():
+    """Circuit breaker and latency histogram of one endpoint, e.g. the chat completions of a model."""
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.attempts = 0
+        self.errors = 0
+        self.retries = 0
+        self.hedges = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=BREAKER_WINDOW) # True for the failed attempts
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """False while the circuit is open. After the cooldown one trial call goes through,
+        its success closes the circuit, its failure opens it again."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+                self._trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, latency_ms, error=None):
+        with self._lock:
+            self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+            self.attempts += 1
+            if error is not None:
+                self.errors += 1
+            # errors of the request, e.g. 400, mean the endpoint answered
+            failed = error is not None and _retryable(error)
+            if self._trial:
+                self._trial = False
+                if not failed:
+                    self.opened_at = None
+                    self._outcomes.clear()
+                    return
+                self.opened_at = time.monotonic()
+                return
+            self._outcomes.append(failed)
+            failures = sum(self._outcomes)
+            if self.opened_at is None and failures >= BREAKER_MIN_FAILURES and \
+                    failures >= BREAKER_FAILURE_RATE * len(self._outcomes):
+                print(f"circuit of {self.name} open after {failures} failures of {len(self._outcomes)} attempts")
+                self.opened_at = time.monotonic()
+
+    def count(self, key):
+        with self._lock:
+            setattr(self, key, getattr(self, key) + 1)
+
+    def percentile(self, q):
+        """Upper bound in ms of the latency bucket of the q-th percentile, inf above the last bucket."""
+        total = sum(self.counts)
+        if not total:
+            return None
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS + (float('inf'),), self.counts):
+            cumulative += count
+            if cumulative >= q / 100 * total:
+                return bound
+
+    def stats(self):
+        with self._lock:
+            state = 'closed' if self.opened_at is None else 'half-open' if self._trial else 'open'
+            histogram = {f'<={bound}' if bound != float('inf') else f'>{LATENCY_BUCKETS_MS[-1]}': count
+                         for bound, count in zip(LATENCY_BUCKETS_MS + (float('inf'),), self.counts) if count}
+            report = {'attempts': self.attempts, 'errors': self.errors, 'retries': self.retries,
+                      'hedges': self.hedges, 'rejected': self.rejected, 'state': state}
+        report.update({f'p{q}_ms': self.percentile(q) for q in (50, 95, 99)})
+        report['histogram'] = histogram
+        return report
+
+_endpoints = {}
+_lock = threading.Lock()
+_clients = {}
+_executor = None
+
+def endpoint(name):
+    """Return the process-wide Endpoint of the name, created on first use."""
+    with _lock:
+        if name not in _endpoints:
+            _endpoints[name] = Endpoint(name)
+        return _endpoints[name]
+
+def stats():
+    """Attempts, errors, retries, hedges, circuit state and latency percentiles of each endpoint."""
+    with _lock:
+        endpoints = list(_endpoints.values())
+    return {e.name: e.stats() for e in endpoints}
+
+def reset():
+    """Forget the endpoints: their circuits close and their histograms start empty."""
+    with _lock:
+        _endpoints.clear()
+
+def _client(use_async=False):
+    # the OpenAI clients of utils, without their own retries
+    base = utils.async_client if use_async else utils.client
+    with _lock:
+        if use_async not in _clients or _clients[use_async][0] is not base:
+            _clients[use_async] = (base, base.with_options(max_retries=0))
+        return _clients[use_async][1]
+
+def get_executor():
+    """Return the process-wide thread pool running the hedged attempts."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix='hedge')
+        return _executor
+
+def _attempt(ep, request, timeout):
+    client = _client()
+    start = time.perf_counter()
+    try:
+        result = request(client, timeout)
+    except Exception as e:
+        ep.record((time.perf_counter() - start) * 1000, e)
+        raise
+    ep.record((time.perf_counter() - start) * 1000)
+    return result
+
+def _hedged(ep, request, timeout, hedge_after):
+    futures = [get_executor().submit(_attempt, ep, request, timeout)]
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done:
+        ep.count('hedges')
+        futures.append(get_executor().submit(_attempt, ep, request, timeout - hedge_after))
+    # the first answer wins, the other attempt finishes in the background
+    pending = set(futures)
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+def call(call_type, name, request):
+    """Make the request within the policy of the call type.
+    Args:
+        call_type (str): key of POLICIES.
+        name (str): endpoint name, for its circuit breaker and latency histogram.
+        request: function(client, timeout) making one attempt with the OpenAI client.
+    Returns:
+        the result of the first successful attempt.
+    Raises:
+        CircuitOpenError when the endpoint is failing, DeadlineExceededError when the next retry
+        would end after the deadline, or the error of the last attempt.
+    """
+    policy = POLICIES[call_type]
+    ep = endpoint(name)
+    deadline = time.monotonic() + policy.deadline
+    for attempt in range(policy.max_retries + 1):
+        if not ep.allow():
+            raise CircuitOpenError(f"{name} is failing, retry after {BREAKER_COOLDOWN}s")
+        timeout = min(policy.attempt_timeout, deadline - time.monotonic())
+        try:
+            if policy.hedge_after is not None and policy.hedge_after < timeout:
+                return _hedged(ep, request, timeout, policy.hedge_after)
+            return _attempt(ep, request, timeout)
+        except Exception as e:
+            if not _retryable(e) or attempt == policy.max_retries:
+                raise
+            delay = backoff(e, attempt)
+            if time.monotonic() + delay >= deadline:
+                raise DeadlineExceededError(f"{name} failed within its {policy.deadline}s deadline: {e}") from e
+            ep.count('retries')
+            print(f"{name} failed ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s")
+            time.sleep(delay)
+
+async def _aattempt(ep, request, timeout):
+    client = _client(use_async=True)
+    start = time.perf_counter()
+    try:
+        result = await request(client, timeout)
+    except Exception as e:
+        ep.record((time.perf_counter() - start) * 1000, e)
+        raise
+    ep.record((time.perf_counter() - start) * 1000)
+    return result
+
+async def _ahedged(ep, request, timeout, hedge_after):
+    tasks = [asyncio.ensure_future(_aattempt(ep, request, timeout))]
+    done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+    if not done:
+        ep.count('hedges')
+        tasks.append(asyncio.ensure_future(_aattempt(ep, request, timeout - hedge_after)))
+    # the first answer wins, the other attempt is cancelled
+    pending = set(tasks)
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+    raise error
+
+async def acall(call_type, name, request):
+    """call awaited from asyncio, request being a coroutine function(client, timeout) on the asyncio client."""
+    policy = POLICIES[call_type]
+    ep = endpoint(name)
+    deadline = time.monotonic() + policy.deadline
+    for attempt in range(policy.max_retries + 1):
+        if not ep.allow():
+            raise CircuitOpenError(f"{name} is failing, retry after {BREAKER_COOLDOWN}s")
+        timeout = min(policy.attempt_timeout, deadline - time.monotonic())
+        try:
+            if policy.hedge_after is not None and policy.hedge_after < timeout:
+                return await _ahedged(ep, request, timeout, policy.hedge_after)
+            return await _aattempt(ep, request, timeout)
+        except Exception as e:
+            if not _retryable(e) or attempt == policy.max_retries:
+                raise
+            delay = backoff(e, attempt)
+            if time.monotonic() + delay >= deadline:
+                raise DeadlineExceededError(f"{name} failed within its {policy.deadline}s deadline: {e}") from e
+            ep.count('retries')
+            print(f"{name} failed ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+def chat_completion(call_type='chat', **kwargs):
+    """client.chat.completions.create(**kwargs) within the policy of the call type.
+    A streamed completion is retried until the stream starts."""
+    return call(call_type, f"chat.completions:{kwargs.get('model')}",
+                lambda client, timeout: client.chat.completions.create(timeout=timeout, **kwargs))
+
+def embeddings(call_type='embed', **kwargs):
+    """client.embeddings.create(**kwargs) within the policy of the call type."""
+    return call(call_type, f"embeddings:{kwargs.get('model')}",
+                lambda client, timeout: client.embeddings.create(timeout=timeout, **kwargs))
+
+async def achat_completion(call_type='chat', **kwargs):
+    """chat_completion on the asyncio client."""
+    return await acall(call_type, f"chat.completions:{kwargs.get('model')}",
+                       lambda client, timeout: client.chat.completions.create(timeout=timeout, **kwargs))
+
+async def aembeddings(call_type='embed', **kwargs):
+    """embeddings on the asyncio client."""
+    return await acall(call_type, f"embeddings:{kwargs.get('model')}",
+                       lambda client, timeout: client.embeddings.create(timeout=timeout, **kwargs))
@@ -0,0 +1,154 @@
+import os
+import copy
+import threading
+import numpy as np
+import embedder
+import bm25
+from chunk_store import ChunkStore
+
+RRF_K = 60 # reciprocal rank fusion constant, dampens the weight of the top ranks
+HYBRID_CANDIDATES = 20 # number of candidates of each retriever fused by hybrid_search
+
+class Memory():
+    """A memory directory opened for searching: FAISS index, BM25 index, chunks and
+    the settings needed to bring query vectors into its vector space."""
+    def __init__(self, path):
+        self.path = path
+        self.manifest = embedder.read_manifest(path)
+        self.metric = self.manifest.get('metric', 'l2')
+        # the shared common memory this memory is searched together with, if any
+        self.common_path = self.manifest.get('common')
+        self.embeddings = np.load(f'{path}/embeddings.npy', mmap_mode='r')
+        self.chunks = ChunkStore(path)
+        self.index, _ = embedder.load_index(path, mmap=True)
+        self.pca = embedder.load_pca(path)
+        self.bm25 = bm25.load_or_build(path, self.chunks)
+
+    def search(self, query_embeddings, k=5):
+        """Search the memory with query vectors as returned by the embedding model.
+        Returns:
+            scores: (len(queries), k) scores, the higher the more similar
+            ids: (len(queries), k) chunk ids, -1 when there are fewer than k chunks
+        """
+        vectors = query_embeddings if self.pca is None else \
+            self.pca.apply(np.ascontiguousarray(query_embeddings, dtype=np.float32))
+        distances, ids = self.index.search(embedder.prepare_vectors(vectors, self.metric), k)
+        return (distances if self.metric == 'ip' else -distances), ids
+
+    def with_pca(self, pca):
+        """This memory searched in the PCA space of another memory, so that the scores of both can be merged.
+        Its vectors are projected and indexed in RAM, for small memories such as the common memory."""
+        sq_params_path = f'{self.path}/{embedder.SQ_PARAMS_FILE}'
+        vectors = embedder.decode_vectors(np.asarray(self.embeddings),
+                                          np.load(sq_params_path) if os.path.exists(sq_params_path) else None)
+        projected = copy.copy(self)
+        projected.pca = pca
+        projected.embeddings = pca.apply(np.ascontiguousarray(vectors))
+        projected.index = embedder.Embedder.create_faiss_index(projected.embeddings, 'flat', self.metric)
+        return projected
+
+def search_memories_batch(memories, query_embeddings, k=5, skip=None):
+    """Search several memories of the same metric with all the query vectors, one FAISS call per memory.
+    Args:
+        memories: list of Memory.
+        query_embeddings: query vectors as returned by the embedding model.
+        k (int): number of results per query.
+        skip: function(memory, chunk_id) returning True for chunks to leave out of the results.
+    Returns:
+        for each query, list of (score, memory, chunk_id), best first.
+    """
+    results = [[] for _ in range(len(query_embeddings))]
+    for m in memories:
+        # leave room for the skipped chunks
+        scores, ids = m.search(query_embeddings, 2 * k if skip else k)
+        for query_results, query_scores, query_ids in zip(results, scores, ids):
+            query_results += [(score, m, int(i)) for score, i in zip(query_scores, query_ids)
+                              if i >= 0 and not (skip and skip(m, i))]
+    for query_results in results:
+        query_results.sort(key=lambda r: r[0], reverse=True)
+        del query_results[k:]
+    return results
+
+def search_memories(memories, query_embeddings, k=5, skip=None):
+    """Search several memories of the same metric and merge the results of the first query,
+    see search_memories_batch."""
+    return search_memories_batch(memories, query_embeddings[:1], k, skip)[0]
+
+def reciprocal_rank_fusion(rankings, rrf_k=RRF_K):
+    """Fuse rankings of the same items, scoring each item sum(1 / (rrf_k + rank)).
+    Args:
+        rankings: list of rankings, each a list of items best first.
+    Returns:
+        list of (score, item), best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(((score, item) for item, score in scores.items()), key=lambda r: r[0], reverse=True)
+
+def lexical_search(memories, query, k=5, skip=None):
+    """BM25 search of the query text over several memories, merged by score.
+    Returns:
+        list of (score, memory, chunk_id), best first.
+    """
+    results = []
+    for m in memories:
+        scores, ids = m.bm25.search(query, 2 * k if skip else k)
+        results += [(float(score), m, int(i)) for score, i in zip(scores, ids) if not (skip and skip(m, i))]
+    results.sort(key=lambda r: r[0], reverse=True)
+    return results[:k]
+
+def hybrid_search(memories, queries, query_embeddings=None, k=5, skip=None, lexical=True,
+                  candidates=HYBRID_CANDIDATES):
+    """Fuse the vector search and the BM25 search of all the queries with reciprocal rank fusion.
+    Args:
+        memories: list of Memory.
+        queries: list of query texts for the BM25 search.
+        query_embeddings: vectors of the queries as returned by the embedding model, 
+            None to search the BM25 index only.
+        k (int): number of results.
+        skip: function(memory, chunk_id) returning True for chunks to leave out of the results.
+        lexical (bool): include the BM25 search, False for the vector search only.
+        candidates (int): number of results of each search to fuse.
+    Returns:
+        results: list of (score, memory, chunk_id), best first.
+        query_results: for each query, its own top k (memory, chunk_id), to measure what each query adds.
+    """
+    query_rankings = [[] for _ in queries]
+    if lexical:
+        for rankings, query in zip(query_rankings, queries):
+            rankings.append([(m, i) for _, m, i in lexical_search(memories, query, candidates, skip)])
+    if query_embeddings is not None:
+        for rankings, results in zip(query_rankings, search_memories_batch(memories, query_embeddings, candidates, skip)):
+            rankings.append([(m, i) for _, m, i in results])
+    fused = reciprocal_rank_fusion([r for rankings in query_rankings for r in rankings])
+    query_results = [[item for _, item in reciprocal_rank_fusion(rankings)[:k]] for rankings in query_rankings]
+    return [(score, m, i) for score, (m, i) in fused[:k]], query_results
+
+_shared = {}
+_shared_lock = threading.Lock()
+_path_locks = {} # memories are loaded outside _shared_lock, one at a time per path
+
+def get_shared(path):
+    """Return the process-wide Memory of the path, loading it on first use.
+    Loading a memory does not hold up the threads using or loading other memories."""
+    key = os.path.normcase(os.path.abspath(path))
+    with _shared_lock:
+        if key in _shared:
+            return _shared[key]
+        path_lock = _path_locks.setdefault(key, threading.Lock())
+    with path_lock:
+        with _shared_lock:
+            if key in _shared:
+                return _shared[key]
+        loaded = Memory(path)
+        with _shared_lock:
+            _shared[key] = loaded
+        return loaded
+
+def release_shared(path):
+    """Drop the process-wide Memory of the path, it is loaded again on next use."""
+    key = os.path.normcase(os.path.abspath(path))
+    with _shared_lock:
+        _shared.pop(key, None)
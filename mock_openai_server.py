@@ -0,0 +1,196 @@
+"""Local mock of the OpenAI-compatible endpoints used by the bots, for benchmarks without the GenAI API.
+Chat completions answer after a fixed latency, streamed or not; embeddings are deterministic
+random vectors of the text. Prompt caching is simulated: the longest prefix of the prompt already seen,
+in blocks of PROMPT_CACHE_BLOCK tokens, is reported in usage.prompt_tokens_details.cached_tokens.
+Faults can be injected: a share of the requests fail (500), are rate limited (429 with retry-after-ms)
+or are answered slowly, to test the retries, hedging and circuit breaking of llm_client.
+Usage:
+    python mock_openai_server.py --port 8765 --latency-ms 500
+    python mock_openai_server.py --error-rate 0.1 --rate-limit-rate 0.05 --slow-rate 0.05 --slow-ms 5000
+    python benchmark.py concurrency --mem-path ./memory/dare --url http://127.0.0.1:8765
+"""
+import json
+import time
+import random
+import zlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+DEFAULT_PORT = 8765
+DEFAULT_LATENCY_MS = 500 # time to the whole answer
+DEFAULT_EMBEDDING_DIM = 3072 # text-embedding-3-large
+STREAM_PIECES = 20 # a streamed answer is sent in this many pieces over the latency
+CHARS_PER_TOKEN = 4
+PROMPT_CACHE_MIN_TOKENS = 1024 # shorter prompts are not cached, like the OpenAI prompt cache
+PROMPT_CACHE_BLOCK = 128 # tokens
+RETRY_AFTER_MS = 200 # of the rate limited requests
+ANSWER = "DARE is the data warehouse of the merchant acquiring business."
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real endpoint
+
+    def log_message(self, format, *args):
+        pass
+
+    def _path(self):
+        # the bots use the base url with or without /v1
+        path = self.path.split('?')[0]
+        return path[3:] if path.startswith('/v1/') else path
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self._path() == '/models':
+            self._send_json({'object': 'list', 'data': [{'id': self.server.model, 'object': 'model'}]})
+        else:
+            self._send_json({'error': {'message': f'not found: {self.path}'}}, 404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with self.server.lock:
+            self.server.requests += 1
+        fault = self.server.fault()
+        if fault == 'error':
+            self._send_json({'error': {'message': 'injected server error', 'type': 'server_error'}}, 500)
+            return
+        if fault == 'rate_limit':
+            self._send_json({'error': {'message': 'injected rate limit', 'type': 'rate_limit_error'}}, 429,
+                            {'retry-after-ms': str(RETRY_AFTER_MS)})
+            return
+        if fault == 'slow':
+            time.sleep(self.server.slow_ms / 1000)
+        if self._path() == '/embeddings':
+            self._embeddings(request)
+        elif self._path() == '/chat/completions':
+            self._chat_completions(request)
+        else:
+            self._send_json({'error': {'message': f'not found: {self.path}'}}, 404)
+
+    def _embeddings(self, request):
+        texts = request['input'] if isinstance(request['input'], list) else [request['input']]
+        dim = request.get('dimensions') or self.server.embedding_dim
+        data = [{'object': 'embedding', 'index': i,
+                 'embedding': np.random.default_rng(zlib.crc32(t.encode('utf-8'))).standard_normal(dim).tolist()}
+                for i, t in enumerate(texts)]
+        self._send_json({'object': 'list', 'data': data, 'model': request.get('model'),
+                         'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+
+    def _chat_completions(self, request):
+        created = int(time.time())
+        answer = self.server.answer
+        # the tools come first in the prompt, then the messages
+        prompt = json.dumps(request.get('tools', [])) + json.dumps(request['messages'])
+        usage = {'prompt_tokens': len(prompt) // CHARS_PER_TOKEN, 'completion_tokens': len(answer) // CHARS_PER_TOKEN,
+                 'prompt_tokens_details': {'cached_tokens': self.server.cached_tokens(request['model'], prompt)}}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        if not request.get('stream'):
+            time.sleep(self.server.latency)
+            self._send_json({'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': created,
+                             'model': request['model'], 'usage': usage,
+                             'choices': [{'index': 0, 'finish_reason': 'stop',
+                                          'message': {'role': 'assistant', 'content': answer}}]})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        step = max(1, len(answer) // STREAM_PIECES)
+        pieces = [answer[i:i+step] for i in range(0, len(answer), step)]
+        for i, piece in enumerate(pieces):
+            time.sleep(self.server.latency / len(pieces))
+            self._send_event({'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': created,
+                              'model': request['model'],
+                              'choices': [{'index': 0, 'delta': {'content': piece},
+                                           'finish_reason': 'stop' if i == len(pieces) - 1 else None}]})
+        if (request.get('stream_options') or {}).get('include_usage'):
+            self._send_event({'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': created,
+                              'model': request['model'], 'choices': [], 'usage': usage})
+        self._send_event('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _send_event(self, data):
+        event = f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n".encode('utf-8')
+        self.wfile.write(f'{len(event):x}\r\n'.encode('ascii') + event + b'\r\n')
+        self.wfile.flush()
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # hundreds of sessions connect at once
+
+    def __init__(self, port=DEFAULT_PORT, latency_ms=DEFAULT_LATENCY_MS, embedding_dim=DEFAULT_EMBEDDING_DIM,
+                 model='mock-model', answer=ANSWER, error_rate=0.0, rate_limit_rate=0.0, slow_rate=0.0,
+                 slow_ms=5000, seed=0):
+        super().__init__(('127.0.0.1', port), MockOpenAIHandler)
+        self.latency = latency_ms / 1000
+        self.embedding_dim = embedding_dim
+        self.model = model
+        self.answer = answer
+        # shares of the requests failing, rate limited, answered slowly; can be changed while serving
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.faults = {'error': 0, 'rate_limit': 0, 'slow': 0}
+        self._random = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+        self._prefixes = set() # hashes of the cached prompt prefixes, by model
+
+    def fault(self):
+        """The fault injected into the next request: 'error', 'rate_limit', 'slow' or None."""
+        with self.lock:
+            x = self._random.random()
+            for fault, rate in (('error', self.error_rate), ('rate_limit', self.rate_limit_rate),
+                                ('slow', self.slow_rate)):
+                if x < rate:
+                    self.faults[fault] += 1
+                    return fault
+                x -= rate
+        return None
+
+    def cached_tokens(self, model, prompt):
+        """Tokens of the longest cached prefix of the prompt, and cache the prefixes of this prompt."""
+        block = PROMPT_CACHE_BLOCK * CHARS_PER_TOKEN
+        ends = range(PROMPT_CACHE_MIN_TOKENS * CHARS_PER_TOKEN, len(prompt) + 1, block)
+        keys = [(model, zlib.crc32(prompt[:end].encode('utf-8')), end) for end in ends]
+        with self.lock:
+            cached = max((key[2] for key in keys if key in self._prefixes), default=0)
+            self._prefixes.update(keys)
+        return cached // CHARS_PER_TOKEN
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+def start(port=0, **kwargs):
+    """Start the mock server on a background thread, port 0 for any free port.
+    Returns:
+        the server, its url in server.url; stop it with server.shutdown()."""
+    server = MockOpenAIServer(port, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="mock OpenAI-compatible server")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency-ms', type=int, default=DEFAULT_LATENCY_MS)
+    parser.add_argument('--dim', type=int, default=DEFAULT_EMBEDDING_DIM, help='dimensions of the embeddings')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of the requests failing with 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of the requests failing with 429')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='share of the requests answered slowly')
+    parser.add_argument('--slow-ms', type=int, default=5000, help='extra latency of the slow requests')
+    args = parser.parse_args()
+    server = MockOpenAIServer(args.port, args.latency_ms, args.dim, error_rate=args.error_rate,
+                              rate_limit_rate=args.rate_limit_rate, slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    print(f"mock OpenAI server on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,92 @@
+"""Page-parallel PDF text extraction.
+Page ranges are extracted in worker processes and streamed back in page order.
+The extracted pages are cached per file content hash, so a PDF is only extracted once.
+"""
+import os
+import json
+from bisect import bisect_right
+from itertools import accumulate
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import utils
+
+fitz = utils.lazy_import('fitz')
+
+TEXT_CACHE_PATH = './input/.text_cache'
+PAGES_PER_TASK = 16
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+def _extract_range(pdf_path, start, end):
+    with fitz.open(pdf_path) as doc:
+        return [doc[i].get_text() for i in range(start, end)]
+
+def _cache_path(pdf_path):
+    return f'{TEXT_CACHE_PATH}/{utils.get_file_hash(pdf_path)}.json'
+
+def _save_cache(cache_path, pages):
+    try:
+        os.makedirs(TEXT_CACHE_PATH, exist_ok=True)
+        with open(f'{cache_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(pages, f)
+        os.replace(f'{cache_path}.tmp', cache_path)
+    except OSError as e:
+        print(f"Error saving extracted text {cache_path}: {e}")
+
+def iter_pages(pdf_path, workers=DEFAULT_WORKERS, use_cache=True):
+    """Yield (page_number, text) of the PDF in page order, page numbers starting from 1.
+    Args:
+        pdf_path (str): file path and file name of the PDF file.
+        workers (int): number of extraction processes, 1 to extract in this process.
+        use_cache (bool): read / save the extracted pages from / into the text cache.
+    """
+    cache_path = _cache_path(pdf_path) if use_cache else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            yield from enumerate(json.load(f), 1)
+        return
+
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+    ranges = [(start, min(start + PAGES_PER_TASK, page_count)) for start in range(0, page_count, PAGES_PER_TASK)]
+    pages = []
+    if workers > 1 and len(ranges) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+            # keep twice as many ranges in flight as workers, yield them in order
+            pending = deque()
+            for start, end in ranges:
+                pending.append(executor.submit(_extract_range, pdf_path, start, end))
+                if len(pending) >= 2 * workers:
+                    for text in pending.popleft().result():
+                        pages.append(text)
+                        yield len(pages), text
+            while pending:
+                for text in pending.popleft().result():
+                    pages.append(text)
+                    yield len(pages), text
+    else:
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                pages.append(page.get_text())
+                yield len(pages), pages[-1]
+
+    if cache_path:
+        _save_cache(cache_path, pages)
+
+def extract_pages(pdf_path, workers=DEFAULT_WORKERS, use_cache=True):
+    """Return the list of the page texts of the PDF."""
+    return [text for _, text in iter_pages(pdf_path, workers, use_cache)]
+
+def extract_text(pdf_path, workers=DEFAULT_WORKERS, use_cache=True):
+    """Return the text of the PDF, i.e. the text of all its pages joined together."""
+    return "".join(extract_pages(pdf_path, workers, use_cache))
+
+def page_ranges(pages, starts, lengths):
+    """Return the (first page, last page) of each chunk of the joined page texts.
+    Args:
+        pages: list of page texts.
+        starts: start offset of each chunk in the joined text.
+        lengths: length of each chunk.
+    """
+    page_starts = list(accumulate((len(p) for p in pages[:-1]), initial=0))
+    return [(bisect_right(page_starts, start), bisect_right(page_starts, start + max(length, 1) - 1))
+            for start, length in zip(starts, lengths)]
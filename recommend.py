@@ -1,44 +1,37 @@
-import joblib
-import json
-import pandas as pd
+import threading
 import numpy as np
-from langchain.tools import tool
-from typing import List
+import utils
 
-file_path = './memory/recom'
-product_cp_pipeline = joblib.load(f'{file_path}/product_cp_prediction_model.pkl')
-product_cp_label_encoder = joblib.load(f'{file_path}/prod_cp_label_encoder.pkl')
-
-product_cnp_pipeline = joblib.load(f'{file_path}/product_cnp_prediction_model.pkl')
-product_cnp_label_encoder = joblib.load(f'{file_path}/prod_cnp_label_encoder.pkl')
-
-price_pipeline = joblib.load(f'{file_path}/price_prediction_model.pkl')
-price_label_encoder = joblib.load(f'{file_path}/price_label_encoder.pkl')
-
-@tool
-def recommend_product_wrapper(cp_cnp: str, mis_division: str, mcc: int, postcode: int, revenue: float) -> List[str]:
-    """
-    Recomend merchant product(s) based on input criteria
-    Args:
-        cp_cnp: whether the product should be CP/Card Present or CNP/Card Not Present/eComm
-        mis_division: the market division. Valid values are RBS, BB, IB&M
-        mcc: MCC / Merchant Category Code
-        postcode: postcode of trading address
-        revenue: monthly revenue / ternover in AUD
+joblib = utils.lazy_import('joblib')
+pd = utils.lazy_import('pandas')
 
-    Returns:
-        A list of product codes in order of high-to-low propability for recommendation.
-    """
-    kwargs = locals()
-    return recommend_product(**kwargs)
+file_path = './memory/recom'
+_models = None
+_models_lock = threading.Lock()
+
+def get_models():
+    """Load the prediction models and label encoders on first use, only the product bots need them."""
+    global _models
+    with _models_lock:
+        if _models is None:
+            _models = {
+                'product_cp_pipeline': joblib.load(f'{file_path}/product_cp_prediction_model.pkl'),
+                'product_cp_label_encoder': joblib.load(f'{file_path}/prod_cp_label_encoder.pkl'),
+                'product_cnp_pipeline': joblib.load(f'{file_path}/product_cnp_prediction_model.pkl'),
+                'product_cnp_label_encoder': joblib.load(f'{file_path}/prod_cnp_label_encoder.pkl'),
+                'price_pipeline': joblib.load(f'{file_path}/price_prediction_model.pkl'),
+                'price_label_encoder': joblib.load(f'{file_path}/price_label_encoder.pkl'),
+            }
+        return _models
 
 def recommend_product(cp_cnp, mis_division, mcc, postcode, revenue):
+    models = get_models()
     if cp_cnp=='CP':
-        prod_pipeline = product_cp_pipeline
-        prod_encoder = product_cp_label_encoder
+        prod_pipeline = models['product_cp_pipeline']
+        prod_encoder = models['product_cp_label_encoder']
     else:
-        prod_pipeline = product_cnp_pipeline
-        prod_encoder = product_cnp_label_encoder
+        prod_pipeline = models['product_cnp_pipeline']
+        prod_encoder = models['product_cnp_label_encoder']
 
     new_data = pd.DataFrame({
         'MIS_DIVISION': [mis_division],
@@ -54,23 +47,6 @@ def recommend_product(cp_cnp, mis_division, mcc, postcode, revenue):
     # print(prod_codes)
     return prod_codes
 
-@tool
-def recommend_pricing_wrapper(product_code: str, mis_division: str, mcc: int, postcode: int, revenue: float) -> str:
-    """
-    Recomend merchant pricing based on input criteria
-    Args:
-        product_code: merchant product code
-        mis_division: the market division. Valid values are RBS, BB, IB&M
-        mcc: MCC / Merchant Category Code
-        postcode: postcode of trading address
-        revenue: monthly revenue / ternover in AUD
-
-    Returns:
-        The recommended pricing plan.
-    """
-    kwargs = locals()
-    return recommend_pricing(**kwargs)
-
 def recommend_pricing(product_code, mis_division, mcc, postcode, revenue):
     new_data = pd.DataFrame({
         'PRODUCT_CODE': [product_code],
@@ -79,6 +55,7 @@ def recommend_pricing(product_code, mis_division, mcc, postcode, revenue):
         'tpcode': [postcode],
         'NET_REVENUE': [revenue]
     })
-    predictions = price_pipeline.predict(new_data)
-    pricing = price_label_encoder.inverse_transform(predictions)
+    models = get_models()
+    predictions = models['price_pipeline'].predict(new_data)
+    pricing = models['price_label_encoder'].inverse_transform(predictions)
     return pricing
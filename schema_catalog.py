@@ -0,0 +1,238 @@
+"""Local catalog of the DARE tables and their columns.
+The catalog is extracted once, from the database INFORMATION_SCHEMA when it is reachable or from the
+data dictionary summaries in ./input/summary, and saved into a JSON file. The get_table_columns tool
+answers from it without a database round-trip.
+Usage:
+    python schema_catalog.py refresh
+    python schema_catalog.py refresh --source summaries
+    python schema_catalog.py columns dbo.merchant
+"""
+import os
+import re
+import json
+import time
+import argparse
+import difflib
+import threading
+from pathlib import Path
+
+CATALOG_PATH = './memory/schema_catalog.json'
+SUMMARY_PATH = './input/summary'
+SOURCES = ('auto', 'db', 'summaries')
+MAX_SUGGESTIONS = 5
+SCHEMA_QUERY = """SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, IS_NULLABLE
+                  FROM INFORMATION_SCHEMA.COLUMNS ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION"""
+SCHEMA_MAX_COLUMNS = 1000000
+_IDENTIFIER = r'[A-Za-z_][A-Za-z0-9_]*'
+
+def normalise_name(name):
+    """Lower-cased table name without brackets / quotes and without the database name."""
+    name = re.sub(r'[\[\]"`\s]', '', name).lower()
+    parts = name.split('.')
+    return '.'.join(parts[-2:])
+
+def _data_type(data_type, max_length):
+    if max_length is None or max_length != max_length: # None or NaN
+        return data_type
+    return f"{data_type}({'max' if int(max_length) == -1 else int(max_length)})"
+
+def columns_from_db():
+    """Read the tables and columns from the database INFORMATION_SCHEMA.
+    Returns:
+        dict of table name -> list of [column name, data type, description]
+    """
+    import db_utils
+    db = db_utils.DbUtil()
+    try:
+        df = db.execute(SCHEMA_QUERY, fetch_size=SCHEMA_MAX_COLUMNS)
+    finally:
+        db.clean_up()
+    tables = {}
+    for row in df.itertuples(index=False):
+        data_type = _data_type(row.DATA_TYPE, row.CHARACTER_MAXIMUM_LENGTH)
+        nullable = ' null' if row.IS_NULLABLE == 'YES' else ''
+        tables.setdefault(f'{row.TABLE_SCHEMA}.{row.TABLE_NAME}', []).append([row.COLUMN_NAME, data_type+nullable, ''])
+    return tables
+
+def _split_row(line):
+    return [cell.strip().strip('*`').strip() for cell in line.strip().strip('|').split('|')]
+
+def parse_summary(text):
+    """Extract [column name, data type, description] from a data dictionary summary.
+    Columns are read from markdown tables with a column name header and from bullet lists like
+    '- **column_name** (varchar): description'.
+    """
+    columns = []
+    header = None
+    for line in text.splitlines():
+        if not line.strip().startswith('|'):
+            header = None
+            bullet = re.match(rf'\s*[-*]\s+[*`]*({_IDENTIFIER})[*`]*\s*(?:\(([^)]*)\))?\s*[:\-–]\s*(.*)', line)
+            if bullet and ('_' in bullet.group(1) or bullet.group(2)):
+                columns.append([bullet.group(1), bullet.group(2) or '', bullet.group(3).strip()])
+            continue
+        cells = _split_row(line)
+        if header is None:
+            lower = [c.lower() for c in cells]
+            name_col = next((i for i, c in enumerate(lower) if 'column' in c or c in ('name', 'field')), None)
+            header = None if name_col is None else {
+                'name': name_col,
+                'type': next((i for i, c in enumerate(lower) if 'type' in c), None),
+                'description': next((i for i, c in enumerate(lower) if 'description' in c or 'meaning' in c), None)}
+            continue
+        if set(''.join(cells)) <= set('-: '):
+            continue # separator row
+        def cell(key):
+            i = header[key]
+            return cells[i] if i is not None and i < len(cells) else ''
+        if re.fullmatch(_IDENTIFIER, cell('name')):
+            columns.append([cell('name'), cell('type'), cell('description')])
+    # keep the first occurrence of each column
+    seen = set()
+    return [c for c in columns if not (c[0].lower() in seen or seen.add(c[0].lower()))]
+
+def table_name_from_summary(file_path):
+    """The table name of a summary file, derived from the file name like the Summariser does:
+    <document>-<table name>[-...].txt, e.g. DARE-dbo.merchant_fee.txt -> dbo.merchant_fee."""
+    parts = Path(file_path).stem.split('-')
+    return parts[1] if len(parts) > 1 and parts[1] else parts[0]
+
+def columns_from_summaries(summary_path=SUMMARY_PATH):
+    """Read the tables and columns from the data dictionary summaries, one file per table.
+    Returns:
+        dict of table name -> list of [column name, data type, description]
+    """
+    tables = {}
+    for file_path in sorted(Path(summary_path).glob('*.txt')):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            columns = parse_summary(f.read())
+        if columns:
+            # several summaries of a table, e.g. of its versions, add up
+            table = tables.setdefault(table_name_from_summary(file_path), [])
+            seen = {c[0].lower() for c in table}
+            table.extend(c for c in columns if c[0].lower() not in seen)
+    return tables
+
+class SchemaCatalog():
+    """Tables and columns of the database, looked up by table name with or without schema."""
+    def __init__(self, tables=None, source=None, created=None):
+        self.tables = tables or {}
+        self.source = source
+        self.created = created
+        self._by_name = {}
+        self._by_table = {}
+        for name in self.tables:
+            key = normalise_name(name)
+            self._by_name[key] = name
+            self._by_table.setdefault(key.split('.')[-1], []).append(name)
+
+    @classmethod
+    def load(cls, path=CATALOG_PATH):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['tables'], data.get('source'), data.get('created'))
+
+    def save(self, path=CATALOG_PATH):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'source': self.source, 'created': self.created, 'tables': self.tables}, f)
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def extract(cls, source='auto', summary_path=SUMMARY_PATH):
+        """Extract the catalog from the database ('db'), the summaries ('summaries') or
+        the database falling back to the summaries ('auto'). Column descriptions missing in the
+        database are filled in from the summaries."""
+        assert source in SOURCES, f"Invalid source, must be one of {SOURCES}"
+        summaries = columns_from_summaries(summary_path) if source != 'db' else {}
+        if source == 'summaries':
+            return cls(summaries, 'summaries', time.time())
+        try:
+            tables = columns_from_db()
+        except Exception as e:
+            if source == 'db':
+                raise
+            print(f"Error reading the schema from the database, using the summaries: {e}")
+            return cls(summaries, 'summaries', time.time())
+        descriptions = {(normalise_name(t).split('.')[-1], c[0].lower()): c[2]
+                        for t, columns in summaries.items() for c in columns}
+        for table, columns in tables.items():
+            for c in columns:
+                c[2] = descriptions.get((normalise_name(table).split('.')[-1], c[0].lower()), '')
+        return cls(tables, 'db', time.time())
+
+    def find(self, table_name):
+        """Return the catalog names of the tables matching the name, several when the name
+        has no schema and more than one schema has such a table."""
+        key = normalise_name(table_name)
+        if key in self._by_name:
+            return [self._by_name[key]]
+        return self._by_table.get(key.split('.')[-1], [])
+
+    def suggest(self, table_name, n=MAX_SUGGESTIONS):
+        key = normalise_name(table_name).split('.')[-1]
+        return [name for t in difflib.get_close_matches(key, self._by_table, n=n) for name in self._by_table[t]][:n]
+
+    def get_table_columns(self, table_name):
+        """Describe the columns of the table, one 'name | type | description' line per column."""
+        names = self.find(table_name)
+        if not names:
+            suggestions = self.suggest(table_name)
+            similar = f" Similar tables: {', '.join(suggestions)}." if suggestions else ''
+            return (f"table {table_name} is not in the schema catalog.{similar} "
+                    "If the table exists, query INFORMATION_SCHEMA.COLUMNS with execute_sql.")
+        lines = []
+        for name in names:
+            lines.append(f"table {name} columns (name | type | description):")
+            lines += [' | '.join(c).rstrip(' |') for c in self.tables[name]]
+        return '\n'.join(lines)
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def get_catalog(path=CATALOG_PATH):
+    """Return the process-wide catalog, extracting it from the summaries when it was never refreshed."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            if os.path.exists(path):
+                _catalog = SchemaCatalog.load(path)
+            else:
+                _catalog = SchemaCatalog.extract('summaries')
+                _catalog.save(path)
+        return _catalog
+
+def refresh(source='auto', path=CATALOG_PATH, summary_path=SUMMARY_PATH):
+    """Re-extract the catalog and replace the process-wide one."""
+    global _catalog
+    catalog = SchemaCatalog.extract(source, summary_path)
+    catalog.save(path)
+    with _catalog_lock:
+        _catalog = catalog
+    print(f"schema catalog: {len(catalog.tables)} tables, "
+          f"{sum(len(c) for c in catalog.tables.values())} columns from {catalog.source}")
+    return catalog
+
+def get_table_columns(table_name):
+    """Describe the columns of the table from the schema catalog.
+    Args:
+        table_name (string): table name, optionally with schema, e.g. dbo.merchant
+    """
+    return get_catalog().get_table_columns(table_name)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DARE schema catalog")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    refresh_parser = subparsers.add_parser('refresh', help='re-extract the catalog')
+    refresh_parser.add_argument('--source', choices=SOURCES, default='auto')
+    refresh_parser.add_argument('--summary-path', default=SUMMARY_PATH)
+    columns_parser = subparsers.add_parser('columns', help='print the columns of a table')
+    columns_parser.add_argument('table')
+
+    args = parser.parse_args()
+    if args.command == 'refresh':
+        refresh(args.source, summary_path=args.summary_path)
+    elif args.command == 'columns':
+        print(get_table_columns(args.table))
@@ -1,10 +1,11 @@
-import fitz
 # from bs4 import BeautifulSoup
 from langchain_text_splitters import HTMLSemanticPreservingSplitter, RecursiveCharacterTextSplitter
 from pathlib import Path
 import os
 import utils
-from utils import client
+import llm_client
+import ingest
+import pdf_extract
 
 OUTPUT_PATH = './input/summary'
 SYSTEM_PROMPT="""The documents are data dictionary data of DARE database tables.
@@ -57,8 +58,7 @@ class Summariser():
         else:
             f = open(output_path, mode="w", encoding='utf-8')
 
-        doc = fitz.open(pdf_path)
-        text = "".join(page.get_text() for page in doc)
+        text = pdf_extract.extract_text(pdf_path)
         splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
         chunks = splitter.split_text(text)
         table_name = str(pdf_path).split('-')[1]
@@ -83,7 +83,8 @@ class Summariser():
                     {"role": "user", "content": f"Question: {queries}"},
                     {"role": "user", "content": f"chunk #0 context: table / doc name is {table_name}"}
                 ]
-            response = client.chat.completions.create(
+            response = llm_client.chat_completion(
+                call_type='summarise',
                 model=utils.CHAT_MODEL,
                 messages=messages,
                 temperature=temperature,
@@ -102,8 +103,11 @@ class Summariser():
         return
     
     def summarise_pdf(self, pdf_path, chunk_size=8000, temperature=0.8):
-        doc = fitz.open(pdf_path)
-        text = "".join(page.get_text() for page in doc)
+        text = pdf_extract.extract_text(pdf_path)
+        return self.summarise_pdf_text(text, pdf_path, chunk_size, temperature)
+
+    def summarise_pdf_text(self, text, pdf_path, chunk_size=8000, temperature=0.8):
+        """Summarise the text extracted from the PDF file pdf_path."""
         splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
         # splitter = CharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=100)
         chunks = splitter.split_text(text)
@@ -127,7 +131,8 @@ class Summariser():
                     {"role": "user", "content": f"Question: {queries}"},
                     {"role": "user", "content": f"chunk #0 context: table / doc name is {table_name}"}
                 ]
-            response = client.chat.completions.create(
+            response = llm_client.chat_completion(
+                call_type='summarise',
                 model=utils.CHAT_MODEL,
                 messages=messages,
                 temperature=temperature,
@@ -139,11 +144,13 @@ class Summariser():
     
     def summarise_pdf_directory(self, pdf_directory):
         directory = Path(pdf_directory)
-        for file_path in directory.glob("*.pdf"):
+        # extract the text of the next files in the background while summarising
+        files = [(file_path, 'pdf') for file_path in directory.glob("*.pdf")]
+        for file_path, text in ingest.iter_texts(files):
             output_path = utils.get_basename_without_extension(file_path)
             output_path = f"{self.output_path}/{output_path}.txt"
             # print(file_path)
-            summary = self.summarise_pdf(file_path)
+            summary = self.summarise_pdf_text(text, file_path)
             with open(output_path, mode="w", encoding='utf-8') as f:
                 f.write(summary)
 
@@ -179,7 +186,8 @@ class Summariser():
                     {"role": "user", "content": f"Question: {queries}"},
                     {"role": "user", "content": f"chunk #0 context: table / doc name is {table_name}"}
                 ]
-            response = client.chat.completions.create(
+            response = llm_client.chat_completion(
+                call_type='summarise',
                 model=utils.CHAT_MODEL,
                 messages=messages,
                 temperature=temperature
@@ -197,11 +205,12 @@ class Summariser():
     
     def summarise_html_directory(self, html_directory):
         directory = Path(html_directory)
-        for file_path in directory.glob("*.html"):
+        files = [(file_path, 'html') for file_path in directory.glob("*.html")]
+        for file_path, html_content in ingest.iter_texts(files):
             output_path = utils.get_basename_without_extension(file_path)
             output_path = f"{self.output_path}/{output_path}.txt"
             # print(file_path)
-            summary = self.summarise_html(file_path)
+            summary = self.summarise_html_content(html_content)
             with open(output_path, mode="w", encoding='utf-8') as f:
                 f.write(summary)
 
@@ -0,0 +1,184 @@
+"""Declarative registry of the tools the bots can call.
+Each tool is registered once with its function, description, JSON parameters, timeout and
+concurrency limit; Chat_Bot sends the OpenAI tool schemas and LangChainBot builds its tools from
+the same registry. The tool calls of one response run concurrently on a bounded thread pool.
+"""
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import utils
+import db_utils
+import schema_catalog
+import recommend
+
+TOOL_MAX_WORKERS = 8 # tool calls running at once in the process
+DEFAULT_TOOL_TIMEOUT = 60 # seconds
+MAX_TOOL_ITERATIONS = 5 # rounds of tool calls per turn, then the model must answer
+
+class ToolSpec():
+    """A tool: its function, called with the keyword arguments of the tool call, and its OpenAI schema."""
+    def __init__(self, name, func, description, parameters=None, timeout=DEFAULT_TOOL_TIMEOUT,
+                 max_concurrency=None, result_format='{result}'):
+        """
+        Args:
+            name (str): tool name seen by the model.
+            func: function called with the arguments of the tool call.
+            description (str): what the tool does, for the model.
+            parameters (dict): JSON schema properties of the arguments, name -> {"type", "description"}.
+            timeout (float): seconds after which the call is reported to the model as timed out.
+            max_concurrency (int): max number of calls running at once, None for no limit.
+            result_format (str): format of the result returned to the model.
+        """
+        self.name = name
+        self.func = func
+        self.description = description
+        self.parameters = parameters or {}
+        self.timeout = timeout
+        self.result_format = result_format
+        self._slots = threading.Semaphore(max_concurrency) if max_concurrency else None
+
+    def schema(self):
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": {
+                    "type": "object",
+                    "properties": self.parameters,
+                    "required": list(self.parameters)
+                }
+            }
+        }
+
+    def call(self, arguments, timeout=None):
+        """Call the function with the arguments dict and return the result text.
+        timeout: seconds left to wait for a concurrency slot, None to wait for as long as it takes.
+        A call which gets no slot in time does not run, and is reported as timed out."""
+        if self._slots is None:
+            return self.result_format.format(result=self.func(**arguments))
+        if not self._slots.acquire(timeout=timeout):
+            return _timed_out(self.name)
+        try:
+            return self.result_format.format(result=self.func(**arguments))
+        finally:
+            self._slots.release()
+
+_tools = {}
+
+def register(name, func, description, parameters=None, **kwargs):
+    """Register a tool, replacing any tool of the same name. See ToolSpec for the arguments."""
+    _tools[name] = ToolSpec(name, func, description, parameters, **kwargs)
+    return _tools[name]
+
+def get(name):
+    return _tools[name]
+
+def specs():
+    return list(_tools.values())
+
+def schemas():
+    """The OpenAI tool schemas of the registered tools."""
+    return [spec.schema() for spec in _tools.values()]
+
+def call(name, arguments, deadline=None):
+    """Call the tool with its JSON arguments, in the calling thread, and return its result text.
+    Errors are returned as text for the model to react to.
+    deadline: time.perf_counter() after which the call is not started any more, None for no deadline."""
+    if name not in _tools:
+        return f"error: there is no tool {name}"
+    remaining = None if deadline is None else deadline - time.perf_counter()
+    if remaining is not None and remaining <= 0:
+        # queued for longer than the tool's timeout, already reported as timed out
+        return _timed_out(name)
+    try:
+        result = _tools[name].call(json.loads(arguments or '{}'), remaining)
+    except Exception as e:
+        print(f"Error calling tool {name}: {e}")
+        return f"error calling {name}: {e}"
+    return result
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """Return the process-wide thread pool running the tool calls."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix='tool')
+        return _executor
+
+def _timeout(name):
+    return _tools[name].timeout if name in _tools else DEFAULT_TOOL_TIMEOUT
+
+def _timed_out(name):
+    # a running call cannot be stopped, it finishes in the background; a queued one is not started
+    print(f"tool {name} timed out after {_timeout(name)}s")
+    return f"error calling {name}: timed out after {_timeout(name)} seconds"
+
+def call_many(tool_calls):
+    """Run the tool calls of one response concurrently, each within its tool's timeout.
+    Args:
+        tool_calls: list of tool call message dicts, {"id", "function": {"name", "arguments"}}.
+    Returns:
+        list of result texts, aligned with tool_calls.
+    """
+    start = time.perf_counter()
+    names = [tool_call['function']['name'] for tool_call in tool_calls]
+    deadlines = [start + _timeout(name) for name in names]
+    futures = [get_executor().submit(call, name, tool_call['function']['arguments'], deadline)
+               for name, tool_call, deadline in zip(names, tool_calls, deadlines)]
+    results = []
+    for name, future, deadline in zip(names, futures, deadlines):
+        try:
+            results.append(future.result(timeout=max(0, deadline - time.perf_counter())))
+        except FutureTimeoutError:
+            future.cancel()
+            results.append(_timed_out(name))
+    print(f"tools {names} in {(time.perf_counter() - start) * 1000:.0f} ms")
+    return results
+
+async def acall_many(tool_calls):
+    """call_many awaited from asyncio, on the same thread pool."""
+    loop = asyncio.get_running_loop()
+    async def run(tool_call):
+        name = tool_call['function']['name']
+        deadline = time.perf_counter() + _timeout(name)
+        try:
+            # on timeout wait_for cancels the pool's future too, so a queued call is not started
+            return await asyncio.wait_for(loop.run_in_executor(get_executor(), call, name,
+                                                               tool_call['function']['arguments'], deadline),
+                                          _timeout(name))
+        except asyncio.TimeoutError:
+            return _timed_out(name)
+    return await asyncio.gather(*(run(tool_call) for tool_call in tool_calls))
+
+_MARKET_DIVISION = {"type": "string", "description": "Which market division the customer belongs. Valid values are RBS, BB, IB&M"}
+_MCC = {"type": "integer", "description": "MCC / Merchant Category Code."}
+_POSTCODE = {"type": "integer", "description": "Postcode of trading address, must be valid Australian postcode."}
+_REVENUE = {"type": "number", "description": "Monthly net revenue of the merchant."}
+
+register("get_current_date_time", utils.print_now,
+         "Get the current date, time and day of week. It answers the question of today's date, day of week, etc.",
+         timeout=5)
+register("execute_sql", db_utils.execute_sql,
+         "Execute SQL query on the database and return results",
+         {"query": {"type": "string", "description": "The SQL query to execute"}},
+         timeout=120, max_concurrency=4, result_format="query result: {result}")
+register("get_table_columns", schema_catalog.get_table_columns,
+         "Get the columns (name, data type, description) of a DARE table from the local schema catalog",
+         {"table_name": {"type": "string", "description": "The table name, optionally with schema, e.g. dbo.merchant"}},
+         timeout=10)
+register("recommend_product", recommend.recommend_product,
+         "Recommend merchant products based on input criteria",
+         {"cp_cnp": {"type": "string", "description": "Whether the product should be CP / Card Present or CNP / Card Not Present / eCommerce"},
+          "mis_division": _MARKET_DIVISION, "mcc": _MCC, "postcode": _POSTCODE, "revenue": _REVENUE},
+         timeout=30, result_format="recommended products (from high to low priority): {result}")
+register("recommend_pricing", recommend.recommend_pricing,
+         "Recommend merchant pricing plan",
+         {"product_code": {"type": "string", "description": "Merchant product code"},
+          "mis_division": _MARKET_DIVISION, "mcc": _MCC, "postcode": _POSTCODE, "revenue": _REVENUE},
+         timeout=30, result_format="recommended pricing plan: {result}")
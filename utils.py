@@ -1,11 +1,27 @@
 import os
-import requests
+import sys
 import re
-from bs4 import BeautifulSoup
-import openai
+import hashlib
+import json
+import time
+import types
+import importlib
+import threading
 from dotenv import load_dotenv
 from datetime import datetime
 
+class _LazyModule(types.ModuleType):
+    """Placeholder of a module which is imported on first attribute access."""
+    def __getattr__(self, name):
+        return getattr(importlib.import_module(self.__name__), name)
+
+def lazy_import(name):
+    """Return the module, imported on first use, so that importing this project does not pay for
+    heavy dependencies (openai, faiss, fitz, pyodbc...) of features which are never used."""
+    return sys.modules.get(name) or _LazyModule(name)
+
+openai = lazy_import('openai')
+
 # Load environment variables
 load_dotenv()
 
@@ -13,10 +29,40 @@ load_dotenv()
 GENAI_API_URL = os.getenv('GENAI_API_URL')
 GENAI_API_KEY = os.getenv('GENAI_API_KEY')
 CHAT_MODEL='gpt-4.1_v2025-04-14_GLOBAL'
-client=openai.OpenAI(api_key=GENAI_API_KEY, base_url=GENAI_API_URL, timeout=300)
+MODELS_CACHE_PATH = './memory/models_cache.json'
+MODELS_CACHE_TTL = 24 * 3600 # seconds
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return the OpenAI client, created on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = openai.OpenAI(api_key=GENAI_API_KEY, base_url=GENAI_API_URL, timeout=300)
+        return _client
+
+_async_client = None
+
+def get_async_client():
+    """Return the asyncio OpenAI client, created on first use, for the async bots."""
+    global _async_client
+    with _client_lock:
+        if _async_client is None:
+            _async_client = openai.AsyncOpenAI(api_key=GENAI_API_KEY, base_url=GENAI_API_URL, timeout=300)
+        return _async_client
+
+def __getattr__(name):
+    # utils.client and utils.async_client are created on first use, see get_client
+    if name == 'client':
+        return get_client()
+    if name == 'async_client':
+        return get_async_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_available_models():
     """Get list of available models from the API."""
+    import requests
     headers = {
         'Authorization': f'Bearer {GENAI_API_KEY}',
         'Content-Type': 'application/json'
@@ -32,6 +78,35 @@ def get_available_models():
     else:
         raise Exception(f"Error getting models: {response.text}")
     
+def get_available_models_cached(ttl=MODELS_CACHE_TTL, cache_path=MODELS_CACHE_PATH):
+    """Get list of available models, from the cache file when it is younger than ttl seconds.
+    The stale cache is used when the API cannot be reached."""
+    cached = None
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if time.time() - cached['time'] < ttl:
+                return cached['data']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error reading models cache {cache_path}: {e}")
+            cached = None
+    try:
+        models = get_available_models()
+    except Exception as e:
+        if cached is None:
+            raise
+        print(f"Error getting models, using the cached list: {e}")
+        return cached['data']
+    try:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        with open(f'{cache_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'time': time.time(), 'data': models}, f)
+        os.replace(f'{cache_path}.tmp', cache_path)
+    except OSError as e:
+        print(f"Error saving models cache {cache_path}: {e}")
+    return models
+    
 def get_available_emb_models():
     """Get list of available embedding models from the API"""
     all_models = get_available_models()
@@ -65,3 +140,11 @@ def print_now():
     now_string = f'today is {now.strftime("%Y-%m-%d %H:%M:%S")} {now.strftime("%A")}'
     print(now_string)
     return now_string
+
+def get_file_hash(file_path, block_size=1 << 20):
+    """Return the sha256 hex digest of the file's content."""
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()